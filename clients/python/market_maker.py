@@ -170,13 +170,23 @@ class MarketMakerBot(SputnikSession):
                         self.replaceBidAsk(ticker, new_bid, 'BUY')
 
     def replaceBidAsk(self, ticker, new_ba, side):
-        self.cancelOrders(ticker, side)
         if self.markets[ticker]['contract_type'] == "futures":
             quantity = 10
         else:
             quantity = 2.5
 
-        self.placeOrder(ticker, quantity, new_ba, side)
+        open_orders = [id for id, order in self.orders.items()
+                       if not order['is_cancelled'] and order['quantity_left'] > 0
+                       and order['side'] == side and order['contract'] == ticker]
+
+        # Move a single resting quote in one call instead of cancelling it
+        if len(open_orders) == 1 and not open_orders[0].startswith('internal_'):
+            order = self.orders[open_orders[0]]
+            filled = order['quantity'] - order['quantity_left']
+            self.amendOrder(open_orders[0], filled + Decimal(quantity), new_ba)
+        else:
+            self.cancelOrders(ticker, side)
+            self.placeOrder(ticker, quantity, new_ba, side)
 
     def monitorOrders(self):
         for ticker, market in self.external_markets.iteritems():
@@ -392,6 +392,10 @@ class SputnikSession(wamp.ApplicationSession, SputnikMixin):
         log.msg(pformat(["onCancelOrder", success]))
         return success
 
+    def onAmendOrder(self, success):
+        log.msg(pformat(["onAmendOrder", success]))
+        return success
+
     def onOHLCVHistory(self, ohlcv_history):
         log.msg(pformat(["onOHLCVHistory", ohlcv_history]))
         return ohlcv_history
@@ -784,6 +788,23 @@ class SputnikSession(wamp.ApplicationSession, SputnikMixin):
 
         return d.addCallback(_onCancelOrder).addErrback(self.onError, "cancelOrder")
 
+    def amendOrder(self, id, quantity, price):
+        """
+        changes the price and total quantity of an order by its id. A
+        smaller order at the same price keeps its place in the queue.
+        :param id: order id
+        :param quantity: new total quantity, including what has filled
+        :param price: new price
+        """
+        if isinstance(id, basestring) and id.startswith('internal_'):
+            logging.error("can't amend internal order: %s" % id)
+            return
+
+        contract = self.wire_orders[str(id)]['contract']
+        d = self.call(u"rpc.trader.amend_order", int(id), self.price_to_wire(contract, price),
+                      self.quantity_to_wire(contract, quantity))
+        return d.addCallback(self.onAmendOrder).addErrback(self.onError, "amendOrder")
+
 class BotFactory(wamp.ApplicationSessionFactory, EventEmitter):
     def __init__(self, **kwargs):
         EventEmitter.__init__(self)
@@ -865,6 +886,9 @@ class Sputnik(EventEmitter):
     def cancelOrder(self, id):
         return self.session.cancelOrder(id)
 
+    def amendOrder(self, id, quantity, price):
+        return self.session.amendOrder(id, quantity, price)
+
     def getOpenOrders(self):
         return defer.succeed(self.session.orders)
 
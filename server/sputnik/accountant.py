@@ -25,6 +25,7 @@ from rpc_schema import schema
 
 from optparse import OptionParser
 from decimal import Decimal
+from collections import defaultdict
 
 parser = OptionParser()
 parser.add_option("-c", "--config", dest="filename",
@@ -38,6 +39,7 @@ import models
 import margin
 import util
 import ledger
+import stats
 from alerts import AlertsProxy
 from sendmail import Sendmail
 
@@ -48,9 +50,10 @@ from zmq_util import export, dealer_proxy_async, router_share_async, pull_share_
 
 from twisted.internet import reactor, defer, task
 from twisted.python import log
+from twisted.python.failure import Failure
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import func
+from sqlalchemy import func, bindparam
 from watchdog import watchdog
 from jinja2 import Environment, FileSystemLoader
 
@@ -76,6 +79,185 @@ WITHDRAWAL_TOO_SMALL = AccountantException("exceptions/accountant/withdrawal_too
 NO_SUCH_USER = AccountantException("exceptions/accountant/no_such_user")
 INVALID_PRICE_QUANTITY = AccountantException("exceptions/accountant/invalid_price_quantity")
 INVALID_CONTRACT_TYPE = AccountantException("exceptions/accountant/invalid_contract_type")
+ORDER_FILLED = AccountantException("exceptions/accountant/order_filled")
+ORDER_REJECTED = AccountantException("exceptions/accountant/order_rejected")
+
+class CachedPosition(object):
+    __slots__ = ["id", "username", "contract_id", "position", "reference_price", "pending_postings"]
+
+    def __init__(self, username, contract_id, position=0, reference_price=None, pending_postings=0, id=None):
+        self.id = id
+        self.username = username
+        self.contract_id = contract_id
+        self.position = position
+        self.reference_price = reference_price
+        self.pending_postings = pending_postings
+
+    def __repr__(self):
+        return "<CachedPosition('%s', %d, %d)>" % (self.username, self.contract_id, self.position)
+
+
+class PositionCache:
+    """The positions of the accountant's users, kept in memory
+
+    The accountant is the only writer of its users' positions, so once a
+    user's positions are loaded the map is the source of truth and changes
+    are written back to the positions table in batches. With no
+    flush_interval every change is written straight away.
+
+    The table can lag by up to flush_interval seconds, so anything reading
+    positions from it in this process must flush first. The ledger stays
+    the record: positions loaded at startup are recalculated from it.
+    post_or_fail writes its pending_postings increments through before posting.
+    """
+    def __init__(self, session, flush_interval=None):
+        self.session = session
+        self.flush_interval = flush_interval
+        # username -> {contract_id: CachedPosition}
+        self.users = {}
+        self.dirty = set()
+        self.pending_flush = None
+
+    def load(self, username, from_ledger=False):
+        positions = {}
+        for row in self.session.query(models.Position).filter_by(username=username).all():
+            position = row.position or 0
+            if from_ledger:
+                position, timestamp = util.position_calculated(row, self.session)
+                if position != row.position:
+                    log.msg("Position %s is %d in the ledger." % (row, position))
+            cached = CachedPosition(username, row.contract_id, position, row.reference_price,
+                                    row.pending_postings or 0, row.id)
+            positions[row.contract_id] = cached
+            if position != row.position:
+                self.touch(cached)
+        self.users[username] = positions
+        return positions
+
+    def get_user_positions(self, username):
+        positions = self.users.get(username)
+        if positions is None:
+            positions = self.load(username)
+        return positions
+
+    def get(self, username, contract):
+        """Return the cached position, creating it if it does not exist
+
+        :param username: the username
+        :type username: str
+        :param contract: the contract
+        :type contract: models.Contract
+        :returns: CachedPosition
+        """
+        positions = self.get_user_positions(username)
+        position = positions.get(contract.id)
+        if position is None:
+            log.msg("Creating new position for %s on %s." % (username, contract))
+            position = positions[contract.id] = CachedPosition(username, contract.id)
+            self.touch(position)
+        return position
+
+    def get_value(self, username, contract):
+        position = self.get_user_positions(username).get(contract.id)
+        if position is None:
+            return 0
+        return position.position
+
+    def touch(self, position):
+        self.dirty.add(position)
+        if self.flush_interval is None:
+            self.flush()
+        elif self.pending_flush is None:
+            self.pending_flush = reactor.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write every changed position to the database in one transaction
+
+        :returns: bool -- False if the write failed, the positions stay dirty and are retried
+        """
+        if self.pending_flush is not None and self.pending_flush.active():
+            self.pending_flush.cancel()
+        self.pending_flush = None
+
+        if not self.dirty:
+            return True
+
+        dirty = list(self.dirty)
+        table = models.Position.__table__
+        updates = [{"b_id": position.id, "b_position": position.position,
+                    "b_reference_price": position.reference_price,
+                    "b_pending_postings": position.pending_postings}
+                   for position in dirty if position.id is not None]
+        inserts = [position for position in dirty if position.id is None]
+        ids = {}
+        try:
+            if updates:
+                self.session.execute(table.update().where(table.c.id == bindparam("b_id")).values(
+                    position=bindparam("b_position"),
+                    reference_price=bindparam("b_reference_price"),
+                    pending_postings=bindparam("b_pending_postings")), updates)
+            for position in inserts:
+                ids[position] = self.insert(position)
+            self.session.commit()
+        except SQLAlchemyError, e:
+            log.err("Could not flush %d positions: %s" % (len(dirty), e))
+            self.session.rollback()
+            if self.flush_interval is not None:
+                self.pending_flush = reactor.callLater(self.flush_interval, self.flush)
+            return False
+
+        for position, id in ids.iteritems():
+            position.id = id
+        self.dirty.difference_update(dirty)
+        return True
+
+    def write_pending(self, positions):
+        """Write just the pending_postings of the positions, leaving the rest for the next flush
+
+        New positions are inserted whole.
+
+        :returns: bool -- False if the write failed
+        """
+        if self.flush_interval is None:
+            return self.flush()
+
+        positions = set(positions)
+        table = models.Position.__table__
+        updates = [{"b_id": position.id, "b_pending_postings": position.pending_postings}
+                   for position in positions if position.id is not None]
+        inserts = [position for position in positions if position.id is None]
+        ids = {}
+        try:
+            if updates:
+                self.session.execute(table.update().where(table.c.id == bindparam("b_id")).values(
+                    pending_postings=bindparam("b_pending_postings")), updates)
+            for position in inserts:
+                ids[position] = self.insert(position)
+            self.session.commit()
+        except SQLAlchemyError, e:
+            log.err("Could not write pending postings of %d positions: %s" % (len(positions), e))
+            self.session.rollback()
+            return False
+
+        for position, id in ids.iteritems():
+            position.id = id
+        self.dirty.difference_update(inserts)
+        return True
+
+    def insert(self, position):
+        table = models.Position.__table__
+        result = self.session.execute(table.insert().values(
+            username=position.username, contract_id=position.contract_id,
+            position=position.position, reference_price=position.reference_price,
+            pending_postings=position.pending_postings))
+        return result.inserted_primary_key[0]
+
+    def invalidate(self, username):
+        """Flush and forget a user's positions, before they are changed in the database
+        """
+        if self.flush() and username in self.users:
+            del self.users[username]
+
 
 class Accountant:
     """The Accountant primary class
@@ -83,17 +265,29 @@ class Accountant:
     """
     def __init__(self, session, engines, cashier, ledger, webserver, accountant_proxy,
                  alerts_proxy, accountant_number=0, debug=False, trial_period=False,
-                 mimetic_share=0.5, sendmail=None, template_dir='admin_templates'):
+                 mimetic_share=0.5, sendmail=None, template_dir='admin_templates',
+                 position_flush_interval=None, verify_margin=False, ledger_retries=7):
         """Initialize the Accountant
 
         :param session: The SQL Alchemy session
         :type session:
         :param debug: Whether or not weird things can happen like position adjustment
         :type debug: bool
+        :param position_flush_interval: seconds between writes of changed positions, None to write them at once
+        :type position_flush_interval: float
+        :param verify_margin: check every incremental margin against a full calculation
+        :type verify_margin: bool
+        :param ledger_retries: times to post again, after 1, 2, 4... seconds, when the ledger is overloaded
+        :type ledger_retries: int
 
         """
 
         self.session = session
+        self.positions = PositionCache(session, position_flush_interval)
+        # username -> margin.MarginState
+        self.margin_states = {}
+        self.verify_margin = verify_margin
+        self.ledger_retries = ledger_retries
         self.debug = debug
         self.deposit_limits = {}
         # TODO: Make this configurable
@@ -130,7 +324,9 @@ class Accountant:
         # Posting happens as follows:
         # 1. All affected positions have a counter incremented to keep track of
         #    pending postings.
-        # 2. The ledger's RPC post() is invoked.
+        # 2. The ledger's RPC post() is invoked. If the ledger is overloaded
+        #    it is invoked again with backoff. The other postings of the group
+        #    may have started it meanwhile, and it would time out without ours.
         # 3. When the call returns, the position counters are decremented. This
         #    happens whether or not there was an error.
         # 4a. If there was no error, positions are updated and the webserver is
@@ -147,20 +343,14 @@ class Accountant:
         def update_counters(increment=False):
             change = 1 if increment else -1
 
-            try:
-                for posting in postings:
-                    position = self.get_position(
-                            posting['username'], posting['contract'])
-                    position.pending_postings += change
-                    # we might be initializing the position here, so make sure it is in db
-                    self.session.add(position)
-                self.session.commit()
-            except SQLAlchemyError, e:
-                log.err("Could not update counters: %s" % e)
-                self.alerts_proxy.send_alert("Exception in ledger. See logs.")
-                self.session.rollback()
-            finally:
-                self.session.rollback()
+            positions = []
+            for posting in postings:
+                position = self.get_position(
+                        posting['username'], posting['contract'])
+                position.pending_postings += change
+                self.positions.touch(position)
+                positions.append(position)
+            return positions
 
         def on_success(result):
             log.msg("Post success: %s" % result)
@@ -175,14 +365,32 @@ class Accountant:
 
                     log.msg("Adjusting position %s by %d %s" % (position, posting['quantity'], posting['direction']))
                     position.position += sign * posting['quantity']
+                    self.positions.touch(position)
                     log.msg("New position: %s" % position)
-                    #self.session.merge(position)
-                self.session.commit()
             finally:
                 self.session.rollback()
 
+        def post(attempt=0):
+            d = defer.maybeDeferred(self.ledger.post, *postings)
+            if attempt < self.ledger_retries:
+                d.addErrback(retry_overloaded, attempt)
+            return d
+
+        def retry_overloaded(failure, attempt):
+            failure.trap(ledger.LedgerException)
+            if failure.value.args != ledger.OVERLOADED.args:
+                return failure
+            delay = 2 ** attempt
+            log.msg("Ledger is overloaded, posting again in %ds: %s" % (delay, postings))
+            return task.deferLater(reactor, delay, post, attempt + 1)
+
         def on_fail_ledger(failure):
             e = failure.trap(ledger.LedgerException)
+            if failure.value.args == ledger.OVERLOADED.args:
+                log.err("Ledger refused postings %d times, it is overloaded: %s" %
+                        (self.ledger_retries + 1, postings))
+                self.alerts_proxy.send_alert("Ledger is overloaded and refusing postings. See logs.")
+                return failure
             log.err("Ledger exception:")
             log.err(failure.value)
             self.alerts_proxy.send_alert("Exception in ledger. See logs.")
@@ -221,9 +429,15 @@ class Accountant:
             update_counters(increment=False)
             return result
 
-        update_counters(increment=True)
+        positions = update_counters(increment=True)
+        # The increments go to the database before the ledger can commit,
+        #   so that repair_user_positions sees postings in flight after a crash.
+        #   The decrements, and everything else, can wait for the next flush.
+        if not self.positions.write_pending(positions):
+            log.err("Could not update counters for postings: %s" % (postings,))
+            self.alerts_proxy.send_alert("Exception in ledger. See logs.")
 
-        d = self.ledger.post(*postings)
+        d = post()
 
         d.addBoth(decrement_counters)
         d.addCallback(on_success).addCallback(publish_transactions)
@@ -244,12 +458,8 @@ class Accountant:
         :raises: AccountantException
         """
 
-        if isinstance(username, models.User):
-            return username
-
         try:
-            return self.session.query(models.User).filter_by(
-                username=username).one()
+            return util.get_user(self.session, username)
         except NoResultFound:
             raise NO_SUCH_USER
 
@@ -308,15 +518,11 @@ class Accountant:
         """
         user = self.get_user(username)
         contract = self.get_contract(ticker)
-        try:
-            return self.session.query(models.Position).filter_by(
-                user=user, contract=contract).one().position
-        except NoResultFound:
-            return 0
+        return self.positions.get_value(user.username, contract)
 
     def get_margin(self, username):
         user = self.get_user(username)
-        low_margin, high_margin, cash_spent = margin.calculate_margin(user, self.session, safe_prices=self.safe_prices)
+        low_margin, high_margin, cash_spent = self.calculate_margin_incremental(user)
         cash_position = self.get_position_value(username, 'BTC')
         return {
             'username': username,
@@ -326,7 +532,7 @@ class Accountant:
         }
 
     def get_position(self, username, ticker, reference_price=None):
-        """Return a user's position for a contact. If it does not exist, initialize it. WARNING: If a position is created, it will be added to the session.
+        """Return a user's position for a contact. If it does not exist, initialize it.
 
         :param username: the username
         :type username: str, models.User
@@ -334,26 +540,77 @@ class Accountant:
         :type ticker: str, models.User
         :param reference_price: the (optional) reference price for the position
         :type reference_price: int
-        :returns: models.Position -- the position object
+        :returns: CachedPosition -- the position, call self.positions.touch after changing it
         """
 
         user = self.get_user(username)
         contract = self.get_contract(ticker)
 
-        try:
-            position = self.session.query(models.Position).filter_by(
-                user=user, contract=contract).one()
-            if position.reference_price is None and reference_price is not None:
-                position.reference_price = reference_price
-                self.session.add(position)
-            return position
-        except NoResultFound:
-            log.msg("Creating new position for %s on %s." %
-                          (username, contract))
-            position = models.Position(user, contract)
+        position = self.positions.get(user.username, contract)
+        if position.reference_price is None and reference_price is not None:
             position.reference_price = reference_price
-            self.session.add(position)
-            return position
+            self.positions.touch(position)
+        return position
+
+    def get_margin_positions(self, user):
+        """The user's positions from memory, in the form margin.calculate_margin takes overrides
+        """
+        positions = {}
+        for position in self.positions.get_user_positions(user.username).itervalues():
+            contract = self.get_contract(position.contract_id)
+            positions[contract.ticker] = {'position': position.position,
+                                          'reference_price': position.reference_price,
+                                          'contract': contract}
+        return positions
+
+    def calculate_margin(self, user, position_overrides={}, **kwargs):
+        """margin.calculate_margin, with the user's positions from memory rather than the database
+        """
+        overrides = self.get_margin_positions(user)
+        overrides.update(position_overrides)
+        return margin.calculate_margin(user, self.session, self.safe_prices,
+                                       position_overrides=overrides, **kwargs)
+
+    def get_margin_state(self, user):
+        state = self.margin_states.get(user.username)
+        if state is None:
+            state = margin.MarginState(user, trial_period=self.trial_period)
+            state.load(self.session)
+            self.margin_states[user.username] = state
+        return state
+
+    def update_margin_state(self, order):
+        """Bring the user's margin state up to date after an order changed
+
+        Call this after the change is committed, or rolled back.
+        """
+        state = self.margin_states.get(order.username)
+        if state is not None:
+            state.update_order(order)
+
+    def calculate_margin_incremental(self, user, order=None, withdrawals=None):
+        """Calculate the margin from the user's margin state, without reloading their orders
+
+        :param order: an order not yet accepted we're considering throwing in
+        :type order: models.Order
+        :param withdrawals: ticker -> amount to be withdrawn
+        :type withdrawals: dict
+        :returns: tuple -- low and high margin, and max_cash_spent, as calculate_margin
+        """
+        state = self.get_margin_state(user)
+        result = state.calculate(self.get_margin_positions(user), self.safe_prices, order=order,
+                                 withdrawals=withdrawals)
+        if self.verify_margin:
+            expected = self.calculate_margin(user, order_id=order.id if order is not None else None,
+                                             withdrawals=withdrawals, trial_period=self.trial_period)
+            nonzero = lambda cash_spent: dict((ticker, amount) for ticker, amount in cash_spent.iteritems() if amount)
+            if result[:2] != expected[:2] or nonzero(result[2]) != nonzero(expected[2]):
+                log.err("Incremental margin for %s is %s, calculated margin is %s." %
+                        (user.username, result, expected))
+                self.alerts_proxy.send_alert("Incremental margin mismatch for %s. See logs." % user.username)
+                del self.margin_states[user.username]
+                return expected
+        return result
 
     def check_margin(self, user, low_margin, high_margin):
         cash = self.get_position_value(user, "BTC")
@@ -398,10 +655,9 @@ class Accountant:
         cash_position = self.get_position_value(position.username, position.contract.denominated_contract)
         cash_override = {position.contract.denominated_contract_ticker: cash_position - cash_spent}
 
-        margin_current = margin.calculate_margin(position.user, self.session, self.safe_prices)
-        margin_if = margin.calculate_margin(position.user, self.session, self.safe_prices,
-                                                                      position_overrides=position_override,
-                                                                      cash_overrides=cash_override)
+        margin_current = self.calculate_margin(position.user)
+        margin_if = self.calculate_margin(position.user, position_overrides=position_override,
+                                          cash_overrides=cash_override)
         margin_change = margin_current[0] - margin_if[0]
         cost = (best_ask - best_bid)/2.0
 
@@ -417,6 +673,7 @@ class Accountant:
 
         def after_cancellations(results):
             log.msg("Cancels done for %s" % username)
+            self.positions.flush()
             # Wait for pending postings
             total_pending = self.session.query(func.sum(models.Position.pending_postings).label("total_pending")).join(
                 models.Contract).filter(
@@ -434,7 +691,7 @@ class Accountant:
                 deferreds = []
                 for position in positions:
                     if position.contract.ticker not in order_books:
-                        d = self.engines[position.contract.ticker].get_order_book()
+                        d = self.engines[position.contract.ticker].get_order_book(depth=1)
                         def got_book(book, ticker):
                             order_books[ticker] = book
                             return (ticker, book)
@@ -465,6 +722,7 @@ class Accountant:
         # Disable the user while this is happening
         self.disable_user(username)
 
+        self.positions.flush()
         positions = self.session.query(models.Position).join(models.Contract).filter_by(username=username).filter(
             models.Contract.contract_type.in_(["futures", "prediction"]))
         deferreds = [self.liquidate_position(username, p.contract.ticker) for p in positions]
@@ -532,6 +790,7 @@ class Accountant:
 
         def after_cancellations(results):
             log.msg("Cancels for %s / %s done" % (username, ticker))
+            self.positions.flush()
             # Wait until all pending postings have gone through
             try:
                 position = self.session.query(models.Position).filter_by(user=user, contract=contract).one()
@@ -584,9 +843,7 @@ class Accountant:
                     self.session.rollback()
                 raise TRADE_NOT_PERMITTED
 
-            low_margin, high_margin, max_cash_spent = margin.calculate_margin(
-                order.user, self.session, self.safe_prices, order.id,
-                trial_period=self.trial_period)
+            low_margin, high_margin, max_cash_spent = self.calculate_margin_incremental(order.user, order=order)
 
             if not self.check_margin(order.user, low_margin, high_margin):
                 log.msg("Order rejected due to margin.")
@@ -610,6 +867,7 @@ class Accountant:
             self.alerts_proxy.send_alert("Could not merge order: %s" % order)
         finally:
             self.session.rollback()
+        self.update_margin_state(order)
 
     def charge_fees(self, fees, user, type="Trade"):
         """Credit fees to the people operating the exchange
@@ -667,17 +925,43 @@ class Accountant:
 
         return user_postings, vendor_postings, remainder_postings
 
+    @util.timed
     def post_transaction(self, username, transaction):
         """Update the database to reflect that the given trade happened. Charge fees.
 
         :param transaction: the transaction object
         :type transaction: dict
         """
-        log.msg("Processing transaction %s." % transaction)
-        last = time.time()
         if username != transaction["username"]:
             raise RemoteCallException("username does not match transaction")
 
+        fill = self.prepare_transaction(transaction)
+        if fill["trade"] is not None:
+            try:
+                self.session.add(fill["trade"])
+                self.session.commit()
+                log.msg("Trade saved to db with posted=false: %s" % fill["trade"])
+            except Exception as e:
+                self.session.rollback()
+                log.err("Exception while creating trade: %s" % e)
+
+        for posting in fill["remote_postings"]:
+            self.accountant_proxy.remote_post(posting["username"], posting)
+
+        d = self.post_or_fail(*fill["postings"])
+        return self.finish_transaction(fill, d)
+
+    def prepare_transaction(self, transaction):
+        """Work out the postings, fees and trade for a transaction, without saving or posting anything
+
+        :param transaction: the transaction object
+        :type transaction: dict
+        :returns: dict -- the transaction's fill, with its postings, remote_postings, fees and
+            unsaved trade, which is None for the passive side
+        """
+        log.msg("Processing transaction %s." % transaction)
+        last = time.time()
+        username = transaction["username"]
         aggressive = transaction["aggressive"]
         ticker = transaction["contract"]
         order = transaction["order"]
@@ -685,7 +969,6 @@ class Accountant:
         side = transaction["side"]
         price = transaction["price"]
         quantity = transaction["quantity"]
-        timestamp = transaction["timestamp"]
         uid = transaction["uid"]
 
         if ticker in self.clearing_contracts:
@@ -703,11 +986,6 @@ class Accountant:
         last = next
         log.msg("post_transaction: part 1: %.3f ms." % elapsed)
 
-        next = time.time()
-        elapsed = (next - last) * 1000
-        last = next
-        log.msg("post_transaction: part 2: %.3f ms." % elapsed)
-
         if side == "BUY":
             denominated_direction = "debit"
             payout_direction = "credit"
@@ -735,13 +1013,8 @@ class Accountant:
                 payout_contract = contract
                 position = self.get_position(user, contract, price)
                 cash_spent = util.get_cash_spent(contract, price - position.reference_price, quantity)
-
-                # Make sure the position goes into the db with this reference price
-                self.session.add(position)
-                self.session.commit()
             except Exception as e:
-                self.session.rollback()
-                log.err("Unable to add position %s to db" % position)
+                log.err("Unable to add position for %s on %s: %s" % (username, contract, e))
         else:
             cash_spent = util.get_cash_spent(contract, price, quantity)
 
@@ -784,23 +1057,44 @@ class Accountant:
             posting["count"] = count
             posting["uid"] = uid
 
-        for posting in remote_postings:
-            self.accountant_proxy.remote_post(posting["username"], posting)
-
+        trade = None
         if aggressive:
             try:
                 aggressive_order = self.session.query(models.Order).filter_by(id=order).one()
                 passive_order = self.session.query(models.Order).filter_by(id=other_order).one()
-
                 trade = models.Trade(aggressive_order, passive_order, price, quantity)
-                self.session.add(trade)
-                self.session.commit()
-                log.msg("Trade saved to db with posted=false: %s" % trade)
             except Exception as e:
-                self.session.rollback()
                 log.err("Exception while creating trade: %s" % e)
 
-        d = self.post_or_fail(*postings)
+        return {"transaction": transaction,
+                "user": user,
+                "contract": contract,
+                "postings": postings,
+                "remote_postings": remote_postings,
+                "fees": fees,
+                "trade": trade}
+
+    def finish_transaction(self, fill, d):
+        """Once the fill's postings are in the ledger, update its order, and tell the user and the webserver
+
+        :param fill: from prepare_transaction
+        :type fill: dict
+        :param d: the result of posting the fill
+        :type d: Deferred
+        :returns: Deferred
+        """
+        transaction = fill["transaction"]
+        username = transaction["username"]
+        ticker = transaction["contract"]
+        order = transaction["order"]
+        side = transaction["side"]
+        price = transaction["price"]
+        quantity = transaction["quantity"]
+        timestamp = transaction["timestamp"]
+        user = fill["user"]
+        contract = fill["contract"]
+        fees = fill["fees"]
+        trade = fill["trade"]
 
         def update_order(result):
             try:
@@ -808,6 +1102,7 @@ class Accountant:
                 db_order.quantity_left -= quantity
                 # self.session.add(db_order)
                 self.session.commit()
+                self.update_margin_state(db_order)
                 log.msg("Updated order: %s" % db_order)
             except Exception as e:
                 self.session.rollback()
@@ -867,24 +1162,89 @@ class Accountant:
         # TODO: add errbacks for these
         d.addBoth(update_order)
         d.addCallback(notify_fill)
-        if aggressive:
+        if trade is not None:
             d.addCallback(publish_trade)
 
         # The engine doesn't care to receive errors
         return d.addErrback(log.err)
 
+    @util.timed
+    def post_transactions(self, transactions):
+        """Post the fills an engine made in one turn, in the order it made them
+
+        All of the trades are saved in one commit, and the postings go to the
+        ledger in one call per uid, so both sides of a fill between users
+        of this accountant share a call. One transaction failing to prepare
+        does not stop the rest.
+
+        :param transactions: the transaction objects
+        :type transactions: list
+        :returns: DeferredList
+        """
+        log.msg("Processing %d transactions." % len(transactions))
+        fills = []
+        for transaction in transactions:
+            try:
+                fills.append(self.prepare_transaction(transaction))
+            except Exception as e:
+                log.err("Unable to post transaction %s: %s" % (transaction, e))
+
+        trades = [fill["trade"] for fill in fills if fill["trade"] is not None]
+        if trades:
+            try:
+                self.session.add_all(trades)
+                self.session.commit()
+                log.msg("%d trades saved to db with posted=false" % len(trades))
+            except Exception as e:
+                self.session.rollback()
+                log.err("Exception while creating trades: %s" % e)
+                for fill in fills:
+                    fill["trade"] = None
+
+        # uid -> fills, and (uid, accountant) -> remote postings, in the order they came
+        by_uid = defaultdict(list)
+        remote = defaultdict(list)
+        uids = []
+        for fill in fills:
+            uid = fill["transaction"]["uid"]
+            if uid not in by_uid:
+                uids.append(uid)
+            by_uid[uid].append(fill)
+            for posting in fill["remote_postings"]:
+                accountant = self.accountant_proxy.get_accountant_for_user(posting["username"])
+                remote[uid, accountant].append(posting)
+
+        for (uid, accountant), postings in sorted(remote.iteritems(), key=lambda item: uids.index(item[0][0])):
+            self.accountant_proxy.remote_post(postings[0]["username"], *postings)
+
+        deferreds = []
+        for uid in uids:
+            postings = [posting for fill in by_uid[uid] for posting in fill["postings"]]
+            d = self.post_or_fail(*postings)
+            results = [defer.Deferred() for fill in by_uid[uid]]
+
+            def fan_out(result, results=results):
+                for branch in results:
+                    if isinstance(result, Failure):
+                        branch.errback(result)
+                    else:
+                        branch.callback(result)
+
+            d.addBoth(fan_out)
+            deferreds.extend(self.finish_transaction(fill, branch) for fill, branch in zip(by_uid[uid], results))
+        return defer.DeferredList(deferreds)
+
     def raiseException(self, failure):
         raise failure.value
 
-    def cancel_order(self, username, order_id):
-        """Cancel an order by id.
+    def get_cancellable_order(self, username, order_id):
+        """Look up an order the user is allowed to cancel
 
-        :param id: The order id to cancel
-        :type id: int
-        :returns: tuple -- (True/False, Result/Error)
+        :param order_id: The order id to cancel
+        :type order_id: int
+        :returns: models.Order
+        :raises: NO_ORDER_FOUND, USER_ORDER_MISMATCH, ORDER_CANCELLED
         """
-        log.msg("Received request to cancel order id %d." % order_id)
-
         try:
             order = self.session.query(models.Order).filter_by(id=order_id).one()
         except NoResultFound:
@@ -896,6 +1256,19 @@ class Accountant:
         if order.is_cancelled:
             raise ORDER_CANCELLED
 
+        return order
+
+    @util.timed
+    def cancel_order(self, username, order_id):
+        """Cancel an order by id.
+
+        :param id: The order id to cancel
+        :type id: int
+        :returns: tuple -- (True/False, Result/Error)
+        """
+        log.msg("Received request to cancel order id %d." % order_id)
+
+        order = self.get_cancellable_order(username, order_id)
         d = self.engines[order.contract.ticker].cancel_order(order_id)
 
         def update_order(result):
@@ -908,6 +1281,7 @@ class Accountant:
                 log.err("Unable to commit order cancellation")
                 raise e
 
+            self.update_margin_state(order)
             return result
 
         def publish_order(result):
@@ -919,6 +1293,139 @@ class Accountant:
         d.addErrback(self.raiseException)
         return d
 
+    def amend_order(self, username, order_id, price, quantity):
+        """Change the price and total quantity of an open order
+
+        A smaller order at the same price keeps its place in the queue,
+        anything else is cancelled and placed again by the engine in one go
+        and has to pass the margin check.
+
+        :param order_id: The order id to amend
+        :type order_id: int
+        :param price: the new price
+        :type price: int
+        :param quantity: the new total quantity, including what has filled
+        :type quantity: int
+        :returns: Deferred
+        :raises: INVALID_PRICE_QUANTITY, ORDER_FILLED, INSUFFICIENT_MARGIN, DISABLED_USER, TRADE_NOT_PERMITTED
+        """
+        log.msg("Received request to amend order id %d to %d at %d." % (order_id, quantity, price))
+
+        order = self.get_cancellable_order(username, order_id)
+        contract = order.contract
+        if contract.ticker in self.clearing_contracts:
+            raise CONTRACT_CLEARING
+
+        self.check_price_quantity(contract, price, quantity)
+        if order.quantity_left + quantity - order.quantity <= 0:
+            raise ORDER_FILLED
+
+        old_price, old_quantity = order.price, order.quantity
+        order.price = price
+        order.quantity = quantity
+        order.quantity_left += quantity - old_quantity
+
+        if price != old_price or quantity > old_quantity:
+            user = order.user
+            if not self.is_user_enabled(user):
+                self.session.rollback()
+                raise DISABLED_USER
+
+            if not user.permissions.trade:
+                self.session.rollback()
+                raise TRADE_NOT_PERMITTED
+
+            self.update_margin_state(order)
+            low_margin, high_margin, max_cash_spent = self.calculate_margin_incremental(user)
+            if not self.check_margin(user, low_margin, high_margin):
+                log.msg("Amend rejected due to margin.")
+                self.session.rollback()
+                self.update_margin_state(order)
+                raise INSUFFICIENT_MARGIN
+
+        try:
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            self.update_margin_state(order)
+            log.err("Unable to commit order amendment")
+            raise e
+        self.update_margin_state(order)
+
+        d = self.engines[contract.ticker].amend_order(order_id, price, quantity)
+
+        def update_order(amended):
+            if not amended:
+                # The order left the book first, put it back how it was
+                try:
+                    order.price = old_price
+                    order.quantity_left += old_quantity - order.quantity
+                    order.quantity = old_quantity
+                    self.session.commit()
+                except Exception as e:
+                    self.session.rollback()
+                    log.err("Unable to revert order amendment")
+                    raise e
+                finally:
+                    self.update_margin_state(order)
+
+            self.webserver.order(username, order.to_webserver())
+            return amended
+
+        d.addCallback(update_order)
+        d.addErrback(self.raiseException)
+        return d
+
+    @util.timed
+    def cancel_orders(self, username, order_ids):
+        """Cancel a batch of orders, one engine call per contract
+
+        :param order_ids: The order ids to cancel
+        :type order_ids: list
+        :returns: Deferred -- a {"success": ..., "result"/"error": ...} per order, in order
+        """
+        log.msg("Received request to cancel order ids %s." % order_ids)
+
+        results = [None] * len(order_ids)
+        batches = defaultdict(list)
+        for i, order_id in enumerate(order_ids):
+            try:
+                order = self.get_cancellable_order(username, order_id)
+                batches[order.contract.ticker].append((i, order))
+            except AccountantException as e:
+                results[i] = {"success": False, "error": e.args}
+
+        def update_orders(engine_results, batch):
+            try:
+                for i, order in batch:
+                    order.is_cancelled = True
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                log.err("Unable to commit order cancellations")
+                raise e
+
+            for i, order in batch:
+                self.update_margin_state(order)
+
+            for (i, order), result in zip(batch, engine_results):
+                self.webserver.order(username, order.to_webserver())
+                results[i] = {"success": True, "result": result}
+
+        def batch_failed(failure, batch):
+            log.err(failure)
+            for i, order in batch:
+                results[i] = {"success": False, "error": failure.value.args}
+
+        deferreds = []
+        for ticker, batch in batches.iteritems():
+            d = self.engines[ticker].cancel_orders([order.id for i, order in batch])
+            d.addCallback(update_orders, batch)
+            d.addErrback(batch_failed, batch)
+            deferreds.append(d)
+
+        return defer.gatherResults(deferreds).addCallback(lambda ignored: results)
+
     def cancel_order_engine(self, username, id):
         log.msg("Received msg from engine to cancel order id %d" % id)
 
@@ -948,16 +1455,17 @@ class Accountant:
             self.alerts_proxy.send_alert("Could not merge cancelled order: %s" % order)
         finally:
             self.session.rollback()
+        self.update_margin_state(order)
 
         self.webserver.order(username, order.to_webserver())
 
 
-    def place_order(self, username, order, force=False):
-        """Place an order
+    def create_order(self, order, force=False):
+        """Check an order, save it and accept it if the user can afford it
 
         :param order: dictionary representing the order to be placed
         :type order: dict
-        :returns: tuple -- (True/False, Result/Error)
+        :returns: models.Order
         """
         if order["contract"] in self.clearing_contracts:
             raise CONTRACT_CLEARING
@@ -977,20 +1485,7 @@ class Accountant:
                 log.err("Webserver allowed a 'cash' contract!")
                 raise INVALID_CONTRACT_TYPE
 
-        if order["price"] % contract.tick_size != 0 or order["price"] < 0 or order["quantity"] < 0:
-            raise INVALID_PRICE_QUANTITY
-
-        # case of predictions
-        if contract.contract_type == 'prediction':
-            if not 0 <= order["price"] <= contract.denominator:
-                raise INVALID_PRICE_QUANTITY
-
-        if contract.contract_type == "cash_pair":
-            if not order["quantity"] % contract.lot_size == 0:
-                raise INVALID_PRICE_QUANTITY
-
-        else:
-            log.msg("Forcing order")
+        self.check_price_quantity(contract, order["price"], order["quantity"])
 
         o = models.Order(user, contract, order["quantity"], order["price"], order["side"].upper(),
                          timestamp=util.timestamp_to_dt(order['timestamp']))
@@ -1003,29 +1498,114 @@ class Accountant:
             raise e
 
         self.accept_order(o, force=force)
-        d = self.engines[o.contract.ticker].place_order(o.to_matching_engine_order())
+        return o
+
+    def check_price_quantity(self, contract, price, quantity):
+        """Make sure an order's price and quantity are valid for its contract
+
+        :raises: INVALID_PRICE_QUANTITY
+        """
+        if price % contract.tick_size != 0 or price < 0 or quantity < 0:
+            raise INVALID_PRICE_QUANTITY
+
+        # case of predictions
+        if contract.contract_type == 'prediction':
+            if not 0 <= price <= contract.denominator:
+                raise INVALID_PRICE_QUANTITY
+
+        if contract.contract_type == "cash_pair":
+            if not quantity % contract.lot_size == 0:
+                raise INVALID_PRICE_QUANTITY
 
-        def mark_order_dispatched(result):
-            o.dispatched = True
+    def track_dispatch(self, d, username, orders):
+        """Mark orders dispatched and publish them once the engine has them
+
+        :param d: the engine call the orders went out in
+        :type d: Deferred
+        :param orders: the orders sent
+        :type orders: list
+        """
+        def mark_orders_dispatched(result):
+            for o in orders:
+                o.dispatched = True
             try:
                 # self.session.add(o)
                 self.session.commit()
             except:
-                self.alerts_proxy.send_alert("Could not mark order as dispatched: %s" % o)
+                self.alerts_proxy.send_alert("Could not mark orders as dispatched: %s" % orders)
             finally:
                 self.session.rollback()
             return result
 
-        def publish_order(result):
-            self.webserver.order(username, o.to_webserver())
+        def publish_orders(result):
+            for o in orders:
+                self.webserver.order(username, o.to_webserver())
             return result
 
         d.addErrback(self.raiseException)
-        d.addCallback(mark_order_dispatched)
-        d.addCallback(publish_order)
+        d.addCallback(mark_orders_dispatched)
+        d.addCallback(publish_orders)
+        return d
+
+    @util.timed
+    def place_order(self, username, order, force=False):
+        """Place an order
+
+        :param order: dictionary representing the order to be placed
+        :type order: dict
+        :returns: tuple -- (True/False, Result/Error)
+        """
+        o = self.create_order(order, force=force)
+        d = self.engines[o.contract.ticker].place_order(o.to_matching_engine_order())
+        self.track_dispatch(d, username, [o])
 
         return o.id
 
+    @util.timed
+    def place_orders(self, username, orders):
+        """Place a batch of orders, one engine call per contract
+
+        Each order is checked and accepted in turn, so the margin check for
+        one order counts the orders accepted before it. An order succeeds
+        once the engine has taken it. One the engine refuses fails with
+        ORDER_REJECTED; the engine has it cancelled through on_queue_fail,
+        which gives back the margin it held.
+
+        :param orders: dictionaries representing the orders to be placed
+        :type orders: list
+        :returns: Deferred -- a {"success": ..., "result"/"error": ...} per order, in order
+        """
+        results = [None] * len(orders)
+        batches = defaultdict(list)
+        for i, order in enumerate(orders):
+            try:
+                o = self.create_order(order)
+                batches[o.contract.ticker].append((i, o))
+            except AccountantException as e:
+                results[i] = {"success": False, "error": e.args}
+
+        def map_results(engine_results, batch):
+            for (i, o), placed in zip(batch, engine_results):
+                if placed:
+                    results[i] = {"success": True, "result": o.id}
+                else:
+                    log.msg("Engine refused order %d" % o.id)
+                    results[i] = {"success": False, "error": ORDER_REJECTED.args}
+
+        def batch_failed(failure, batch):
+            log.err(failure)
+            for i, o in batch:
+                results[i] = {"success": False, "error": failure.value.args}
+
+        deferreds = []
+        for ticker, batch in batches.iteritems():
+            d = self.engines[ticker].place_orders([o.to_matching_engine_order() for i, o in batch])
+            self.track_dispatch(d, username, [o for i, o in batch])
+            d.addCallbacks(map_results, batch_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+            deferreds.append(d)
+
+        return defer.gatherResults(deferreds).addCallback(lambda ignored: results)
+
     def transfer_position(self, username, ticker, direction, quantity, note, uid):
         """Transfer a position from one user to another
 
@@ -1083,10 +1663,8 @@ class Accountant:
                 raise DISABLED_USER
 
             # Check margin now
-            low_margin, high_margin, max_cash_spent = margin.calculate_margin(user,
-                    self.session, self.safe_prices,
-                    withdrawals={ticker:amount},
-                    trial_period=self.trial_period)
+            low_margin, high_margin, max_cash_spent = self.calculate_margin_incremental(user,
+                    withdrawals={ticker:amount})
             if not self.check_margin(username, low_margin, high_margin):
                 log.msg("Insufficient margin for withdrawal %d / %d" % (low_margin, high_margin))
                 raise INSUFFICIENT_MARGIN
@@ -1326,20 +1904,64 @@ class Accountant:
         return self.cancel_many_orders(orders)
 
     def cancel_many_orders(self, orders):
-        deferreds = []
+        """Cancel open orders with one engine call per contract and user
+
+        The engine drops every resting order of the user on the contract.
+        The orders it reports are the ones marked cancelled. The orders
+        should all be of this accountant's users, as another accountant's
+        are not ours to mark.
+
+        :param orders: the open orders
+        :returns: DeferredList
+        """
+        batches = defaultdict(list)
         for order in orders:
-            log.msg("Cancelling user %s order %d" % (order.username, order.id))
-            d = self.cancel_order(order.username, order.id)
+            batches[(order.contract.ticker, order.username)].append(order)
+
+        def cancel_all(ticker, username):
+            d = self.engines[ticker].cancel_all(username)
 
             def cancel_failure(failure):
                 log.err(failure)
                 # Try again?
-                log.msg("Trying again-- Cancelling user %s order %d" % (order.username, order.id))
-                d = self.cancel_order(order.username, order.id)
-                d.addErrback(cancel_failure)
-                return d
+                log.msg("Trying again-- Cancelling orders on %s for %s" % (ticker, username))
+                return cancel_all(ticker, username)
 
             d.addErrback(cancel_failure)
+            return d
+
+        def update_orders(cancelled_ids, ticker, batch):
+            # Only what the engine says it cancelled is marked, which may
+            #   include orders the query did not find
+            queried = dict((order.id, order) for order in batch)
+            orders = [queried[id] for id in cancelled_ids if id in queried]
+            missing = [id for id in cancelled_ids if id not in queried]
+            if missing:
+                orders.extend(self.session.query(models.Order).filter(models.Order.id.in_(missing)).all())
+            not_cancelled = sorted(set(queried) - set(cancelled_ids))
+            if not_cancelled:
+                log.msg("Orders on %s not cancelled by the engine, left as they are: %s" % (ticker, not_cancelled))
+
+            try:
+                for order in orders:
+                    order.is_cancelled = True
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                log.err("Unable to commit order cancellations")
+                raise e
+
+            for order in orders:
+                self.update_margin_state(order)
+                self.webserver.order(order.username, order.to_webserver())
+
+            return cancelled_ids
+
+        deferreds = []
+        for (ticker, username), batch in batches.iteritems():
+            log.msg("Cancelling %d orders on %s for %s" % (len(batch), ticker, username))
+            d = cancel_all(ticker, username)
+            d.addCallback(update_orders, ticker, batch)
             deferreds.append(d)
 
         return defer.DeferredList(deferreds)
@@ -1353,6 +1975,14 @@ class Accountant:
 
         return my_users
 
+    def load_positions(self):
+        """Load the positions of this accountant's users, as the ledger has them
+        """
+        my_users = self.get_my_users()
+        for user in my_users:
+            self.positions.load(user.username, from_ledger=True)
+        log.msg("Positions loaded for %d users" % len(my_users))
+
     def repair_user_positions(self):
         my_users = self.get_my_users()
         for user in my_users:
@@ -1368,6 +1998,7 @@ class Accountant:
         user = self.get_user(user)
         log.msg("Repairing position for %s" % user.username)
         self.disable_user(user)
+        self.positions.invalidate(user.username)
         try:
             for position in user.positions:
                 position.pending_postings = 0
@@ -1383,6 +2014,7 @@ class Accountant:
 
     def check_user(self, user):
         user = self.get_user(user)
+        self.positions.invalidate(user.username)
         clean = True
         try:
             for position in user.positions:
@@ -1447,10 +2079,12 @@ class Accountant:
         orders = self.session.query(models.Order).filter_by(contract=contract).filter_by(is_cancelled=False).filter(
             models.Order.quantity_left > 0).filter(
             models.Order.username.in_(my_users))
+        # Each accountant cancels its own users' orders
         d = self.cancel_many_orders(orders)
 
         def after_cancellations(results):
             log.msg("Cancels done for %s" % ticker)
+            self.positions.flush()
             # Wait until all pending postings have gone through
             total_pending = self.session.query(func.sum(models.Position.pending_postings).label('total_pending')).filter_by(contract=contract).filter(
                 models.Position.username.in_(my_users)).one().total_pending
@@ -1475,12 +2109,19 @@ class Accountant:
         return d
 
     def reload_fee_group(self, id):
-        group = self.session.query(models.FeeGroup).filter_by(id=id).one()
+        cache = util.get_identity_cache(self.session)
+        cache.invalidate("fee_group", id)
+        group = util.get_fee_group(self.session, id)
         self.session.expire(group)
+        # Open orders hold on to the fees they were checked with
+        self.margin_states.clear()
 
     def reload_contract(self, ticker):
+        # A contract is cached by ticker and by id
+        util.get_identity_cache(self.session).invalidate("contract")
         contract = self.session.query(models.Contract).filter_by(ticker=ticker).one()
         self.session.expire(contract)
+        self.margin_states.clear()
 
     def change_fee_group(self, username, id):
         try:
@@ -1491,6 +2132,12 @@ class Accountant:
         except Exception as e:
             self.session.rollback()
             raise e
+        finally:
+            util.get_identity_cache(self.session).invalidate("user", username)
+            self.margin_states.pop(username, None)
+
+    def get_cache_stats(self):
+        return util.get_identity_cache(self.session).stats
 
     def clear_position(self, position, price, position_count, uid, zero_out=True):
         # We use position_calculated here to be sure we get the canonical position
@@ -1548,12 +2195,9 @@ class Accountant:
 
             def set_reference_price(result):
                 log.msg("Setting reference price for %s to %d" % (position, price))
-                try:
-                    position.reference_price = price
-                    self.session.commit()
-                except Exception as e:
-                    self.session.rollback()
-                    raise e
+                cached = self.positions.get(position.username, position.contract)
+                cached.reference_price = price
+                self.positions.touch(cached)
 
                 # Zero out positions
                 if zero_out:
@@ -1596,6 +2240,24 @@ class WebserverExport(ComponentExport):
     def cancel_order(self, username, id):
         return self.accountant.cancel_order(username, id)
 
+    @export
+    @session_aware
+    @schema("rpc/accountant.webserver.json#amend_order")
+    def amend_order(self, username, id, price, quantity):
+        return self.accountant.amend_order(username, id, price, quantity)
+
+    @export
+    @session_aware
+    @schema("rpc/accountant.webserver.json#place_orders")
+    def place_orders(self, username, orders):
+        return self.accountant.place_orders(username, orders)
+
+    @export
+    @session_aware
+    @schema("rpc/accountant.webserver.json#cancel_orders")
+    def cancel_orders(self, username, ids):
+        return self.accountant.cancel_orders(username, ids)
+
     @export
     @session_aware
     @schema("rpc/accountant.webserver.json#request_withdrawal")
@@ -1627,6 +2289,12 @@ class EngineExport(ComponentExport):
     def post_transaction(self, username, transaction):
         return self.accountant.post_transaction(username, transaction)
 
+    @export
+    @session_aware
+    @schema("rpc/accountant.engine.json#post_transactions")
+    def post_transactions(self, username, transactions):
+        return self.accountant.post_transactions(transactions)
+
     @export
     @session_aware
     @schema("rpc/accountant.engine.json#cancel_order")
@@ -1748,6 +2416,16 @@ class AdministratorExport(ComponentExport):
     def reload_contract(self, username, ticker):
         return self.accountant.reload_contract(ticker)
 
+    @export
+    @schema("rpc/accountant.administrator.json#get_cache_stats")
+    def get_cache_stats(self, username):
+        return self.accountant.get_cache_stats()
+
+    @export
+    @schema("rpc/accountant.administrator.json#get_stats")
+    def get_stats(self, username):
+        return stats.registry.stats
+
     @export
     @schema("rpc/accountant.administrator.json#get_margin")
     def get_margin(self, username):
@@ -1763,6 +2441,13 @@ class AdministratorExport(ComponentExport):
     def liquidate_position(self, username, ticker):
         return self.accountant.liquidate_position(username, ticker)
 
+def shard_for_user(username, num_procs):
+    """
+    :returns: int -- the number of the accountant which looks after the user
+    """
+    return ord(username[0]) % num_procs
+
+
 class AccountantProxy:
     def __init__(self, mode, uri, base_port, timeout=1):
         self.num_procs = config.getint("accountant", "num_procs")
@@ -1777,7 +2462,19 @@ class AccountantProxy:
             self.proxies.append(proxy)
 
     def get_accountant_for_user(self, username):
-        return ord(username[0]) % self.num_procs
+        return shard_for_user(username, self.num_procs)
+
+    def post_transactions(self, username, transactions):
+        """Send each accountant the transactions for its users in one call
+
+        :param username: None, the transactions may be for any users
+        :param transactions: the transaction objects
+        :type transactions: list
+        """
+        batches = defaultdict(list)
+        for transaction in transactions:
+            batches[self.get_accountant_for_user(transaction["username"])].append(transaction)
+        return [self.proxies[i].post_transactions(None, batch) for i, batch in sorted(batches.iteritems())]
 
     def __getattr__(self, key):
         if key.startswith("__") and key.endswith("__"):
@@ -1799,11 +2496,10 @@ if __name__ == "__main__":
     log.msg("Accountant %d of %d" % (accountant_number+1, num_procs))
 
     session = database.make_session()
-    engines = {}
-    engine_base_port = config.getint("engine", "accountant_base_port")
-    for contract in session.query(models.Contract).filter_by(active=True).all():
-        engines[contract.ticker] = dealer_proxy_async("tcp://127.0.0.1:%d" %
-                                                      (engine_base_port + int(contract.id)))
+    contract_ids = dict((contract.ticker, contract.id) for contract in
+                        session.query(models.Contract).filter_by(active=True))
+    engines = util.connect_engines(config.getint("engine", "accountant_base_port"),
+                                   contract_ids)
     ledger = dealer_proxy_async(config.get("ledger", "accountant_export"), timeout=None)
     webserver = push_proxy_async(config.get("webserver", "accountant_export"))
     cashier = push_proxy_async(config.get("cashier", "accountant_export"))
@@ -1813,6 +2509,9 @@ if __name__ == "__main__":
     alerts_proxy = AlertsProxy(config.get("alerts", "export"))
     debug = config.getboolean("accountant", "debug")
     trial_period = config.getboolean("accountant", "trial_period")
+    position_flush_interval = config.getfloat("accountant", "position_flush_interval")
+    verify_margin = config.getboolean("accountant", "verify_margin")
+    ledger_retries = config.getint("accountant", "ledger_retries")
     mimetic_share = config.getfloat("accountant", "mimetic_share")
     sendmail = Sendmail(config.get("administrator", "email"))
 
@@ -1821,7 +2520,10 @@ if __name__ == "__main__":
                             debug=debug,
                             trial_period=trial_period,
                             mimetic_share=mimetic_share,
-                            sendmail=sendmail)
+                            sendmail=sendmail,
+                            position_flush_interval=position_flush_interval,
+                            verify_margin=verify_margin,
+                            ledger_retries=ledger_retries)
 
     webserver_export = WebserverExport(accountant)
     engine_export = EngineExport(accountant)
@@ -1852,6 +2554,9 @@ if __name__ == "__main__":
                        config.get("accountant", "accountant_export") %
                        (config.getint("accountant", "accountant_export_base_port") + accountant_number))
 
+    reactor.addSystemEventTrigger("before", "shutdown", accountant.positions.flush)
+    reactor.callWhenRunning(accountant.load_positions)
     reactor.callWhenRunning(accountant.repair_user_positions)
+    stats.registry.start_logging(config.getint("accountant", "stats_interval"))
     reactor.run()
 
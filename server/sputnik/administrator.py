@@ -56,6 +56,7 @@ import database
 import models
 from util import ChainedOpenSSLContextFactory
 import util
+import stats
 from sendmail import Sendmail
 from watchdog import watchdog
 from accountant import AccountantProxy
@@ -577,7 +578,7 @@ class Administrator:
         :type username: str
         :returns: models.User
         """
-        user = self.session.query(models.User).filter_by(username=username).one()
+        user = util.get_user(self.session, username)
 
         return user
 
@@ -1090,6 +1091,7 @@ class Administrator:
                         self.session.rollback()
                         raise e
 
+                    util.get_identity_cache(self.session).invalidate("contract")
                     self.accountant.reload_contract(None, ticker)
                     self.webserver.reload_contract(ticker)
 
@@ -1139,32 +1141,10 @@ class Administrator:
                                                                        'total': 0,
                                                                        'positions_raw': []})}
 
-        # # Build the balance sheet from scratch with a single query
-        # if 'timestamp' in self.bs_cache:
-        #     bs_query = self.session.query(models.Posting.username,
-        #                                   models.Posting.contract_id,
-        #                                   func.sum(models.Posting.quantity).label('position'),
-        #                                   func.max(models.Journal.timestamp).label('last_timestamp')).filter(
-        #         models.Journal.id == models.Posting.journal_id).filter(
-        #         models.Journal.timestamp > util.timestamp_to_dt(self.bs_cache['timestamp'])).group_by(
-        #         models.Posting.username,
-        #         models.Posting.contract_id)
-        #
-        #     # Copy the cached balance sheet over, without losing any defaultdict-ness, also update the hashes
-        #     for side in ["Asset", "Liability"]:
-        #         if side in self.bs_cache:
-        #             for contract in self.bs_cache[side]:
-        #                 for username, position_details in self.bs_cache[side][contract]['positions_by_user'].iteritems():
-        #                     user = self.get_user(username)
-        #                     position_details['hash'] = user.user_hash(timestamp)
-        #                     balance_sheet[side][contract]['positions_by_user'][username] = position_details
-        #
-        # else:
-        bs_query = self.session.query(models.Posting.username,
-                                      models.Posting.contract_id,
-                                      func.sum(models.Posting.quantity).label('position')).group_by(
-            models.Posting.username,
-            models.Posting.contract_id)
+        # The ledger keeps every user's balance in each contract
+        bs_query = self.session.query(models.Balance.username,
+                                      models.Balance.contract_id,
+                                      models.Balance.balance.label('position'))
 
         for row in bs_query:
             user = self.get_user(row.username)
@@ -1258,6 +1238,7 @@ class Administrator:
             setattr(contract, key, value)
 
         self.session.commit()
+        util.get_identity_cache(self.session).invalidate("contract")
         self.webserver.reload_contract(ticker)
         self.accountant.reload_contract(None, ticker)
 
@@ -1364,6 +1345,7 @@ class Administrator:
         :type id: int
         """
         log.msg("Changing fee group for %s to %d" % (username, id))
+        util.get_identity_cache(self.session).invalidate("user", username)
         return self.accountant.change_fee_group(username, id)
 
     def modify_fee_group(self, id, name, aggressive_factor, passive_factor, withdraw_factor, deposit_factor):
@@ -1377,7 +1359,7 @@ class Administrator:
         log.msg("Modifying fee group %d" % id)
 
         try:
-            group = self.session.query(models.FeeGroup).filter_by(id=id).one()
+            group = util.get_fee_group(self.session, id)
             group.name = name
             group.aggressive_factor = aggressive_factor
             group.passive_factor = passive_factor
@@ -2654,6 +2636,11 @@ class CronExport(ComponentExport):
     def notify_expired(self):
         return self.administrator.notify_expired()
 
+    @export
+    @schema("rpc/administrator.json#get_stats")
+    def get_stats(self):
+        return stats.registry.stats
+
 
 class TicketServerExport(ComponentExport):
     """The administrator exposes these functions to the TicketServer
@@ -2713,11 +2700,10 @@ if __name__ == "__main__":
     user_limit = config.getint("administrator", "user_limit")
     bs_cache_update = config.getint("administrator", "bs_cache_update")
 
-    engine_base_port = config.getint("engine", "administrator_base_port")
-    engines = {}
-    for contract in session.query(models.Contract).filter_by(active=True):
-        engines[contract.ticker] = dealer_proxy_async("tcp://127.0.0.1:%d" %
-                                                      (engine_base_port + int(contract.id)))
+    contract_ids = dict((contract.ticker, contract.id) for contract in
+                        session.query(models.Contract).filter_by(active=True))
+    engines = util.connect_engines(config.getint("engine", "administrator_base_port"),
+                                   contract_ids)
 
     bitgo_config = {'use_production': not config.getboolean("cashier", "testnet"),
                     'client_id': config.get("bitgo", "client_id"),
@@ -2803,6 +2789,6 @@ if __name__ == "__main__":
         reactor.listenTCP(config.getint("ticketserver", "ticketserver_port"), Site(base_resource),
                                         interface="127.0.0.1")
 
-
+    stats.registry.start_logging(config.getint("administrator", "stats_interval"))
     reactor.run()
 
@@ -18,9 +18,11 @@ parser.add_option("-c", "--config", dest="filename",
 if options.filename:
     config.reconfigure(options.filename)
 
+import os
 import sys
 import json
 import heapq
+import bisect
 import math
 
 import database
@@ -28,14 +30,21 @@ import models
 import accountant
 
 import util
+import stats
 
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.python import log
-from zmq_util import export, router_share_async, push_proxy_async, ComponentExport, connect_publisher
+from zmq_util import export, router_share_async, router_share_routed_async, push_proxy_async, \
+    ComponentExport, connect_publisher
 from rpc_schema import schema
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from itertools import izip_longest
 from datetime import datetime
 from watchdog import watchdog
+from exception import EngineException
+
+OVERLOADED = EngineException("exceptions/engine/overloaded")
 
 
 class OrderSide:
@@ -49,7 +58,18 @@ class OrderSide:
         return "SELL"
 
 
-class Order:
+class Order(object):
+    """
+    An order on, or on its way to, the book.
+
+    Slotted, with integer side and price, to keep a deep book small. The
+    price-time priority key is worked out when the timestamp is set rather
+    than on every comparison. Price and side are fixed once the order is
+    made, an amend builds a new Order.
+    """
+    __slots__ = ["id", "contract", "quantity", "quantity_left", "username",
+                 "price", "side", "_timestamp", "priority"]
+
     def __init__(self, id=None, contract=None, quantity=None,
                  quantity_left=None, price=None, side=None, username=None,
                  timestamp=None):
@@ -57,13 +77,24 @@ class Order:
         self.contract = contract
         self.quantity = quantity
         self.quantity_left = quantity
-        self.price = price
-        self.side = side
         self.username = username
-        if timestamp is not None:
-            self.timestamp = timestamp
+        self.price = None if price is None else int(price)
+        self.side = None if side is None else int(side)
+        if timestamp is None:
+            timestamp = util.dt_to_timestamp(datetime.utcnow())
+        self.timestamp = timestamp
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+        if self.price is None or self.side is None:
+            self.priority = None
         else:
-            self.timestamp = util.dt_to_timestamp(datetime.utcnow())
+            self.priority = (self.side * self.price, timestamp)
 
     def to_administrator(self):
         return {'id': self.id,
@@ -84,7 +115,9 @@ class Order:
             "Bid" if self.side < 0 else "Ask", self.price, self.quantity_left, self.quantity, self.id)
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        return {'id': self.id, 'contract': self.contract, 'quantity': self.quantity,
+                'quantity_left': self.quantity_left, 'price': self.price, 'side': self.side,
+                'username': self.username, 'timestamp': self.timestamp}.__repr__()
 
     def __eq__(self, other):
         return self.side == other.side and self.price == other.price \
@@ -95,11 +128,162 @@ class Order:
         Returns whether an order is higher than another in the order book.
         """
 
-        if self.side is not other.side:
+        if self.side != other.side:
             raise Exception("Orders are not comparable.")
 
         # Price-Time Priority
-        return (self.side * self.price, self.timestamp) < (other.side * other.price, other.timestamp)
+        return self.priority < other.priority
+
+
+class OrderNode(object):
+    """
+    Link in the FIFO queue of a PriceLevel.
+    """
+    __slots__ = ["order", "level", "prev", "next"]
+
+    def __init__(self, order, level):
+        self.order = order
+        self.level = level
+        self.prev = None
+        self.next = None
+
+
+class PriceLevel(object):
+    """
+    All the resting orders at one price, as a doubly linked list in time
+    priority. Unlinking a node is O(1).
+    """
+    __slots__ = ["price", "head", "tail", "count"]
+
+    def __init__(self, price):
+        self.price = price
+        self.head = None
+        self.tail = None
+        self.count = 0
+
+    def append(self, node):
+        # Orders nearly always arrive in timestamp order so this walk is
+        #   almost always zero steps, but an order stamped earlier than the
+        #   tail (possible with several accountants) still gets time priority.
+        after = self.tail
+        while after is not None and after.order.priority > node.order.priority:
+            after = after.prev
+
+        node.prev = after
+        if after is None:
+            node.next = self.head
+            self.head = node
+        else:
+            node.next = after.next
+            after.next = node
+
+        if node.next is None:
+            self.tail = node
+        else:
+            node.next.prev = node
+
+        self.count += 1
+
+    def unlink(self, node):
+        if node.prev is None:
+            self.head = node.next
+        else:
+            node.prev.next = node.next
+
+        if node.next is None:
+            self.tail = node.prev
+        else:
+            node.next.prev = node.prev
+
+        node.prev = node.next = None
+        self.count -= 1
+
+    def __iter__(self):
+        node = self.head
+        while node is not None:
+            yield node.order
+            node = node.next
+
+
+class OrderBookSide(object):
+    """
+    One side of the order book, organized by price level.
+
+    Each price has its own FIFO queue and every resting order is indexed by
+    id, so a cancel is O(1). The level prices are kept in a heap keyed on
+    side * price (best first) with lazy removal of emptied levels, so adding a
+    level is O(log levels) and looking up the best order is O(1) amortized.
+    """
+
+    def __init__(self, side):
+        self.side = side
+        self.levels = {}
+        self.nodes = {}
+        self.prices = []
+        self.heaped = set()
+
+    def best_level(self):
+        # Drop keys whose level has emptied since they were pushed.
+        while self.prices:
+            key = self.prices[0]
+            level = self.levels.get(key * self.side)
+            if level is not None:
+                return level
+            heapq.heappop(self.prices)
+            self.heaped.discard(key)
+        return None
+
+    def best(self):
+        level = self.best_level()
+        if level is None:
+            return None
+        return level.head.order
+
+    def push(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            self.levels[order.price] = level
+            key = order.priority[0]
+            if key not in self.heaped:
+                heapq.heappush(self.prices, key)
+                self.heaped.add(key)
+
+        node = OrderNode(order, level)
+        level.append(node)
+        self.nodes[order.id] = node
+
+    def pop(self):
+        level = self.best_level()
+        if level is None:
+            raise IndexError("pop from empty order book side")
+        order = level.head.order
+        self.remove(order)
+        return order
+
+    def remove(self, order):
+        node = self.nodes.pop(order.id)
+        level = node.level
+        level.unlink(node)
+        if level.count == 0:
+            del self.levels[level.price]
+
+    def __contains__(self, order):
+        return order.id in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __nonzero__(self):
+        return len(self.nodes) > 0
+
+    def __iter__(self):
+        """
+        Iterates over the resting orders in price-time priority.
+        """
+        for price in sorted(self.levels, key=lambda price: price * self.side):
+            for order in self.levels[price]:
+                yield order
 
 
 class EngineListener:
@@ -124,14 +308,34 @@ class EngineListener:
     def on_cancel_success(self, order):
         pass
 
+    def on_cancel_all(self, orders):
+        for order in orders:
+            self.on_cancel_success(order)
+
     def on_cancel_fail(self, order_id, reason):
         pass
 
+    def on_amend_success(self, order, old_quantity_left):
+        pass
+
+    def on_amend_fail(self, order_id, reason):
+        pass
+
 
 class Engine:
-    def __init__(self):
-        self.orderbook = {OrderSide.BUY: [], OrderSide.SELL: []}
+    def __init__(self, stats_registry=None):
+        """
+        :param stats_registry: where the timed methods record, so engines sharing a process keep their own
+        :type stats_registry: stats.Registry
+        """
+        self.orderbook = {OrderSide.BUY: OrderBookSide(OrderSide.BUY),
+                          OrderSide.SELL: OrderBookSide(OrderSide.SELL)}
+        self.stats_registry = stats_registry if stats_registry is not None else stats.Registry()
         self.ordermap = {}
+        # Resting orders by username, then id
+        self.user_orders = defaultdict(dict)
+        # One copy of each resting user's username, however many orders they have
+        self.usernames = {}
         self.listeners = []
 
     @util.timed
@@ -140,13 +344,13 @@ class Engine:
         # Loop until the order or the opposite side is exhausted.
         while order.quantity_left > 0:
 
+            # Find the best counter-offer.
+            passive_order = self.orderbook[-order.side].best()
+
             # If the other side has run out of orders, break.
-            if not self.orderbook[-order.side]:
+            if passive_order is None:
                 break
 
-            # Find the best counter-offer.
-            passive_order = self.orderbook[-order.side][0]
-
             # We may assume this order is the best offer on its side. If not,
             #   the following will automatically fail since it failed for
             #   better offers already.
@@ -160,17 +364,17 @@ class Engine:
 
             # If the passive order is used up, remove it.
             if passive_order.quantity_left <= 0:
-                heapq.heappop(self.orderbook[passive_order.side])
-                del self.ordermap[passive_order.id]
+                self.orderbook[passive_order.side].pop()
+                self.unmap_order(passive_order)
 
             # Notify listeners.
             self.notify_trade_success(order, passive_order, price, quantity)
 
-        # If order is not completely filled, push remainder onto heap and make
-        #   an entry in the map.
+        # If order is not completely filled, push remainder onto the book and
+        #   make an entry in the map.
         if order.quantity_left > 0:
-            heapq.heappush(self.orderbook[order.side], order)
-            self.ordermap[order.id] = order
+            self.orderbook[order.side].push(order)
+            self.map_order(order)
 
             # Notify listeners
             self.notify_queue_success(order)
@@ -203,15 +407,102 @@ class Engine:
         order = self.ordermap[id]
 
         # Remove the order from the book.
-        del self.ordermap[id]
+        self.unmap_order(order)
         self.orderbook[order.side].remove(order)
-        heapq.heapify(self.orderbook[order.side]) #yuck
 
         # Notify user of cancellation.
         self.notify_cancel_success(order)
 
         return True
 
+    @util.timed
+    def amend_order(self, id, price, quantity):
+        """
+        Change the price and total quantity of a resting order. A smaller
+        order at the same price keeps its place in the queue. Anything else
+        is cancelled and placed again, possibly trading, within this call.
+        """
+        if id not in self.ordermap:
+            log.msg("The order id=%s cannot be amended, it's already outside the book." % id)
+            self.notify_amend_fail(id, "the order is no longer on the book")
+            return False
+
+        order = self.ordermap[id]
+        filled = order.quantity - order.quantity_left
+        if quantity <= filled:
+            log.msg("The order id=%s cannot be amended to %s, %s has already filled." % (id, quantity, filled))
+            self.notify_amend_fail(id, "the order has already filled past the new quantity")
+            return False
+
+        if price == order.price and quantity <= order.quantity:
+            old_quantity_left = order.quantity_left
+            order.quantity = quantity
+            order.quantity_left = quantity - filled
+            self.notify_amend_success(order, old_quantity_left)
+            return True
+
+        self.unmap_order(order)
+        self.orderbook[order.side].remove(order)
+        self.notify_cancel_success(order)
+
+        replacement = Order(id=order.id, contract=order.contract, quantity=quantity,
+                            price=price, side=order.side, username=order.username)
+        replacement.quantity_left = quantity - filled
+        return self.place_order(replacement)
+
+    @util.timed
+    def cancel_all(self, username=None):
+        """
+        Cancel every resting order of username, or every resting order if
+        username is None. Listeners hear about all of them in one
+        on_cancel_all. Returns the ids of the cancelled orders.
+        """
+        if username is None:
+            orders = self.ordermap.values()
+        else:
+            orders = self.user_orders.get(username, {}).values()
+
+        orders.sort(key=lambda order: order.id)
+        for order in orders:
+            self.unmap_order(order)
+            self.orderbook[order.side].remove(order)
+
+        if orders:
+            self.notify_cancel_all(orders)
+
+        return [order.id for order in orders]
+
+    def map_order(self, order):
+        order.username = self.usernames.setdefault(order.username, order.username)
+        self.ordermap[order.id] = order
+        self.user_orders[order.username][order.id] = order
+
+    def unmap_order(self, order):
+        del self.ordermap[order.id]
+        user_orders = self.user_orders[order.username]
+        del user_orders[order.id]
+        if not user_orders:
+            del self.user_orders[order.username]
+            del self.usernames[order.username]
+
+    def restore_order(self, order):
+        """
+        Put a resting order back on the book without matching it or
+        notifying listeners. Used when recovering the book after a restart.
+        """
+        self.orderbook[order.side].push(order)
+        self.map_order(order)
+
+    def remove_order(self, id):
+        """
+        Take an order off the book without notifying listeners. Used when
+        reconciling a recovered book with the database.
+        """
+        order = self.ordermap[id]
+        self.unmap_order(order)
+        self.orderbook[order.side].remove(order)
+        return order
+
     def add_listener(self, listener):
         self.listeners.append(listener)
 
@@ -275,6 +566,14 @@ class Engine:
                 log.err("Exception in on_cancel_success of %s: %s." % (listener, e))
                 log.err()
 
+    def notify_cancel_all(self, orders):
+        for listener in self.listeners:
+            try:
+                listener.on_cancel_all(orders)
+            except Exception, e:
+                log.err("Exception in on_cancel_all of %s: %s." % (listener, e))
+                log.err()
+
     def notify_cancel_fail(self, order, reason):
         for listener in self.listeners:
             try:
@@ -283,6 +582,22 @@ class Engine:
                 log.err("Exception in on_cancel_fail of %s: %s." % (listener, e))
                 log.err()
 
+    def notify_amend_success(self, order, old_quantity_left):
+        for listener in self.listeners:
+            try:
+                listener.on_amend_success(order, old_quantity_left)
+            except Exception, e:
+                log.err("Exception in on_amend_success of %s: %s." % (listener, e))
+                log.err()
+
+    def notify_amend_fail(self, order_id, reason):
+        for listener in self.listeners:
+            try:
+                listener.on_amend_fail(order_id, reason)
+            except Exception, e:
+                log.err("Exception in on_amend_fail of %s: %s." % (listener, e))
+                log.err()
+
 
 class LoggingListener:
     def __init__(self, engine, contract):
@@ -292,10 +607,6 @@ class LoggingListener:
     def on_init(self):
         self.ticker = self.contract.ticker
         log.msg("Engine for contract %s (%d) started." % (self.ticker, self.contract.id))
-        log.msg(
-            "Listening for connections on port %d." % (config.getint("engine", "accountant_base_port") + self.contract.id))
-        log.msg(
-            "Listening for connections on port %d." % (config.getint("engine", "administrator_base_port") + self.contract.id))
 
 
     def on_shutdown(self):
@@ -320,130 +631,493 @@ class LoggingListener:
         log.msg("%s cancelled." % order)
         self.print_order_book()
 
+    def on_cancel_all(self, orders):
+        log.msg("%d orders cancelled: %s." % (len(orders), [order.id for order in orders]))
+        self.print_order_book()
+
     def on_cancel_fail(self, order, reason):
         log.msg("Cannot cancel %s because %s." % (order, reason))
 
+    def on_amend_success(self, order, old_quantity_left):
+        log.msg("%s amended, was %s left." % (order, old_quantity_left))
+        self.print_order_book()
+
+    def on_amend_fail(self, order, reason):
+        log.msg("Cannot amend %s because %s." % (order, reason))
+
     def print_order_book(self):
         log.msg("Orderbook for %s:" % self.contract.ticker)
         log.msg("Bids                   Asks")
         log.msg("Vol.  Price     Price  Vol.")
-        length = max(len(self.engine.orderbook[OrderSide.BUY]), len(self.engine.orderbook[OrderSide.SELL]))
-        for i in range(length):
-            try:
-                ask = self.engine.orderbook[OrderSide.SELL][i]
+        for bid, ask in izip_longest(self.engine.orderbook[OrderSide.BUY], self.engine.orderbook[OrderSide.SELL]):
+            if ask is not None:
                 ask_str = "{:<5} {:<5}".format(ask.price, ask.quantity_left)
-            except:
+            else:
                 ask_str = "           "
-            try:
-                bid = self.engine.orderbook[OrderSide.BUY][i]
+            if bid is not None:
                 bid_str = "{:>5} {:>5}".format(bid.quantity_left, bid.price)
-            except:
+            else:
                 bid_str = "           "
             log.msg("{}     {}".format(bid_str, ask_str))
 
 
 class AccountantNotifier(EngineListener):
+    """
+    Tells the accountants about fills. Every fill from one reactor turn, be
+    it one order sweeping the book or a batch of orders, goes out in a
+    single post_transactions, which the accountant proxy splits by
+    accountant.
+    """
+
     def __init__(self, engine, accountant, contract):
         self.engine = engine
         self.accountant = accountant
         self.contract = contract
         self.ticker = self.contract.ticker
+        self.transactions = []
+        self.pending_flush = None
 
     def on_init(self):
         pass
 
+    def on_shutdown(self):
+        self.flush()
+
     def on_trade_success(self, order, passive_order, price, quantity):
         uid = util.get_uid()
-        self.accountant.post_transaction(order.username,
-                                         {
-                                             'username': order.username,
-                                             'aggressive': True,
-                                             'contract': self.ticker,
-                                             'order': order.id,
-                                             'other_order': passive_order.id,
-                                             'side': OrderSide.name(order.side),
-                                             'quantity': quantity,
-                                             'price': price,
-                                             'timestamp': order.timestamp,
-                                             'uid': uid
-                                         }
-        )
-
-        self.accountant.post_transaction(passive_order.username,
-                                         {
-                                             'username': passive_order.username,
-                                             'aggressive': False,
-                                             'contract': self.ticker,
-                                             'order': passive_order.id,
-                                             'other_order': order.id,
-                                             'side': OrderSide.name(passive_order.side),
-                                             'quantity': quantity,
-                                             'price': price,
-                                             'timestamp': order.timestamp,
-                                             'uid': uid
-                                         }
-        )
+        self.transactions.append({
+                                     'username': order.username,
+                                     'aggressive': True,
+                                     'contract': self.ticker,
+                                     'order': order.id,
+                                     'other_order': passive_order.id,
+                                     'side': OrderSide.name(order.side),
+                                     'quantity': quantity,
+                                     'price': price,
+                                     'timestamp': order.timestamp,
+                                     'uid': uid
+                                 })
+
+        self.transactions.append({
+                                     'username': passive_order.username,
+                                     'aggressive': False,
+                                     'contract': self.ticker,
+                                     'order': passive_order.id,
+                                     'other_order': order.id,
+                                     'side': OrderSide.name(passive_order.side),
+                                     'quantity': quantity,
+                                     'price': price,
+                                     'timestamp': order.timestamp,
+                                     'uid': uid
+                                 })
+
+        if self.pending_flush is None:
+            self.pending_flush = reactor.callLater(0, self.flush)
+
+    def on_queue_fail(self, order, reason):
+        # The accountant has already accepted the order, have it cancelled
+        self.accountant.cancel_order(order.username, order.id)
+
+    def flush(self):
+        if self.pending_flush is not None and self.pending_flush.active():
+            self.pending_flush.cancel()
+        self.pending_flush = None
+
+        if not self.transactions:
+            return
+
+        transactions, self.transactions = self.transactions, []
+        self.accountant.post_transactions(None, transactions)
+
+
+class JournalListener(EngineListener):
+    """
+    Keeps the book recoverable across engine restarts.
+
+    Every queue, trade, cancel and amend is appended to a journal file as one
+    compact JSON line tagged with a sequence number. Every snapshot_interval seconds
+    the whole book is written to a snapshot file, which records the last
+    sequence number it contains, and the journal is started afresh. recover()
+    loads the snapshot, replays the journal entries that came after it and
+    puts the resulting orders back on the engine's book.
+    """
+
+    def __init__(self, engine, contract, journal_dir, snapshot_interval=60, reg_snapshot=True):
+        self.engine = engine
+        self.contract = contract
+        self.snapshot_path = os.path.join(journal_dir, "engine-%d.snapshot" % contract.id)
+        self.journal_path = os.path.join(journal_dir, "engine-%d.journal" % contract.id)
+        self.sequence = 0
+        self.journal = None
+
+        if reg_snapshot:
+            def regular_snapshot():
+                self.snapshot()
+                reactor.callLater(snapshot_interval, regular_snapshot)
+
+            reactor.callLater(snapshot_interval, regular_snapshot)
+
+    @staticmethod
+    def order_to_journal(order):
+        return [order.id, order.username, order.contract, order.price, order.side,
+                order.quantity, order.quantity_left, order.timestamp]
+
+    @staticmethod
+    def order_from_journal(entry):
+        id, username, contract, price, side, quantity, quantity_left, timestamp = entry
+        order = Order(id=id, contract=contract, quantity=quantity, price=price,
+                      side=side, username=username, timestamp=timestamp)
+        order.quantity_left = quantity_left
+        return order
+
+    def recover(self):
+        """
+        Rebuild the engine's book from the snapshot and the journal.
+
+        :returns: int -- the number of orders put back on the book
+        """
+        orders = OrderedDict()
+
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            self.sequence = snapshot["sequence"]
+            for entry in snapshot["orders"]:
+                order = self.order_from_journal(entry)
+                orders[order.id] = order
+        except IOError:
+            log.msg("No snapshot found at %s." % self.snapshot_path)
+
+        replayed = 0
+        try:
+            with open(self.journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A crash can leave the last line half written
+                        log.err("Skipping corrupt journal line: %r" % line)
+                        continue
+
+                    sequence, action = entry[0], entry[1]
+                    # Entries already folded into the snapshot
+                    if sequence <= self.sequence:
+                        continue
+                    self.sequence = sequence
+                    replayed += 1
+
+                    if action == "q":
+                        order = self.order_from_journal(entry[2:])
+                        orders[order.id] = order
+                    elif action == "t":
+                        id, quantity = entry[2:]
+                        order = orders.get(id)
+                        if order is not None:
+                            order.quantity_left -= quantity
+                            if order.quantity_left <= 0:
+                                del orders[id]
+                    elif action == "c":
+                        orders.pop(entry[2], None)
+                    elif action == "a":
+                        id, quantity, quantity_left = entry[2:]
+                        order = orders.get(id)
+                        if order is not None:
+                            order.quantity = quantity
+                            order.quantity_left = quantity_left
+        except IOError:
+            log.msg("No journal found at %s." % self.journal_path)
+
+        for order in orders.itervalues():
+            self.engine.restore_order(order)
+
+        log.msg("Recovered %d orders for %s, replayed %d journal entries." %
+                (len(orders), self.contract.ticker, replayed))
+
+        # Fold the replayed entries into a fresh snapshot
+        self.snapshot()
+        return len(orders)
+
+    def append(self, *entry):
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+
+        self.sequence += 1
+        self.journal.write(json.dumps((self.sequence,) + entry, separators=(',', ':')) + "\n")
+        self.journal.flush()
+
+    def snapshot(self):
+        orders = [self.order_to_journal(order)
+                  for side in [OrderSide.BUY, OrderSide.SELL]
+                  for order in self.engine.orderbook[side]]
+
+        # Write to a temporary file and rename so there is always one
+        #   complete snapshot on disk.
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w") as snapshot_file:
+            json.dump({"sequence": self.sequence, "orders": orders}, snapshot_file,
+                      separators=(',', ':'))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(temporary_path, self.snapshot_path)
+
+        # Everything so far is in the snapshot. If we die before this
+        #   truncation, recover() skips the entries by sequence number.
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, "w")
+
+    def on_shutdown(self):
+        self.snapshot()
+        self.journal.close()
+        self.journal = None
+
+    def on_queue_success(self, order):
+        self.append("q", *self.order_to_journal(order))
+
+    def on_trade_success(self, order, passive_order, price, quantity):
+        self.append("t", passive_order.id, quantity)
+
+    def on_cancel_success(self, order):
+        self.append("c", order.id)
+
+    def on_amend_success(self, order, old_quantity_left):
+        self.append("a", order.id, order.quantity, order.quantity_left)
+
+
+def reconcile_book(engine, session, contract, accountant):
+    """
+    Make a recovered book agree with the orders the database says are open.
+
+    Orders which are open in the database but not on the book never reached
+    the engine, or were lost with the journal, so the accountant is asked to
+    cancel them. Orders on the book which the database has already cancelled
+    or filled are dropped.
+    """
+    try:
+        open_orders = session.query(models.Order).filter_by(
+            is_cancelled=False).filter_by(
+            contract_id=contract.id).filter(
+            models.Order.quantity_left > 0).all()
+    except Exception as e:
+        session.rollback()
+        raise e
+
+    open_ids = set()
+    for order in open_orders:
+        open_ids.add(order.id)
+        if order.id not in engine.ordermap:
+            log.msg("Cancelling order %d, it is not on the recovered book" % order.id)
+            accountant.cancel_order(order.username, order.id)
+
+    for id in engine.ordermap.keys():
+        if id not in open_ids:
+            log.msg("Dropping order %d from the recovered book, it is no longer open" % id)
+            engine.remove_order(id)
 
 
 class WebserverNotifier(EngineListener):
-    def __init__(self, engine, webserver, contract, reg_publish=True):
+    def __init__(self, engine, webserver, contract, reg_publish=True, deltas=False, conflation_window=None):
         self.engine = engine
         self.webserver = webserver
         self.contract = contract
+        self.deltas = deltas
         self.aggregated_book = {"bids": defaultdict(int), "asks": defaultdict(int)}
         self.side_map = { OrderSide.BUY: "bids",
                           OrderSide.SELL: "asks"}
 
-        # Publish every 10 min no matter what
+        # Price levels kept best first, stored as sort keys (bids negated)
+        # so bisect works for both sides. wire_books caches the wire form
+        # of the book by depth, dropping an entry only when a level within
+        # its depth changes.
+        self.level_keys = {"bids": [], "asks": []}
+        self.wire_books = {}
+
+        # Bumped on every publication, so a consumer applying deltas can
+        # spot a missed update and resync from a snapshot
+        self.sequence = 0
+
+        # Levels changed since the last publication. With a conflation
+        # window, every change within it goes out in one publication; a
+        # window of 0 coalesces everything from one place or cancel. None
+        # publishes every change as it happens.
+        self.conflation_window = conflation_window
+        self.dirty = {"bids": set(), "asks": set()}
+        self.pending_publish = None
+        self.changes = 0
+        self.conflated = 0
+
+        # Publish every 10 min no matter what. In delta mode the webserver
+        # asks for a snapshot when it sees a gap instead.
         if reg_publish:
             def regular_publish():
-                self.publish_book()
+                if not deltas:
+                    self.publish_book()
+                self.log_conflation()
                 reactor.callLater(600, regular_publish)
 
             reactor.callLater(600, regular_publish)
 
     def on_init(self):
+        # The book may have been recovered without going through the listeners
+        for side, orders in self.engine.orderbook.iteritems():
+            aggregated = self.aggregated_book[self.side_map[side]]
+            aggregated.clear()
+            for order in orders:
+                aggregated[order.price] += order.quantity_left
+            self.level_keys[self.side_map[side]] = sorted(self.level_key(self.side_map[side], price)
+                                                          for price in aggregated)
+        self.wire_books.clear()
+
+        self.cancel_pending()
+        self.sequence += 1
         self.publish_book()
 
-    def on_trade_success(self, order, passive_order, price, quantity):
-        side = self.side_map[passive_order.side]
-
-        self.aggregated_book[side][passive_order.price] -= quantity
-        if self.aggregated_book[side][passive_order.price] == 0:
-            del self.aggregated_book[side][passive_order.price]
+    def on_shutdown(self):
+        self.cancel_pending()
 
-        self.publish_book()
+    def on_trade_success(self, order, passive_order, price, quantity):
+        self.update_level(passive_order.side, passive_order.price, -quantity)
+        self.book_changed()
 
     def on_queue_success(self, order):
-        side = self.side_map[order.side]
-
-        self.aggregated_book[side][order.price] += order.quantity_left
-        self.publish_book()
+        self.update_level(order.side, order.price, order.quantity_left)
+        self.book_changed()
 
     def on_cancel_success(self, order):
-        side = self.side_map[order.side]
+        self.update_level(order.side, order.price, -order.quantity_left)
+        self.book_changed()
+
+    def on_cancel_all(self, orders):
+        for order in orders:
+            self.update_level(order.side, order.price, -order.quantity_left)
+        self.book_changed(len(orders))
+
+    def on_amend_success(self, order, old_quantity_left):
+        self.update_level(order.side, order.price, order.quantity_left - old_quantity_left)
+        self.book_changed()
+
+    def update_level(self, side, price, quantity):
+        side = self.side_map[side]
+        aggregated = self.aggregated_book[side]
+        keys = self.level_keys[side]
+        key = self.level_key(side, price)
+        index = bisect.bisect_left(keys, key)
+        if price not in aggregated:
+            keys.insert(index, key)
+        aggregated[price] += quantity
+        if aggregated[price] == 0:
+            del aggregated[price]
+            del keys[index]
+
+        for depth in self.wire_books.keys():
+            if depth is None or index < depth:
+                del self.wire_books[depth]
+
+        self.dirty[side].add(price)
+
+    def book_changed(self, changes=1):
+        self.changes += changes
+        if self.conflation_window is None:
+            self.flush()
+        elif self.pending_publish is None:
+            self.pending_publish = reactor.callLater(self.conflation_window, self.flush)
+            self.conflated += changes - 1
+        else:
+            self.conflated += changes
 
-        self.aggregated_book[side][order.price] -= order.quantity_left
-        if self.aggregated_book[side][order.price] == 0:
-            del self.aggregated_book[side][order.price]
+    def flush(self):
+        self.cancel_pending()
+        if not self.dirty["bids"] and not self.dirty["asks"]:
+            return
 
-        self.publish_book()
+        self.sequence += 1
+        if self.deltas:
+            self.publish_delta()
+        else:
+            self.publish_book()
+
+    def cancel_pending(self):
+        if self.pending_publish is not None and self.pending_publish.active():
+            self.pending_publish.cancel()
+        self.pending_publish = None
 
     @property
-    def wire_book(self):
-        wire_book = {"contract": self.contract.ticker,
-                     "bids": [{"quantity": row[1],
-                               "price": row[0]} for row in self.aggregated_book["bids"].iteritems()],
-                     "asks": [{"quantity": row[1],
-                               "price": row[0]} for row in self.aggregated_book["asks"].iteritems()]}
+    def conflation_hit_rate(self):
+        """Fraction of book changes that rode along with an earlier publication."""
+        if not self.changes:
+            return 0.0
+        return float(self.conflated) / self.changes
+
+    def log_conflation(self):
+        log.msg("Book conflation for %s: %d changes, %d conflated (%.1f%%)." %
+                (self.contract.ticker, self.changes, self.conflated, 100 * self.conflation_hit_rate))
+
+    @staticmethod
+    def level_key(side, price):
+        if side == "bids":
+            return -price
+        return price
+
+    def levels(self, side, depth=None):
+        aggregated = self.aggregated_book[side]
+        sign = -1 if side == "bids" else 1
+        return [{"quantity": aggregated[sign * key],
+                 "price": sign * key} for key in self.level_keys[side][:depth]]
+
+    def wire_book(self, depth=None):
+        """The book best level first, cut to depth levels a side if given.
+
+        The result is shared with later callers, so do not modify it.
+        """
+        wire_book = self.wire_books.get(depth)
+        if wire_book is None:
+            wire_book = {"contract": self.contract.ticker,
+                         "bids": self.levels("bids", depth),
+                         "asks": self.levels("asks", depth)}
+            self.wire_books[depth] = wire_book
         return wire_book
 
+    @property
+    def snapshot(self):
+        snapshot = dict(self.wire_book())
+        snapshot["sequence"] = self.sequence
+        return snapshot
+
     def publish_book(self):
-        self.webserver.book(self.contract.ticker, self.wire_book)
+        self.dirty = {"bids": set(), "asks": set()}
+        if self.deltas:
+            self.webserver.book(self.contract.ticker, self.snapshot)
+        else:
+            self.webserver.book(self.contract.ticker, self.wire_book())
+
+    def publish_delta(self):
+        # A quantity of zero means the level is gone
+        delta = {"contract": self.contract.ticker,
+                 "sequence": self.sequence}
+        for side, prices in self.dirty.iteritems():
+            delta[side] = [{"price": price,
+                            "quantity": self.aggregated_book[side].get(price, 0)} for price in prices]
+        self.dirty = {"bids": set(), "asks": set()}
+        self.webserver.book_delta(self.contract.ticker, delta)
 
 
 class SafePriceNotifier(EngineListener):
-    def __init__(self, session, engine, accountant, webserver, forwarder, contract):
+    """
+    Keeps a volume weighted EMA of the trade price as the safe price.
+
+    With a checkpoint_dir, the EMA state is written there every
+    checkpoint_interval seconds and on shutdown. At startup only the
+    trades since the checkpoint are replayed from the database, so startup
+    does not grow with the trade history. A trade which reaches the
+    database just after the checkpoint it was counted in is counted again;
+    against the EMA's decay that is negligible.
+    """
+
+    # Exact to the microsecond, so the last trade counted is not replayed
+    timestamp_format = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, session, engine, accountant, webserver, forwarder, contract,
+                 checkpoint_dir=None, checkpoint_interval=60, reg_publish=True, reg_checkpoint=True):
         self.session = session
         self.engine = engine
         self.contract = contract
@@ -456,20 +1130,39 @@ class SafePriceNotifier(EngineListener):
         self.ema_timestamp = None
         self.decay = 0.999
         self.safe_price = None
+
+        self.checkpoint_path = None
+        if checkpoint_dir is not None:
+            self.checkpoint_path = os.path.join(checkpoint_dir, "engine-%d.safe_price" % contract.id)
+
         # Publish every 10 min no matter what
-        def regular_publish():
-            self.publish_safe_price()
+        if reg_publish:
+            def regular_publish():
+                self.publish_safe_price()
+                reactor.callLater(600, regular_publish)
+
             reactor.callLater(600, regular_publish)
 
-        reactor.callLater(600, regular_publish)
+        if self.checkpoint_path is not None and reg_checkpoint:
+            def regular_checkpoint():
+                self.checkpoint()
+                reactor.callLater(checkpoint_interval, regular_checkpoint)
+
+            reactor.callLater(checkpoint_interval, regular_checkpoint)
 
     def on_init(self):
+        self.restore()
         try:
-            trades = self.session.query(models.Trade).filter_by(contract=contract).order_by(
-                models.Trade.timestamp)
-    
-            for trade in trades:
+            trades = self.session.query(models.Trade).filter_by(contract=self.contract)
+            if self.ema_timestamp is not None:
+                trades = trades.filter(models.Trade.timestamp > self.ema_timestamp)
+
+            replayed = 0
+            for trade in trades.order_by(models.Trade.timestamp):
                 self.update_safe_price(trade.price, trade.quantity, publish=False, timestamp=trade.timestamp)
+                replayed += 1
+            log.msg("Replayed %d trades into the safe price for %s." % (replayed, self.contract.ticker))
+
             if self.safe_price is None:
                 self.safe_price = 42
                 log.msg(
@@ -480,6 +1173,46 @@ class SafePriceNotifier(EngineListener):
 
         self.publish_safe_price()
 
+    def on_shutdown(self):
+        self.checkpoint()
+
+    def checkpoint(self):
+        if self.checkpoint_path is None or self.ema_timestamp is None:
+            return
+
+        # Write to a temporary file and rename, as the book snapshot does
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump({"ema_price_volume": self.ema_price_volume,
+                       "ema_volume": self.ema_volume,
+                       "ema_timestamp": self.ema_timestamp.strftime(self.timestamp_format)}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temporary_path, self.checkpoint_path)
+
+    def restore(self):
+        """
+        Load the EMA state from the checkpoint, if there is one.
+
+        :returns: bool -- whether a checkpoint was loaded
+        """
+        if self.checkpoint_path is None:
+            return False
+
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (IOError, ValueError):
+            log.msg("No safe price checkpoint found at %s." % self.checkpoint_path)
+            return False
+
+        self.ema_price_volume = checkpoint["ema_price_volume"]
+        self.ema_volume = checkpoint["ema_volume"]
+        self.ema_timestamp = datetime.strptime(checkpoint["ema_timestamp"], self.timestamp_format)
+        if self.ema_volume:
+            self.safe_price = int(self.ema_price_volume / self.ema_volume)
+        return True
+
     def on_trade_success(self, order, passive_order, price, quantity):
         self.update_safe_price(price, quantity)
 
@@ -506,22 +1239,173 @@ class SafePriceNotifier(EngineListener):
         self.webserver.safe_prices(self.contract.ticker, self.safe_price)
         self.forwarder.publish(json.dumps({self.contract.ticker: self.safe_price}), tag=b'')
 
+class AdmissionQueue(object):
+    """
+    Admits the accountants' requests to the engine. Requests wait for the
+    end of the reactor turn, then every waiting cancel runs before anything
+    that adds to the book, so a burst of new orders cannot hold up the
+    cancels of the quotes it would trade against.
+
+    Cancels and new orders each have a lane of at most max_pending
+    requests. Past that, new orders and amends are refused through the
+    listeners (on_queue_fail, on_amend_fail) and cancels fail with
+    OVERLOADED. A cancel touching an order still waiting to be placed
+    waits behind it in the order lane.
+
+    Every request waits a reactor turn, loaded or not, so the queue is only
+    used when [engine] admission_max_pending is set.
+    """
+
+    def __init__(self, engine, max_pending=1000, reg_log=True):
+        self.engine = engine
+        self.max_pending = max_pending
+        self.lanes = {"cancel": deque(), "order": deque()}
+        # Orders waiting in the order lane, id to username
+        self.waiting = {}
+        self.pending_drain = None
+
+        self.admitted = {"cancel": 0, "order": 0}
+        self.rejected = {"cancel": 0, "order": 0}
+        self.peak_depth = {"cancel": 0, "order": 0}
+
+        if reg_log:
+            def regular_log():
+                self.log_stats()
+                reactor.callLater(600, regular_log)
+
+            reactor.callLater(600, regular_log)
+
+    def submit(self, lane, operation, reject, orders=None):
+        """
+        Queue operation to run at the end of this turn, or call reject now
+        if the lane is full.
+
+        :returns: Deferred -- the result of operation or of reject
+        """
+        if orders is None:
+            orders = []
+        queue = self.lanes[lane]
+        if len(queue) >= self.max_pending:
+            self.rejected[lane] += 1
+            return maybeDeferred(reject)
+
+        d = Deferred()
+        queue.append((d, operation, orders))
+        for order in orders:
+            self.waiting[order.id] = order.username
+
+        self.admitted[lane] += 1
+        self.peak_depth[lane] = max(self.peak_depth[lane], len(queue))
+        if self.pending_drain is None:
+            self.pending_drain = reactor.callLater(0, self.drain)
+        return d
+
+    def submit_cancel(self, operation, ids=None, everyone=False, username=None):
+        if everyone:
+            behind = bool(self.waiting) if username is None else username in self.waiting.itervalues()
+        else:
+            behind = any(id in self.waiting for id in ids or [])
+
+        def reject():
+            raise OVERLOADED
+
+        return self.submit("order" if behind else "cancel", operation, reject)
+
+    def drain(self):
+        if self.pending_drain is not None and self.pending_drain.active():
+            self.pending_drain.cancel()
+        self.pending_drain = None
+
+        for lane in ["cancel", "order"]:
+            queue = self.lanes[lane]
+            while queue:
+                d, operation, orders = queue.popleft()
+                for order in orders:
+                    self.waiting.pop(order.id, None)
+                try:
+                    result = operation()
+                except Exception:
+                    d.errback()
+                else:
+                    d.callback(result)
+
+    @property
+    def stats(self):
+        return {"depth": dict((lane, len(queue)) for lane, queue in self.lanes.iteritems()),
+                "peak_depth": dict(self.peak_depth),
+                "admitted": dict(self.admitted),
+                "rejected": dict(self.rejected)}
+
+    def log_stats(self):
+        stats = self.stats
+        log.msg("Admission for the last period: %s admitted, %s rejected, peak depth %s." %
+                (stats["admitted"], stats["rejected"], stats["peak_depth"]))
+        for lane in self.lanes:
+            self.admitted[lane] = 0
+            self.rejected[lane] = 0
+            self.peak_depth[lane] = len(self.lanes[lane])
+
+
 class AccountantExport(ComponentExport):
-    def __init__(self, engine, safe_price_notifier, webserver_notifier):
+    def __init__(self, engine, safe_price_notifier, webserver_notifier, admission=None):
         self.engine = engine
         self.safe_price_notifier = safe_price_notifier
         self.webserver_notifier = webserver_notifier
+        self.admission = admission
         ComponentExport.__init__(self, engine)
 
+    def admit(self, operation, reject, orders=None):
+        if self.admission is None:
+            return operation()
+        return self.admission.submit("order", operation, reject, orders)
+
+    def admit_cancel(self, operation, ids=None, everyone=False, username=None):
+        if self.admission is None:
+            return operation()
+        return self.admission.submit_cancel(operation, ids, everyone, username)
+
+    def refuse_orders(self, orders):
+        for order in orders:
+            self.engine.notify_queue_fail(order, "the engine is overloaded")
+        return [False] * len(orders)
+
     @export
     @schema("rpc/engine.json#place_order")
     def place_order(self, order):
-        return self.engine.place_order(Order(**order))
+        order = Order(**order)
+        return self.admit(lambda: self.engine.place_order(order),
+                          lambda: self.refuse_orders([order])[0], [order])
 
     @export
     @schema("rpc/engine.json#cancel_order")
     def cancel_order(self, id):
-        return self.engine.cancel_order(id)
+        return self.admit_cancel(lambda: self.engine.cancel_order(id), [id])
+
+    @export
+    @schema("rpc/engine.json#amend_order")
+    def amend_order(self, id, price, quantity):
+        def refuse():
+            self.engine.notify_amend_fail(id, "the engine is overloaded")
+            return False
+
+        return self.admit(lambda: self.engine.amend_order(id, price, quantity), refuse)
+
+    @export
+    @schema("rpc/engine.json#cancel_all")
+    def cancel_all(self, username=None):
+        return self.admit_cancel(lambda: self.engine.cancel_all(username), everyone=True, username=username)
+
+    @export
+    @schema("rpc/engine.json#place_orders")
+    def place_orders(self, orders):
+        orders = [Order(**order) for order in orders]
+        return self.admit(lambda: [self.engine.place_order(order) for order in orders],
+                          lambda: self.refuse_orders(orders), orders)
+
+    @export
+    @schema("rpc/engine.json#cancel_orders")
+    def cancel_orders(self, ids):
+        return self.admit_cancel(lambda: [self.engine.cancel_order(id) for id in ids], ids)
 
     @export
     @schema("rpc/engine.json#get_safe_price")
@@ -530,8 +1414,20 @@ class AccountantExport(ComponentExport):
 
     @export
     @schema("rpc/engine.json#get_order_book")
-    def get_order_book(self):
-        return self.webserver_notifier.wire_book
+    def get_order_book(self, depth=None):
+        return self.webserver_notifier.wire_book(depth)
+
+    @export
+    @schema("rpc/engine.json#get_book_snapshot")
+    def get_book_snapshot(self):
+        return self.webserver_notifier.snapshot
+
+    @export
+    @schema("rpc/engine.json#get_admission_stats")
+    def get_admission_stats(self):
+        if self.admission is None:
+            return None
+        return self.admission.stats
 
 class AdministratorExport(ComponentExport):
     def __init__(self, engine):
@@ -545,63 +1441,105 @@ class AdministratorExport(ComponentExport):
                       for side, orders in self.engine.orderbook.iteritems()}
         return order_book
 
+    @export
+    @schema("rpc/engine.json#get_stats")
+    def get_stats(self):
+        return self.engine.stats_registry.stats
 
-if __name__ == "__main__":
-    log.startLogging(sys.stdout)
-    session = database.make_session()
-    ticker = args[0]
 
-    try:
-        contract = session.query(models.Contract).filter_by(ticker=ticker).one()
-    except Exception, e:
-        session.rollback()
-        log.err("Cannot determine ticker id. %s" % e)
-        log.err()
-        raise e
+def start_engine(session, contract, accountant, webserver, forwarder):
+    """
+    Set up the engine for one contract: its listeners and exports, and its
+    book recovered from the journal. Listeners are attached but not
+    initialised.
 
-    engine = Engine()
+    :returns: tuple -- the engine, its AccountantExport and AdministratorExport
+    """
+    engine = Engine(stats.Registry(contract.ticker))
     administrator_export = AdministratorExport(engine)
-    accountant_port = config.getint("engine", "accountant_base_port") + contract.id
-
-    administrator_port = config.getint("engine", "administrator_base_port") + contract.id
-    router_share_async(administrator_export, "tcp://127.0.0.1:%d" % administrator_port)
 
     logger = LoggingListener(engine, contract)
-    accountant = accountant.AccountantProxy("push",
-                                            config.get("accountant", "engine_export"),
-                                            config.getint("accountant", "engine_export_base_port"))
     accountant_notifier = AccountantNotifier(engine, accountant, contract)
-    webserver = push_proxy_async(config.get("webserver", "engine_export"))
-    webserver_notifier = WebserverNotifier(engine, webserver, contract)
+    webserver_notifier = WebserverNotifier(engine, webserver, contract,
+                                           deltas=config.getboolean("engine", "book_deltas"),
+                                           conflation_window=config.getfloat("engine", "book_conflation_window"))
+
+    safe_price_notifier = SafePriceNotifier(session, engine, accountant, webserver, forwarder, contract,
+                                            checkpoint_dir=config.get("engine", "journal_dir"),
+                                            checkpoint_interval=config.getint("engine", "snapshot_interval"))
+    max_pending = config.getint("engine", "admission_max_pending")
+    admission = AdmissionQueue(engine, max_pending) if max_pending > 0 else None
+    accountant_export = AccountantExport(engine, safe_price_notifier, webserver_notifier, admission)
+
+    journal = JournalListener(engine, contract, config.get("engine", "journal_dir"),
+                              config.getint("engine", "snapshot_interval"))
+
+    # Rebuild the book from the last snapshot and the journal, then cancel
+    #   only the open orders it does not account for.
+    journal.recover()
+    reconcile_book(engine, session, contract, accountant)
+    journal.snapshot()
+
+    engine.add_listener(journal)
+    engine.add_listener(logger)
+    engine.add_listener(accountant_notifier)
+    engine.add_listener(webserver_notifier)
+    engine.add_listener(safe_price_notifier)
 
+    return engine, accountant_export, administrator_export
 
-    watchdog(config.get("watchdog", "engine") %
-             (config.getint("watchdog", "engine_base_port") + contract.id))
 
-    forwarder = connect_publisher(config.get("safe_price_forwarder", "zmq_frontend_address"))
+if __name__ == "__main__":
+    log.startLogging(sys.stdout)
+    session = database.make_session()
 
-    safe_price_notifier = SafePriceNotifier(session, engine, accountant, webserver, forwarder, contract)
-    accountant_export = AccountantExport(engine, safe_price_notifier, webserver_notifier)
-    router_share_async(accountant_export, "tcp://127.0.0.1:%d" % accountant_port)
+    # Either one ticker, or an engine host: several tickers joined with "+"
+    #   sharing this process and the ports of the first of them.
+    tickers = [ticker.strip() for ticker in args[0].split("+")]
 
-    engine.add_listener(logger)
-    engine.add_listener(accountant_notifier)
-    engine.add_listener(webserver_notifier)
-    engine.add_listener(safe_price_notifier)
+    contracts = []
+    for ticker in tickers:
+        try:
+            contracts.append(session.query(models.Contract).filter_by(ticker=ticker).one())
+        except Exception, e:
+            session.rollback()
+            log.err("Cannot determine ticker id. %s" % e)
+            log.err()
+            raise e
 
-    # Cancel all orders with some quantity_left that have been dispatched but not cancelled
-    try:
-        for order in session.query(models.Order).filter_by(
-                is_cancelled=False).filter_by(
-                contract_id=contract.id).filter(
-                        models.Order.quantity_left > 0):
-            log.msg("Cancelling order %d" % order.id)
-            accountant.cancel_order(order.username, order.id)
-    except Exception as e:
-        session.rollback()
-        raise e
+    accountant = accountant.AccountantProxy("push",
+                                            config.get("accountant", "engine_export"),
+                                            config.getint("accountant", "engine_export_base_port"))
+    webserver = push_proxy_async(config.get("webserver", "engine_export"))
+    forwarder = connect_publisher(config.get("safe_price_forwarder", "zmq_frontend_address"))
 
-    engine.notify_init()
+    engines = []
+    accountant_exports = {}
+    administrator_exports = {}
+    for contract in contracts:
+        engine, accountant_exports[contract.ticker], administrator_exports[contract.ticker] = \
+            start_engine(session, contract, accountant, webserver, forwarder)
+        engines.append(engine)
+
+    # The others find the host on the ports of its first active contract
+    active = [contract for contract in contracts if contract.active]
+    port_contract = active[0] if active else contracts[0]
+    accountant_port = config.getint("engine", "accountant_base_port") + port_contract.id
+    administrator_port = config.getint("engine", "administrator_base_port") + port_contract.id
+    if len(contracts) == 1:
+        router_share_async(accountant_exports[port_contract.ticker], "tcp://127.0.0.1:%d" % accountant_port)
+        router_share_async(administrator_exports[port_contract.ticker], "tcp://127.0.0.1:%d" % administrator_port)
+    else:
+        router_share_routed_async(accountant_exports, "tcp://127.0.0.1:%d" % accountant_port)
+        router_share_routed_async(administrator_exports, "tcp://127.0.0.1:%d" % administrator_port)
+    log.msg("Listening for connections on ports %d and %d for %s." %
+            (accountant_port, administrator_port, ", ".join(tickers)))
 
-    reactor.run()
+    watchdog(config.get("watchdog", "engine") %
+             (config.getint("watchdog", "engine_base_port") + port_contract.id))
 
+    for engine in engines:
+        reactor.addSystemEventTrigger("before", "shutdown", engine.notify_shutdown)
+        engine.notify_init()
+        engine.stats_registry.start_logging(config.getint("engine", "stats_interval"))
+    reactor.run()
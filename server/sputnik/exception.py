@@ -11,6 +11,7 @@ class AccountantException(SputnikException): pass
 class AdministratorException(SputnikException): pass
 class CashierException(SputnikException): pass
 class LedgerException(SputnikException): pass
+class EngineException(SputnikException): pass
 class WebserverException(SputnikException): pass
 class ZendeskException(SputnikException): pass
 class PostgresException(SputnikException): pass
@@ -15,18 +15,20 @@ from collections import defaultdict
 
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
 from twisted.protocols.policies import TimeoutMixin
 from twisted.python import log
 
 from sqlalchemy.exc import SQLAlchemyError, DBAPIError
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, bindparam, and_, func
 
 import config
 import util
 import database
-from models import Posting, Journal, User, Contract
+from models import Posting, Journal, User, Contract, Balance
 from zmq_util import router_share_async, export, ComponentExport
 from util import timed
+import stats
 from rpc_schema import schema
 from watchdog import watchdog
 import time
@@ -40,12 +42,15 @@ COUNT_MISMATCH = LedgerException("exceptions/ledger/count_mismatch")
 GROUP_TIMEOUT = LedgerException("exceptions/ledger/group_timeout")
 INTERNAL_ERROR = LedgerException("exceptions/ledger/internal_error")
 DATABASE_ERROR = LedgerException("exceptions/ledger/database_error")
+OVERLOADED = LedgerException("exceptions/ledger/overloaded")
 
 class PostingGroup(TimeoutMixin):
-    def __init__(self, timeout=None):
+    def __init__(self, timeout=None, on_timeout=None):
         self.uid = None
         self.postings = []
         self.deferreds = []
+        self.start_time = time.time()
+        self.on_timeout = on_timeout
         self.setTimeout(timeout)
 
     def add(self, posting):
@@ -78,128 +83,212 @@ class PostingGroup(TimeoutMixin):
         for posting in self.postings:
             log.err(str(posting))
         self.fail(GROUP_TIMEOUT)
+        if self.on_timeout is not None:
+            self.on_timeout(self)
 
 class Ledger:
-    def __init__(self, engine, timeout=None):
+    def __init__(self, engine, timeout=None, group_commit_window=None, group_commit_size=100,
+                 max_pending_groups=None, max_pending_postings=None):
+        """
+        :param group_commit_window: seconds a ready group may wait to share a transaction with others, 0 or None to commit each group as it is ready
+        :type group_commit_window: float
+        :param group_commit_size: commit the waiting groups at once when there are this many
+        :type group_commit_size: int
+        :param max_pending_groups: refuse new groups with OVERLOADED while this many are incomplete, 0 or None for no limit
+        :type max_pending_groups: int
+        :param max_pending_postings: likewise for the postings held in incomplete groups
+        :type max_pending_postings: int
+        """
         self.engine = engine
-        self.pending = defaultdict(lambda: PostingGroup(timeout))
-
-    def execute(self, *args, **kwargs):
-        conn = self.engine.connect()
+        self.timeout = timeout
+        self.pending = {}
+        self.pending_postings = 0
+        self.max_pending_groups = max_pending_groups
+        self.max_pending_postings = max_pending_postings
+        self.completed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.peak_pending = 0
+        # Neither a contract's id nor a user's type changes once created
+        self.contract_ids = {}
+        self.user_types = {}
+        self.group_commit_window = group_commit_window
+        self.group_commit_size = group_commit_size
+        self.ready_groups = []
+        self.commit_call = None
+        self.callLater = reactor.callLater
+
+    def transaction(self, work, *args):
+        """Run work(connection, *args) in one transaction on one pooled connection
+
+        The whole transaction is tried again if it fails, up to 10 times.
+        """
         count = 0
         while count < 10:
+            conn = self.engine.connect()
             try:
-                result = conn.execute(*args, **kwargs)
-                conn.close()
-                return result
+                with conn.begin():
+                    return work(conn, *args)
             except DBAPIError as e:
                 if e.connection_invalidated:
                     log.err("Connection invalidated! Trying again - %s" % str(e))
                 else:
-                    log.err("Unable to execute query: %s %s: %s - trying again" % (args, kwargs, str(e)))
-
-                conn = self.engine.connect()
+                    log.err("Unable to commit transaction: %s - trying again" % str(e))
                 count += 1
+            finally:
+                conn.close()
 
         log.err("Tried to reconnect 10 times, no joy")
         raise DATABASE_ERROR
 
+    def load_ids(self, conn, postings):
+        """Fill the contract id and user type caches for the postings, one query each for any missing
+        """
+        tickers = set(posting["contract"] for posting in postings) - set(self.contract_ids)
+        if tickers:
+            contract_table = Contract.__table__
+            s = select([contract_table.c.ticker, contract_table.c.id], contract_table.c.ticker.in_(tickers))
+            self.contract_ids.update(conn.execute(s).fetchall())
+
+        usernames = set(posting["username"] for posting in postings) - set(self.user_types)
+        if usernames:
+            user_table = User.__table__
+            s = select([user_table.c.username, user_table.c.type], user_table.c.username.in_(usernames))
+            self.user_types.update(conn.execute(s).fetchall())
+
+        for posting in postings:
+            if posting["contract"] not in self.contract_ids or posting["username"] not in self.user_types:
+                log.err("No such contract or user in posting: %s" % posting)
+                raise ARGUMENT_ERROR
+
+    def audit(self, postings):
+        # sanity check
+        if len(postings) == 0:
+            raise INTERNAL_ERROR
+
+        types = [posting["type"] for posting in postings]
+        counts = [posting["count"] for posting in postings]
+
+        if not all(type == types[0] for type in types):
+            raise TYPE_MISMATCH
+        if not all(count == counts[0] for count in counts):
+            raise COUNT_MISMATCH
+
+        # balance check
+        debitsum = defaultdict(int)
+        creditsum = defaultdict(int)
+
+        for posting in postings:
+            if posting["direction"] == "debit":
+                debitsum[posting["contract"]] += posting["quantity"]
+            if posting["direction"] == "credit":
+                creditsum[posting["contract"]] += posting["quantity"]
+
+        for ticker in debitsum:
+            if debitsum[ticker] - creditsum[ticker] is not 0:
+                raise QUANTITY_MISMATCH
+
+    def db_posting(self, posting, journal_id):
+        user_type = self.user_types[posting["username"]]
+        if posting["timestamp"] is not None:
+            timestamp = util.timestamp_to_dt(posting["timestamp"])
+        else:
+            timestamp = None
+
+        if posting["direction"] == 'debit':
+            if user_type == 'Asset':
+                sign = 1
+            else:
+                sign = -1
+        else:
+            if user_type == 'Asset':
+                sign = -1
+            else:
+                sign = 1
+
+        return {'username': posting["username"],
+                'contract_id': self.contract_ids[posting["contract"]],
+                'quantity': sign * posting["quantity"],
+                'note': posting["note"],
+                'timestamp': timestamp,
+                'journal_id': journal_id
+        }
+
+    def update_balances(self, conn, db_postings, journal_timestamps):
+        """Add the postings to the balances table, inserting the rows it does not have yet
+
+        A new row starts from the sum of all of the user's postings in the
+        contract, which already counts these ones, so that a user who posted
+        before the row existed does not start from this batch alone.
+        """
+        changes = {}
+        for db_posting in db_postings:
+            key = (db_posting["username"], db_posting["contract_id"])
+            change = changes.get(key)
+            if change is None:
+                change = changes[key] = {"b_username": key[0], "b_contract_id": key[1], "b_quantity": 0}
+            change["b_quantity"] += db_posting["quantity"]
+            # postings are in journal order, so the last one wins
+            change["b_journal_id"] = db_posting["journal_id"]
+            change["b_timestamp"] = journal_timestamps[db_posting["journal_id"]]
+
+        balance_table = Balance.__table__
+        usernames = set(username for username, contract_id in changes)
+        s = select([balance_table.c.username, balance_table.c.contract_id], balance_table.c.username.in_(usernames))
+        existing = set((row.username, row.contract_id) for row in conn.execute(s))
+
+        updates = [change for key, change in changes.iteritems() if key in existing]
+        if updates:
+            conn.execute(balance_table.update().where(and_(
+                balance_table.c.username == bindparam("b_username"),
+                balance_table.c.contract_id == bindparam("b_contract_id"))).values(
+                balance=balance_table.c.balance + bindparam("b_quantity"),
+                journal_id=bindparam("b_journal_id"),
+                timestamp=bindparam("b_timestamp")), updates)
+
+        missing = [key for key in changes if key not in existing]
+        if missing:
+            posting_table = Posting.__table__
+            s = select([posting_table.c.username, posting_table.c.contract_id, func.sum(posting_table.c.quantity)],
+                       posting_table.c.username.in_(set(username for username, contract_id in missing))).group_by(
+                posting_table.c.username, posting_table.c.contract_id)
+            sums = dict(((row[0], row[1]), row[2]) for row in conn.execute(s))
+            conn.execute(balance_table.insert(), [{"username": key[0], "contract_id": key[1],
+                                                   "balance": sums[key],
+                                                   "journal_id": changes[key]["b_journal_id"],
+                                                   "timestamp": changes[key]["b_timestamp"]}
+                                                  for key in missing])
+
+    def write(self, conn, groups):
+        """Create a journal for each group of postings, then all of their postings in one insert,
+        and bring the balances they touch up to date
+        """
+        self.load_ids(conn, [posting for postings in groups for posting in postings])
+        db_postings = []
+        journal_timestamps = {}
+        for postings in groups:
+            timestamp = datetime.datetime.utcnow()
+            result = conn.execute(Journal.__table__.insert(), type=postings[0]["type"],
+                                  timestamp=timestamp)
+            journal_id = result.inserted_primary_key[0]
+            journal_timestamps[journal_id] = timestamp
+            db_postings.extend(self.db_posting(posting, journal_id) for posting in postings)
+        result = conn.execute(Posting.__table__.insert(), db_postings)
+        log.msg("Inserted %d rows of %d postings in %d journals" % (result.rowcount, len(db_postings), len(groups)))
+        self.update_balances(conn, db_postings, journal_timestamps)
+
     @timed
     def atomic_commit(self, postings):
 
         start = time.time()
         log.msg("atomic commit called for %s at %f" % (postings, start))
         try:
-            # sanity check
-            if len(postings) == 0:
-                raise INTERNAL_ERROR
-
-
-            types = [posting["type"] for posting in postings]
-            counts = [posting["count"] for posting in postings]
-
-            if not all(type == types[0] for type in types):
-                raise TYPE_MISMATCH
-            if not all(count == counts[0] for count in counts):
-                raise COUNT_MISMATCH
-
-            # balance check
-            debitsum = defaultdict(int)
-            creditsum = defaultdict(int)
-
-            log.msg("auditing postings at %f" % (time.time() - start))
-            for posting in postings:
-                if posting["direction"] == "debit":
-                    debitsum[posting["contract"]] += posting["quantity"]
-                if posting["direction"] == "credit":
-                    creditsum[posting["contract"]] += posting["quantity"]
-
-            for ticker in debitsum:
-                if debitsum[ticker] - creditsum[ticker] is not 0:
-                    raise QUANTITY_MISMATCH
-
-            # create the journal and postings
-            # The journal is created separately from the postings but this is ok because
-            # all the postings are created at once. If the posting commit fails then we'll
-            # just end up with an empty journal which won't break anything
-            # TODO: Create the journal and postings together
-            log.msg("creating the journal at %f" % (time.time() - start))
-            ins = Journal.__table__.insert()
-
-            result = self.execute(ins, type=types[0], timestamp=datetime.datetime.utcnow())
-
-            journal_id = result.inserted_primary_key[0]
-
-            log.msg("creating the db postings at %f" % (time.time() - start))
-            db_postings = []
-            for posting in postings:
-                contract_table = Contract.__table__
-                s = select([contract_table.c.id], contract_table.c.ticker==posting["contract"])
-                result = self.execute(s)
-                contract_id = result.first()[0]
-
-                user_table = User.__table__
-                s = select([user_table.c.type], user_table.c.username==posting["username"])
-                result = self.execute(s)
-                user_type = result.first()[0]
-
-                username = posting["username"]
-                quantity = posting["quantity"]
-                direction = posting["direction"]
-                note = posting["note"]
-                if posting["timestamp"] is not None:
-                    timestamp = util.timestamp_to_dt(posting["timestamp"])
-                else:
-                    timestamp = None
+            self.audit(postings)
 
-                if direction == 'debit':
-                    if user_type == 'Asset':
-                        sign = 1
-                    else:
-                        sign = -1
-                else:
-                    if user_type == 'Asset':
-                        sign = -1
-                    else:
-                        sign = 1
-
-                posting = {'username': username,
-                           'contract_id': contract_id,
-                           'quantity': sign * quantity,
-                           'note': note,
-                           'timestamp': timestamp,
-                           'journal_id': journal_id
-                }
-                db_postings.append(posting)
-                log.msg("done making posting at %f: %s" % (time.time() - start, posting))
-
-
-            ins = Posting.__table__.insert()
-            result = self.execute(ins, db_postings)
-            log.msg("Inserted %d rows of %d postings" % (result.rowcount, len(db_postings)))
+            # The journal and postings go in together or not at all
+            self.transaction(self.write, [postings])
             log.msg("Done committing postings at %f" % (time.time() - start))
 
-
             return True
 
         except Exception, e:
@@ -212,32 +301,116 @@ class Ledger:
                 raise DATABASE_ERROR
             raise e
 
-        finally:
-            # We have a long running session object, so we must make sure it
-            # is clean at all times. If there is an exception in the exception
-            # handler, session.rollback() might not get called. This way it is
-            # guaranteed to happen.
-            # 
-            # This is safe to run after a commit.
-            pass
+    def commit_group(self, group):
+        try:
+            self.atomic_commit(group.postings)
+            group.succeed()
+        except Exception, e:
+            group.fail(e)
+
+    def queue_group(self, group):
+        """Hold a ready group for the group commit window, or until enough have queued up
+        """
+        try:
+            self.audit(group.postings)
+        except Exception, e:
+            log.err("Posting group with uid: %s failed audit. Postings were:" % group.uid)
+            for posting in group.postings:
+                log.err(str(posting))
+            group.fail(e)
+            return
+
+        # It is complete, so it can no longer time out
+        group.setTimeout(None)
+        group.ready_time = time.time()
+        self.ready_groups.append(group)
+        if len(self.ready_groups) >= self.group_commit_size:
+            self.commit_ready()
+        elif self.commit_call is None:
+            self.commit_call = self.callLater(self.group_commit_window, self.commit_ready)
+
+    def commit_ready(self):
+        if self.commit_call is not None and self.commit_call.active():
+            self.commit_call.cancel()
+        self.commit_call = None
+
+        groups, self.ready_groups = self.ready_groups, []
+        if not groups:
+            return
+
+        now = time.time()
+        stats.registry.record_count("group_commit_size", len(groups))
+        for group in groups:
+            stats.registry.record("group_commit_wait", (now - group.ready_time) * 1e6)
+        self.commit_groups(groups)
+
+    @timed
+    def commit_groups(self, groups):
+        """Commit several audited groups in one transaction
+
+        If that fails, each group is committed on its own, so that one bad
+        group does not take the others down with it.
+        """
+        try:
+            self.transaction(self.write, [group.postings for group in groups])
+        except Exception:
+            log.err("Unable to commit %d posting groups together, committing them one at a time" % len(groups))
+            log.err()
+            for group in groups:
+                self.commit_group(group)
+            return
+
+        for group in groups:
+            group.succeed()
+
+    def expire(self, group):
+        """Forget a group which timed out
+        """
+        if self.pending.get(group.uid) is group:
+            del self.pending[group.uid]
+            self.pending_postings -= len(group.postings)
+        self.timed_out += 1
+
+    def admit(self, postings):
+        """Refuse postings which would start a new group while the pending table is full
+
+        Postings for a group already pending are always taken, as they bring
+        it closer to leaving the table. The accountants post refused postings
+        again with backoff, so a group started by its other postings meanwhile
+        still completes.
+        """
+        if postings[0]["uid"] in self.pending:
+            return
+        if (self.max_pending_groups and len(self.pending) >= self.max_pending_groups) or \
+                (self.max_pending_postings and self.pending_postings + len(postings) > self.max_pending_postings):
+            self.rejected += 1
+            log.err("Ledger overloaded with %d groups of %d postings pending, refusing uid: %s" %
+                    (len(self.pending), self.pending_postings, postings[0]["uid"]))
+            raise OVERLOADED
 
     def post_one(self, posting):
         uid = posting["uid"]
-        group = self.pending[uid]
+        group = self.pending.get(uid)
+        if group is None:
+            group = self.pending[uid] = PostingGroup(self.timeout, self.expire)
+            self.peak_pending = max(self.peak_pending, len(self.pending))
 
         # acquire the deferred we will return
         response = group.add(posting)
+        self.pending_postings += 1
         
         # Note: it is important we do _not_ check the posting group for
         # consistency yet. Wait until we have them all.
 
         if group.ready():
-            try:
-                self.atomic_commit(group.postings)
-                group.succeed()
-            except Exception, e:
-                group.fail(e)
             del self.pending[uid]
+            self.pending_postings -= len(group.postings)
+            self.completed += 1
+            stats.registry.record("group_age", (time.time() - group.start_time) * 1e6)
+            if self.group_commit_window:
+                self.queue_group(group)
+            else:
+                self.commit_group(group)
        
         return response
 
@@ -252,12 +425,39 @@ class Ledger:
         uids = [posting["uid"] for posting in postings]
         if not all(uid == uids[0] for uid in uids):
             raise UID_MISMATCH
+
+        self.admit(postings)
         
         # at this point, all posting will succeed or fail simulatenously
         # return the first one
         deferreds = [self.post_one(posting) for posting in postings]
         return deferreds[0]
 
+    @property
+    def stats(self):
+        now = time.time()
+        return {"pending_groups": len(self.pending),
+                "pending_postings": self.pending_postings,
+                "peak_pending_groups": self.peak_pending,
+                "oldest_pending": max([now - group.start_time for group in self.pending.itervalues()] or [0]),
+                "completed": self.completed,
+                "timed_out": self.timed_out,
+                "rejected": self.rejected}
+
+    def log_stats(self):
+        stats = self.stats
+        finished = stats["completed"] + stats["timed_out"]
+        timeout_rate = float(stats["timed_out"]) / finished if finished else 0
+        log.msg("Pending groups for the last period: %d completed, %d timed out (%.2f%%), %d refused, "
+                "peak %d. Now %d groups of %d postings, the oldest %.1fs old." %
+                (stats["completed"], stats["timed_out"], timeout_rate * 100, stats["rejected"],
+                 stats["peak_pending_groups"], stats["pending_groups"], stats["pending_postings"],
+                 stats["oldest_pending"]))
+        self.completed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.peak_pending = len(self.pending)
+
 
 class AccountantExport(ComponentExport):
     def __init__(self, ledger):
@@ -269,6 +469,13 @@ class AccountantExport(ComponentExport):
     def post(self, *postings):
         return self.ledger.post(list(postings))
 
+    @export
+    @schema("rpc/ledger.json#get_stats")
+    def get_stats(self):
+        result = stats.registry.stats
+        result["pending"] = self.ledger.stats
+        return result
+
 def create_posting(type, username, contract, quantity, direction, note=None, timestamp=None):
     if timestamp is None:
         timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
@@ -281,8 +488,16 @@ if __name__ == "__main__":
     fo.formatTime = lambda x: datetime.datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S.%f")
     engine = database.make_engine()
     timeout = config.getint("ledger", "timeout")
-    ledger = Ledger(engine, timeout)
+    ledger = Ledger(engine, timeout,
+                    group_commit_window=config.getfloat("ledger", "group_commit_window"),
+                    group_commit_size=config.getint("ledger", "group_commit_size"),
+                    max_pending_groups=config.getint("ledger", "max_pending_groups"),
+                    max_pending_postings=config.getint("ledger", "max_pending_postings"))
+    # Commit whatever is still waiting for its window
+    reactor.addSystemEventTrigger("before", "shutdown", ledger.commit_ready)
     accountant_export = AccountantExport(ledger)
+    stats.registry.start_logging(config.getint("ledger", "stats_interval"))
+    LoopingCall(ledger.log_stats).start(config.getint("ledger", "stats_interval"), now=False)
     watchdog(config.get("watchdog", "ledger"))
     router_share_async(accountant_export,
             config.get("ledger", "accountant_export"))
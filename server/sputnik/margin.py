@@ -11,6 +11,7 @@ __author__ = 'arthurb'
 import models
 import util
 import collections
+import numpy
 
 from twisted.python import log
 
@@ -18,6 +19,115 @@ class MarginException(Exception):
     pass
 
 
+def open_orders_query(session, user):
+    return session.query(models.Order).filter_by(user=user).filter(
+        models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True)
+
+
+def position_margin(contract, position, reference_price, max_position, min_position, max_spent, max_received,
+                    safe_prices):
+    """
+    calculates the low and high margin of one futures or prediction position
+    :param max_position: the position if all the buy orders on the contract are hit
+    :type max_position: int
+    :param min_position: the position if all the sell orders on the contract are hit
+    :type min_position: int
+    :param max_spent: the sum of quantity_left * price * lot_size / denominator over the buy orders
+    :type max_spent: int
+    :param max_received: the same over the sell orders
+    :type max_received: int
+    :returns: tuple - low and high margin
+    """
+    if contract.contract_type == 'futures':
+        if contract.ticker not in safe_prices:
+            log.err("%s not in safe_prices, marking margin high" % contract.ticker)
+            return 2**48, 2**48
+
+        SAFE_PRICE = safe_prices[contract.ticker]
+
+        if reference_price is None:
+            if position != 0:
+                raise MarginException("No reference price with non-zero position")
+
+            reference_price = SAFE_PRICE
+
+        # We divide by 100 because contract.margin_low and contract.margin_high are percentages from 0-100
+        low_max = abs(max_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        low_min = abs(min_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        high_max = abs(max_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        high_min = abs(min_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        log.msg("%s" % ["Margin:", contract.ticker, max_position, min_position, low_max, low_min, high_max, high_min])
+
+        return max(low_max, low_min), max(high_max, high_min)
+
+    if contract.contract_type == 'prediction':
+        payoff = contract.lot_size
+
+        worst_short_cover = -min_position * payoff if min_position < 0 else 0
+        best_short_cover = -max_position * payoff if max_position < 0 else 0
+
+        additional_margin = max(max_spent + best_short_cover, -max_received + worst_short_cover)
+        return additional_margin, additional_margin
+
+    return 0, 0
+
+
+def order_value(order):
+    """
+    :returns: int - what the rest of a prediction order costs, or pays, if it is hit
+    """
+    return order.quantity_left * order.price * order.contract.lot_size / order.contract.denominator
+
+
+def order_cash_spent(user, order, trial_period=False):
+    """
+    the most cash an open order can use up, fees included
+    :param order: the order
+    :type order: Order
+    :returns: dict - ticker to amount
+    """
+    fees = util.get_fees(user, order.contract, order.price, order.quantity, trial_period=trial_period)
+    cash_spent = collections.defaultdict(int)
+
+    # Deal with cash_pair orders separately because there are no cash_pair positions
+    if order.contract.contract_type == 'cash_pair':
+        transaction_size = util.get_cash_spent(order.contract, order.price, order.quantity)
+
+        if order.side == 'BUY':
+            cash_spent[order.contract.denominated_contract.ticker] += transaction_size
+            if order.contract.payout_contract.ticker in fees:
+                fees[order.contract.payout_contract.ticker] = max(0, fees[order.contract.payout_contract.ticker] - order.quantity_left)
+        if order.side == 'SELL':
+            cash_spent[order.contract.payout_contract.ticker] += order.quantity_left
+            if order.contract.denominated_contract.ticker in fees:
+                fees[order.contract.denominated_contract.ticker] = max(0, fees[order.contract.denominated_contract.ticker] - transaction_size)
+
+    for ticker, fee in fees.iteritems():
+        cash_spent[ticker] += fee
+
+    return cash_spent
+
+
+def cash_margin(max_cash_spent, cash_position):
+    """
+    :returns: int - the margin needed to cover the cash the orders and withdrawals could use
+    """
+    margin = 0
+    for cash_ticker, max_spent in max_cash_spent.iteritems():
+        if cash_ticker == 'BTC':
+            margin += max_spent
+        elif max_spent > cash_position.get(cash_ticker, 0):
+            # TODO: We should fix this hack and just check max_cash_spent in check_margin
+            log.msg("max_spent (%d) > cash_position[%s] (%d)" % (max_spent, cash_ticker, cash_position.get(cash_ticker, 0)))
+            margin += 2**48
+
+    return margin
+
+
 def calculate_margin(user, session, safe_prices={}, order_id=None, withdrawals=None, trial_period=False, position_overrides={},
                      cash_overrides={}):
     """
@@ -43,8 +153,7 @@ def calculate_margin(user, session, safe_prices={}, order_id=None, withdrawals=N
     # Override some positions
     positions.update(position_overrides)
 
-    open_orders = session.query(models.Order).filter_by(user=user).filter(
-        models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True).all()
+    open_orders = open_orders_query(session, user).all()
 
     if order_id:
         open_orders += session.query(models.Order).filter_by(id=order_id).all()
@@ -59,99 +168,40 @@ def calculate_margin(user, session, safe_prices={}, order_id=None, withdrawals=N
             }
 
     for position in positions.values():
+        contract = position['contract']
+
+        if contract.contract_type == 'cash':
+            cash_position[contract.ticker] = position['position']
+            continue
+
         max_position = position['position'] + sum(
             order.quantity_left for order in open_orders if
-            order.contract == position['contract'] and order.side == 'BUY')
+            order.contract == contract and order.side == 'BUY')
         min_position = position['position'] - sum(
             order.quantity_left for order in open_orders if
-            order.contract == position['contract'] and order.side == 'SELL')
+            order.contract == contract and order.side == 'SELL')
 
-        contract = position['contract']
+        # case where all our buy orders are hit
+        max_spent = sum(order_value(order) for order in open_orders if
+                        order.contract == contract and order.side == 'BUY')
 
-        if contract.contract_type == 'futures':
-            if contract.ticker not in safe_prices:
-                log.err("%s not in safe_prices, marking margin high" % contract.ticker)
-                high_margin += 2**48
-                low_margin += 2**48
-            else:
-                SAFE_PRICE = safe_prices[contract.ticker]
-
-                #log.msg(low_margin)
-                # print 'max position:', max_position
-                # print 'contract.margin_low :', contract.margin_low
-                # print 'SAFE_PRICE :', SAFE_PRICE
-                # print 'position.reference_price :', position['reference_price']
-                # print position
-                if position['reference_price'] is None:
-                    if position['position'] != 0:
-                        raise MarginException("No reference price with non-zero position")
-
-                    reference_price = SAFE_PRICE
-                else:
-                    reference_price = position['reference_price']
-
-                # We divide by 100 because contract.margin_low and contract.margin_high are percentages from 0-100
-                low_max = abs(max_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                low_min = abs(min_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                high_max = abs(max_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                high_min = abs(min_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                # log.msg(low_max)
-                # log.msg(low_min)
-                log.msg("%s" % ["Margin:", contract.ticker, max_position, min_position, low_max, low_min, high_max, high_min])
-
-                high_margin += max(high_max, high_min)
-                low_margin += max(low_max, low_min)
-
-        if contract.contract_type == 'prediction':
-            payoff = contract.lot_size
-
-            # case where all our buy orders are hit
-            max_spent = sum(order.quantity_left * order.price * order.contract.lot_size / order.contract.denominator
-                            for order in open_orders if
-                            order.contract == contract and order.side == 'BUY')
-
-            # case where all our sell orders are hit
-            max_received = sum(order.quantity_left * order.price * order.contract.lot_size / order.contract.denominator
-                               for order in open_orders if
-                               order.contract == contract and order.side == 'SELL')
-
-            worst_short_cover = -min_position * payoff if min_position < 0 else 0
-            best_short_cover = -max_position * payoff if max_position < 0 else 0
-
-            additional_margin = max(max_spent + best_short_cover, -max_received + worst_short_cover)
-            low_margin += additional_margin
-            high_margin += additional_margin
+        # case where all our sell orders are hit
+        max_received = sum(order_value(order) for order in open_orders if
+                           order.contract == contract and order.side == 'SELL')
 
-        if contract.contract_type == 'cash':
-            cash_position[contract.ticker] = position['position']
+        low, high = position_margin(contract, position['position'], position['reference_price'],
+                                    max_position, min_position, max_spent, max_received, safe_prices)
+        low_margin += low
+        high_margin += high
 
     # Override cash position
     cash_position.update(cash_overrides)
 
     max_cash_spent = collections.defaultdict(int)
 
-    # Deal with cash_pair orders separately because there are no cash_pair positions
     for order in open_orders:
-        fees = util.get_fees(user, order.contract, order.price, order.quantity, trial_period=trial_period)
-        
-        if order.contract.contract_type == 'cash_pair':
-            transaction_size = util.get_cash_spent(order.contract, order.price, order.quantity)
-            
-            if order.side == 'BUY':
-                max_cash_spent[order.contract.denominated_contract.ticker] += transaction_size
-                if order.contract.payout_contract.ticker in fees:
-                    fees[order.contract.payout_contract.ticker] = max(0, fees[order.contract.payout_contract.ticker] - order.quantity_left)
-            if order.side == 'SELL':
-                max_cash_spent[order.contract.payout_contract.ticker] += order.quantity_left
-                if order.contract.denominated_contract.ticker in fees:
-                    fees[order.contract.denominated_contract.ticker] = max(0, fees[order.contract.denominated_contract.ticker] - transaction_size)
-
-        for ticker, fee in fees.iteritems():
-            max_cash_spent[ticker] += fee
+        for ticker, amount in order_cash_spent(user, order, trial_period=trial_period).iteritems():
+            max_cash_spent[ticker] += amount
 
     # Make sure max_cash_spent has something in it for every cash contract
     for ticker in cash_position.iterkeys():
@@ -168,20 +218,343 @@ def calculate_margin(user, session, safe_prices={}, order_id=None, withdrawals=N
             # for fee_ticker, fee in fees.iteritems():
             #     max_cash_spent[fee_ticker] += fee
 
-    for cash_ticker, max_spent in max_cash_spent.iteritems():
-        if cash_ticker == 'BTC':
-            additional_margin = max_spent
-        else:
-            if max_spent <= cash_position[cash_ticker]:
-                additional_margin = 0
-            else:
-                # TODO: We should fix this hack and just check max_cash_spent in check_margin
-                log.msg("max_spent (%d) > cash_position[%s] (%d)" % (max_spent, cash_ticker, cash_position[cash_ticker]))
-                additional_margin = 2**48
-
-        low_margin += additional_margin
-        high_margin += additional_margin
+    additional_margin = cash_margin(max_cash_spent, cash_position)
+    low_margin += additional_margin
+    high_margin += additional_margin
 
     return low_margin, high_margin, max_cash_spent
 
 
+def int_array(values, bound):
+    """
+    :param bound: a bound on anything the values are multiplied up to
+    :returns: numpy.array - of int64, or of python ints if the bound would overflow that
+    """
+    return numpy.array(values, dtype=numpy.int64 if bound < 2**63 else object)
+
+
+def calculate_margins(users, session, safe_prices={}, trial_period=False):
+    """
+    calculates the low and high margin for many users at once, as calculate_margin does
+    one at a time
+
+    Positions and open orders for all the users come in one query each and the
+    arithmetic is done on arrays, one element per order or position.
+
+    :param users: the users
+    :type users: list
+    :returns: dict - username to low and high margin and max_cash_spent, less the
+        zero entries for tickers the user has no cash position in
+    """
+    contracts = {contract.id: contract for contract in session.query(models.Contract)}
+    usernames = [user.username for user in users]
+    user_index = {username: i for i, username in enumerate(usernames)}
+    results = {}
+    if not usernames:
+        return results
+
+    positions = session.query(models.Position.username, models.Position.contract_id, models.Position.position,
+                              models.Position.reference_price).filter(
+        models.Position.username.in_(usernames)).all()
+    orders = session.query(models.Order.username, models.Order.contract_id, models.Order.side,
+                           models.Order.quantity, models.Order.quantity_left, models.Order.price).filter(
+        models.Order.username.in_(usernames)).filter(
+        models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True).all()
+
+    # Cash positions go in a users x tickers table, the rest get a row each
+    cash_tickers = sorted(contract.ticker for contract in contracts.itervalues()
+                          if contract.contract_type == 'cash')
+    cash_index = {ticker: i for i, ticker in enumerate(cash_tickers)}
+    cash_position = numpy.zeros((len(usernames), len(cash_tickers)), dtype=object)
+    held = numpy.zeros((len(usernames), len(cash_tickers)), dtype=bool)
+
+    rows = {}
+    row_position = []
+    row_reference_price = []
+    for username, contract_id, position, reference_price in positions:
+        contract = contracts[contract_id]
+        if contract.contract_type == 'cash':
+            cash_position[user_index[username], cash_index[contract.ticker]] = position or 0
+            held[user_index[username], cash_index[contract.ticker]] = True
+        elif contract.contract_type in ('futures', 'prediction'):
+            rows[username, contract_id] = len(row_position)
+            row_position.append(position or 0)
+            row_reference_price.append(reference_price)
+
+    # Make a blank position for all contracts which have an open order but no position
+    for username, contract_id, side, quantity, quantity_left, price in orders:
+        if contracts[contract_id].contract_type in ('futures', 'prediction') and (username, contract_id) not in rows:
+            rows[username, contract_id] = len(row_position)
+            row_position.append(0)
+            row_reference_price.append(None)
+
+    row_user = numpy.zeros(len(rows), dtype=numpy.int64)
+    row_contract = [None] * len(rows)
+    for (username, contract_id), row in rows.iteritems():
+        row_user[row] = user_index[username]
+        row_contract[row] = contracts[contract_id]
+
+    # Orders
+    order_contracts = [contracts[order.contract_id] for order in orders]
+    factors = {}
+    for user in users:
+        factors[user.username] = max(user.fees.aggressive_factor, user.fees.passive_factor)
+    quantity = [order.quantity for order in orders]
+    lot_size = [contract.lot_size for contract in order_contracts]
+    fees = [0 if trial_period else contract.fees for contract in order_contracts]
+    factor = [factors[order.username] for order in orders]
+    price = [order.price for order in orders]
+    bound = 1
+    for column in [quantity, lot_size, fees, factor, price]:
+        bound *= max(map(abs, column) or [0]) + 1
+
+    quantity = int_array(quantity, bound)
+    quantity_left = int_array([order.quantity_left for order in orders], bound)
+    price = int_array(price, bound)
+    lot_size = int_array(lot_size, bound)
+    denominator = int_array([contract.denominator for contract in order_contracts], bound)
+    payout_denominator = int_array([contract.payout_contract.denominator if contract.contract_type == 'cash_pair' else 1
+                                    for contract in order_contracts], bound)
+    fees = int_array(fees, bound)
+    factor = int_array(factor, bound)
+    buy = numpy.array([order.side == 'BUY' for order in orders], dtype=bool)
+    sell = numpy.array([order.side == 'SELL' for order in orders], dtype=bool)
+    cash_pair = numpy.array([contract.contract_type == 'cash_pair' for contract in order_contracts], dtype=bool)
+    order_user = numpy.array([user_index[order.username] for order in orders], dtype=numpy.int64)
+    order_row = numpy.array([rows.get((order.username, order.contract_id), -1) for order in orders],
+                            dtype=numpy.int64)
+
+    # util.get_cash_spent and util.get_fees
+    transaction_size = numpy.where(cash_pair, quantity * price // (denominator * payout_denominator),
+                                   quantity * price * lot_size // denominator)
+    fee = transaction_size * fees * factor // 100 // 10000
+
+    # order_cash_spent. The fee is charged in the denominated contract
+    denominated = numpy.array([cash_index.get(contract.denominated_contract.ticker, -1)
+                               for contract in order_contracts], dtype=numpy.int64)
+    payout = numpy.array([cash_index.get(contract.payout_contract.ticker, -1) if contract.contract_type == 'cash_pair'
+                          else -1 for contract in order_contracts], dtype=numpy.int64)
+    if not trial_period:
+        fee = numpy.where(buy & cash_pair & (payout == denominated), numpy.maximum(0, fee - quantity_left), fee)
+        fee = numpy.where(sell & cash_pair, numpy.maximum(0, fee - transaction_size), fee)
+    cash_spent = numpy.zeros((len(usernames), len(cash_tickers)), dtype=object)
+    spent = numpy.where(buy & cash_pair, transaction_size, 0) + fee
+    numpy.add.at(cash_spent, (order_user[denominated >= 0], denominated[denominated >= 0]), spent[denominated >= 0])
+    spent = sell & cash_pair & (payout >= 0)
+    numpy.add.at(cash_spent, (order_user[spent], payout[spent]), quantity_left[spent])
+
+    # Futures and prediction positions
+    in_row = order_row >= 0
+    value = quantity_left * price * lot_size // denominator
+    buy_quantity = numpy.zeros(len(rows), dtype=object)
+    sell_quantity = numpy.zeros(len(rows), dtype=object)
+    max_spent = numpy.zeros(len(rows), dtype=object)
+    max_received = numpy.zeros(len(rows), dtype=object)
+    numpy.add.at(buy_quantity, order_row[in_row & buy], quantity_left[in_row & buy])
+    numpy.add.at(sell_quantity, order_row[in_row & sell], quantity_left[in_row & sell])
+    numpy.add.at(max_spent, order_row[in_row & buy], value[in_row & buy])
+    numpy.add.at(max_received, order_row[in_row & sell], value[in_row & sell])
+
+    futures = numpy.array([contract.contract_type == 'futures' for contract in row_contract], dtype=bool)
+    priced = numpy.array([contract.ticker in safe_prices for contract in row_contract], dtype=bool)
+    for ticker in set(contract.ticker for contract in row_contract
+                      if contract.contract_type == 'futures' and contract.ticker not in safe_prices):
+        log.err("%s not in safe_prices, marking margin high" % ticker)
+
+    safe_price = [safe_prices.get(contract.ticker, 0) for contract in row_contract]
+    reference_price = []
+    for row, contract in enumerate(row_contract):
+        if row_reference_price[row] is not None:
+            reference_price.append(row_reference_price[row])
+        elif row_position[row] != 0 and contract.contract_type == 'futures' and contract.ticker in safe_prices:
+            raise MarginException("No reference price with non-zero position")
+        else:
+            reference_price.append(safe_price[row])
+
+    row_lot_size = [contract.lot_size for contract in row_contract]
+    margin_low = [contract.margin_low or 0 for contract in row_contract]
+    margin_high = [contract.margin_high or 0 for contract in row_contract]
+    position = row_position
+    bound = (max(map(abs, position) or [0]) + max(buy_quantity.max() if len(rows) else 0,
+                                                  sell_quantity.max() if len(rows) else 0) + 1)
+    bound *= max(margin_low + margin_high + [100]) * (max(map(abs, reference_price) or [0]) + max(safe_price or [0]) + 1)
+    bound *= max(row_lot_size or [0]) + 1
+
+    position = int_array(position, bound)
+    max_position = position + int_array(list(buy_quantity), bound)
+    min_position = position - int_array(list(sell_quantity), bound)
+    safe_price = int_array(safe_price, bound)
+    reference_price = int_array(reference_price, bound)
+    row_lot_size = int_array(row_lot_size, bound)
+    row_denominator = int_array([contract.denominator for contract in row_contract], bound)
+    margin_low = int_array(margin_low, bound)
+    margin_high = int_array(margin_high, bound)
+
+    # position_margin. We divide by 100 because margin_low and margin_high are percentages from 0-100
+    def futures_margin(margin, extreme_position):
+        return numpy.abs(extreme_position) * margin * safe_price * row_lot_size // row_denominator // 100 + \
+            extreme_position * (reference_price - safe_price) * row_lot_size // row_denominator
+
+    low = numpy.maximum(futures_margin(margin_low, max_position), futures_margin(margin_low, min_position))
+    high = numpy.maximum(futures_margin(margin_high, max_position), futures_margin(margin_high, min_position))
+    low = numpy.where(priced, low, 2**48)
+    high = numpy.where(priced, high, 2**48)
+
+    worst_short_cover = numpy.where(min_position < 0, -min_position * row_lot_size, 0)
+    best_short_cover = numpy.where(max_position < 0, -max_position * row_lot_size, 0)
+    prediction = numpy.maximum(max_spent + best_short_cover, -max_received + worst_short_cover)
+    low = numpy.where(futures, low, prediction)
+    high = numpy.where(futures, high, prediction)
+
+    low_margin = numpy.zeros(len(usernames), dtype=object)
+    high_margin = numpy.zeros(len(usernames), dtype=object)
+    numpy.add.at(low_margin, row_user, low)
+    numpy.add.at(high_margin, row_user, high)
+
+    # cash_margin
+    if 'BTC' in cash_index:
+        btc = cash_index['BTC']
+        short = (cash_spent > cash_position)
+        short[:, btc] = False
+        cash = short.sum(axis=1) * 2**48 + cash_spent[:, btc]
+    else:
+        cash = (cash_spent > cash_position).sum(axis=1) * 2**48
+    low_margin += cash
+    high_margin += cash
+
+    for i, username in enumerate(usernames):
+        max_cash_spent = collections.defaultdict(int)
+        for j, ticker in enumerate(cash_tickers):
+            if cash_spent[i, j] or held[i, j]:
+                max_cash_spent[ticker] = cash_spent[i, j]
+        results[username] = (int(low_margin[i]), int(high_margin[i]), max_cash_spent)
+
+    return results
+
+
+class MarginState:
+    """A user's open orders, summed up per contract
+
+    calculate_margin reloads every open order and walks them once per
+    position. This keeps the sums it needs in memory instead, updated as
+    orders are accepted, filled, amended and cancelled, so a margin check
+    costs one step per contract the user has a position or orders in,
+    however many orders are open, and no queries.
+
+    Each order's part is kept as well as the sums, so taking an order out
+    subtracts exactly what adding it put in and the result is the same as
+    calculate_margin's to the satoshi.
+    """
+    def __init__(self, user, trial_period=False):
+        self.user = user
+        self.trial_period = trial_period
+        # order id -> (contract, side, quantity_left, value, cash spent)
+        self.orders = {}
+        # contract -> [buy quantity, sell quantity, max_spent, max_received]
+        self.contracts = {}
+        self.cash_spent = collections.defaultdict(int)
+
+    def load(self, session):
+        for order in open_orders_query(session, self.user):
+            self.add_order(order)
+
+    def add_order(self, order):
+        contract = order.contract
+        value = order_value(order)
+        cash_spent = order_cash_spent(self.user, order, trial_period=self.trial_period)
+        self.orders[order.id] = (contract, order.side, order.quantity_left, value, cash_spent)
+
+        sums = self.contracts.setdefault(contract, [0, 0, 0, 0])
+        if order.side == 'BUY':
+            sums[0] += order.quantity_left
+            sums[2] += value
+        if order.side == 'SELL':
+            sums[1] += order.quantity_left
+            sums[3] += value
+        for ticker, amount in cash_spent.iteritems():
+            self.cash_spent[ticker] += amount
+
+    def remove_order(self, id):
+        if id not in self.orders:
+            return
+        contract, side, quantity_left, value, cash_spent = self.orders.pop(id)
+
+        sums = self.contracts[contract]
+        if side == 'BUY':
+            sums[0] -= quantity_left
+            sums[2] -= value
+        if side == 'SELL':
+            sums[1] -= quantity_left
+            sums[3] -= value
+        if not any(sums):
+            del self.contracts[contract]
+        for ticker, amount in cash_spent.iteritems():
+            self.cash_spent[ticker] -= amount
+
+    def update_order(self, order):
+        """
+        bring an order up to date after it has changed, whatever the change
+        :param order: the order
+        :type order: Order
+        """
+        self.remove_order(order.id)
+        if order.accepted and not order.is_cancelled and order.quantity_left > 0:
+            self.add_order(order)
+
+    def calculate(self, positions, safe_prices={}, order=None, withdrawals=None):
+        """
+        calculates the low and high margin, as calculate_margin does
+        :param positions: ticker -> {'position', 'reference_price', 'contract'}, as in position_overrides
+        :type positions: dict
+        :param order: an order not yet accepted we're considering throwing in
+        :type order: Order
+        :returns: tuple - low and high margin, and max_cash_spent
+        """
+        if order is not None and order.id not in self.orders:
+            self.add_order(order)
+            try:
+                return self.calculate(positions, safe_prices, withdrawals=withdrawals)
+            finally:
+                self.remove_order(order.id)
+
+        low_margin = high_margin = 0
+        cash_position = {}
+        contracts = set(self.contracts)
+        for position in positions.itervalues():
+            contract = position['contract']
+            if contract.contract_type == 'cash':
+                cash_position[contract.ticker] = position['position']
+                continue
+
+            contracts.discard(contract)
+            buy_quantity, sell_quantity, max_spent, max_received = self.contracts.get(contract, (0, 0, 0, 0))
+            low, high = position_margin(contract, position['position'], position['reference_price'],
+                                        position['position'] + buy_quantity, position['position'] - sell_quantity,
+                                        max_spent, max_received, safe_prices)
+            low_margin += low
+            high_margin += high
+
+        # Contracts with open orders but no position
+        for contract in contracts:
+            buy_quantity, sell_quantity, max_spent, max_received = self.contracts[contract]
+            low, high = position_margin(contract, 0, None, buy_quantity, -sell_quantity,
+                                        max_spent, max_received, safe_prices)
+            low_margin += low
+            high_margin += high
+
+        max_cash_spent = collections.defaultdict(int)
+        for ticker, amount in self.cash_spent.iteritems():
+            if amount:
+                max_cash_spent[ticker] = amount
+        for ticker in cash_position.iterkeys():
+            if ticker not in max_cash_spent:
+                max_cash_spent[ticker] = 0
+        if withdrawals:
+            for ticker, amount in withdrawals.iteritems():
+                max_cash_spent[ticker] += amount
+
+        additional_margin = cash_margin(max_cash_spent, cash_position)
+        low_margin += additional_margin
+        high_margin += additional_margin
+
+        return low_margin, high_margin, max_cash_spent
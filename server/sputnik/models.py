@@ -582,6 +582,35 @@ class Posting(db.Base, QuantityUI):
             self.timestamp = timestamp
         self.note = note
 
+class Balance(db.Base, QuantityUI):
+    """The sum of a user's postings in a contract, kept up to date by the ledger
+
+    It is written in the same transaction as the postings, so it always
+    agrees with them. journal_id and timestamp are those of the last
+    journal to change it.
+    """
+    __tablename__ = 'balances'
+    __table_args__ = {'extend_existing': True}
+
+    username = Column(String, ForeignKey('users.username'), primary_key=True)
+    user = relationship('User')
+    contract_id = Column(Integer, ForeignKey('contracts.id'), primary_key=True)
+    contract = relationship('Contract')
+    balance = Column(BigInteger, nullable=False, server_default="0")
+    journal_id = Column(Integer, ForeignKey('journal.id'))
+    timestamp = Column(DateTime)
+
+    @property
+    def quantity(self):
+        """Alias for the purpose of the UI functions
+
+        :returns: int
+        """
+        return self.balance
+
+    def __repr__(self):
+        return "<Balance('%s', '%s', %d)>" % (self.username, self.contract_id, self.balance)
+
 class Addresses(db.Base, QuantityUI):
     """
     Currency addresses for users, and how much has been accounted for
@@ -28,24 +28,123 @@ For now this just means pinging the accountant regularly to see if everyone's ma
 """
 
 
-from sqlalchemy.orm.exc import NoResultFound
 import models
 import database
 import margin
 import util
 from sendmail import Sendmail
-from accountant import AccountantProxy
+from accountant import AccountantProxy, shard_for_user
 
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
 from zmq_util import connect_subscriber
 import json
+from sqlalchemy import func
 from jinja2 import Environment, FileSystemLoader
 import time
 import sys
+import multiprocessing
+
+
+class MarginChecker:
+    """Works out users' margins and compares them with their cash
+
+    Users' BTC positions are read from the balances the ledger keeps. Given
+    a shard, only the users of that accountant are checked.
+    """
+    def __init__(self, session, shard=None, num_shards=None):
+        self.session = session
+        self.shard = shard
+        self.num_shards = num_shards
+
+        self.BTC = self.session.query(models.Contract).filter_by(ticker='BTC').one()
+
+    def get_users(self, usernames=None):
+        """
+        :param usernames: the users to check, None for everyone
+        :type usernames: set
+        :returns: list -- the active Liability users among them in this shard
+        """
+        users = self.session.query(models.User).filter_by(active=True).filter_by(type='Liability')
+        if usernames is not None:
+            usernames = list(usernames)
+        if self.shard is not None:
+            if usernames is None:
+                usernames = [username for (username,) in users.with_entities(models.User.username)]
+            usernames = [username for username in usernames
+                         if shard_for_user(username, self.num_shards) == self.shard]
+        if usernames is None:
+            return users.all()
+        if not usernames:
+            return []
+        return users.filter(models.User.username.in_(usernames)).all()
+
+    def check(self, users, safe_prices):
+        """
+        :returns: list -- (username, result, cash_position, low_margin, high_margin) for each user,
+            where result is OK, WARNING or CALL
+        """
+        margins = margin.calculate_margins(users, self.session, safe_prices)
+        cash_positions = dict(self.session.query(models.Balance.username, models.Balance.balance).filter_by(
+            contract_id=self.BTC.id).filter(
+            models.Balance.username.in_([user.username for user in users]))) if users else {}
+        results = []
+        for user in users:
+            low_margin, high_margin, cash_spent = margins[user.username]
+            cash_position = int(cash_positions.get(user.username, 0))
+            if cash_position < low_margin:
+                result = "CALL"
+            elif cash_position < high_margin:
+                result = "WARNING"
+            else:
+                result = "OK"
+            results.append((user.username, result, cash_position, low_margin, high_margin))
+
+        return results
+
+
+# The checker of a worker process
+worker = None
+
+def init_worker(shard, num_shards):
+    global worker
+    worker = MarginChecker(database.make_session(), shard, num_shards)
+
+def check_shard(safe_prices, usernames=None):
+    worker.session.expire_all()
+    try:
+        return worker.check(worker.get_users(usernames), safe_prices)
+    finally:
+        worker.session.rollback()
+
+
+class ShardedSweep:
+    """Runs the margin checks in a worker process per accountant
+
+    Each worker has its own session and checks the users of its
+    accountant, so a sweep takes as long as the largest shard.
+    """
+    def __init__(self, num_shards):
+        # A pool of one each, so a shard always goes to the same process
+        self.pools = [multiprocessing.Pool(1, init_worker, (shard, num_shards)) for shard in range(num_shards)]
+
+    def check(self, safe_prices, usernames=None):
+        """
+        :returns: Deferred -- the results of every shard, as MarginChecker.check
+        """
+        deferreds = [threads.deferToThread(pool.apply, check_shard, (safe_prices, usernames))
+                     for pool in self.pools]
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        return d.addCallback(lambda results: [result for shard in results for result in shard])
+
 
 class RiskManager():
-    def __init__(self, session, sendmail, safe_price_subscriber, accountant, admin_templates='admin_templates', nap_time_seconds=60):
+    def __init__(self, session, sendmail, safe_price_subscriber, accountant, admin_templates='admin_templates', nap_time_seconds=60,
+                 sweep=None):
+        """
+        :param sweep: the workers to check users in, None to check them here
+        :type sweep: ShardedSweep
+        """
         self.session = session
         self.nap_time_seconds = nap_time_seconds
         self.jinja_env = Environment(loader=FileSystemLoader(admin_templates))
@@ -55,10 +154,19 @@ class RiskManager():
         self.last_call_time = 0
         self.safe_price_subscriber.subscribe('')
         self.safe_price_subscriber.gotMessage = self.on_safe_prices
-        self.cash_positions = {}
-        self.timestamps = {}
+        self.sweep = sweep
+        self.sweeping = False
+        if sweep is None:
+            self.checker = MarginChecker(session)
         self.low_margin_users = {}
         self.bad_margin_users = {}
+        # The safe prices of the last check, and the highest posting and
+        #   order ids it had seen. Ids, not timestamps: postings reach the
+        #   ledger later than the time they carry.
+        self.safe_prices = {}
+        self.marks = None
+        # ticker -> usernames with a position or open order in it
+        self.exposure = {}
 
         self.BTC = self.session.query(models.Contract).filter_by(ticker='BTC').one()
 
@@ -88,59 +196,141 @@ class RiskManager():
                                     subject="Margin Call" if severe else "Margin Warning")
 
     def on_safe_prices(self, *args):
+        """Check the users the new safe prices could have put in trouble
+
+        Every nap_time_seconds all users are checked. In between, only those
+        with a position or open order in a contract whose safe price moved,
+        and those who traded or placed orders since the last check.
+        """
         this_call_time = time.time()
         safe_prices = json.loads(args[0])
         log.msg("Safe prices received: %s" % safe_prices)
-        # Don't run more than once per minute
+        if self.sweeping:
+            log.msg("Still checking the last safe prices")
+            return
+
+        self.session.expire_all()
+        usernames = None
+        marks = self.high_water_marks()
         if this_call_time - self.last_call_time > self.nap_time_seconds:
             self.last_call_time = this_call_time
+            self.index_exposure()
+        else:
+            moved = set(ticker for ticker in set(safe_prices) | set(self.safe_prices)
+                        if safe_prices.get(ticker) != self.safe_prices.get(ticker))
+            usernames = self.changed_users(self.marks, marks)
+            for ticker in moved:
+                usernames |= self.exposure.get(ticker, set())
+            log.msg("Safe prices moved for %s, checking %d users" % (sorted(moved), len(usernames)))
+            if not usernames:
+                self.safe_prices = safe_prices
+                self.marks = marks
+                return
+
+        self.safe_prices = safe_prices
+        self.marks = marks
+        self.check_users(usernames, safe_prices)
+
+    def high_water_marks(self):
+        """
+        :returns: tuple -- the highest posting id and order id so far
+        """
+        return (self.session.query(func.max(models.Posting.id)).scalar() or 0,
+                self.session.query(func.max(models.Order.id)).scalar() or 0)
+
+    def index_exposure(self):
+        """Rebuild the index from contract to the users with a position or open order in it
+        """
+        self.exposure = {}
+        positions = self.session.query(models.Position.username, models.Contract.ticker).filter(
+            models.Position.contract_id == models.Contract.id).filter(
+            models.Position.position != 0)
+        orders = self.session.query(models.Order.username, models.Contract.ticker).filter(
+            models.Order.contract_id == models.Contract.id).filter(
+            models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True)
+        for username, ticker in positions.union(orders):
+            self.exposure.setdefault(ticker, set()).add(username)
+
+    def changed_users(self, since, until):
+        """Find the users with postings or orders between two sets of high water marks, adding them to the index
 
+        :param since: the marks of the last check, None if there was none
+        :type since: tuple
+        :param until: the marks now
+        :type until: tuple
+        :returns: set -- their usernames
+        """
+        if since is None:
+            return set()
+
+        postings = self.session.query(models.Posting.username, models.Contract.ticker).filter(
+            models.Posting.contract_id == models.Contract.id).filter(
+            models.Posting.id > since[0]).filter(models.Posting.id <= until[0])
+        orders = self.session.query(models.Order.username, models.Contract.ticker).filter(
+            models.Order.contract_id == models.Contract.id).filter(
+            models.Order.id > since[1]).filter(models.Order.id <= until[1])
+        usernames = set()
+        for username, ticker in postings.union(orders):
+            self.exposure.setdefault(ticker, set()).add(username)
+            usernames.add(username)
+        return usernames
+
+    def check_users(self, usernames, safe_prices):
+        """
+        :param usernames: the users to check, None for everyone
+        :type usernames: set
+        """
+        if self.sweep is None:
+            self.handle_results(self.checker.check(self.checker.get_users(usernames), safe_prices))
+            return
+
+        def done(result):
+            self.sweeping = False
+            return result
 
-            self.session.expire_all()
-            for user in self.session.query(models.User).filter_by(active=True).filter_by(type='Liability'):
-                low_margin, high_margin, cash_spent = margin.calculate_margin(user, self.session, safe_prices)
-                try:
-                    cash_position_db = self.session.query(models.Position).filter_by(contract=self.BTC, user=user).one()
-                except NoResultFound:
-                    self.cash_positions[user.username] = 0
-                else:
-                    # Use calculated position
-                    if user.username in self.timestamps:
-                        self.cash_positions[user.username], self.timestamps[user.username] = \
-                            util.position_calculated(cash_position_db, self.session, checkpoint=self.cash_positions[user.username],
-                                                     start=self.timestamps[user.username])
-                    else:
-                        self.cash_positions[user.username], self.timestamps[user.username] = \
-                            util.position_calculated(cash_position_db, self.session)
-
-
-                if self.cash_positions[user.username] < low_margin:
-                    if user.username not in self.bad_margin_users:
-                        self.bad_margin_users[user.username] = datetime.datetime.utcnow()
-                        self.email_user(user, self.cash_positions[user.username], low_margin, high_margin, severe=True)
-
-                    d = self.accountant.liquidate_best(user.username)
-                    d.addErrback(log.err)
-                    result = "CALL"
-                elif self.cash_positions[user.username] < high_margin:
-                    if user.username not in self.low_margin_users:
-                        self.low_margin_users[user.username] = datetime.datetime.utcnow()
-                        self.email_user(user, self.cash_positions[user.username], low_margin, high_margin, severe=False)
-                    result = "WARNING"
-                else:
-                    if user.username in self.low_margin_users:
-                        del self.low_margin_users[user.username] # resolved
-                    if user.username in self.bad_margin_users:
-                        del self.bad_margin_users[user.username] # resolved
-                    result = "OK"
-
-                log.msg("%s: %s / %d %d %d" % (result, user.username, low_margin, high_margin,
-                                                     self.cash_positions[user.username]))
+        self.sweeping = True
+        d = self.sweep.check(safe_prices, usernames)
+        d.addCallback(self.handle_results)
+        d.addBoth(done)
+        d.addErrback(log.err)
+
+    def handle_results(self, results):
+        """Warn users low on margin and liquidate those below it
+
+        :param results: (username, result, cash_position, low_margin, high_margin) for each user checked
+        :type results: list
+        """
+        for username, result, cash_position, low_margin, high_margin in results:
+            if result == "CALL":
+                if username not in self.bad_margin_users:
+                    self.bad_margin_users[username] = datetime.datetime.utcnow()
+                    self.email_user(util.get_user(self.session, username), cash_position, low_margin, high_margin, severe=True)
+
+                d = self.accountant.liquidate_best(username)
+                d.addErrback(log.err)
+            elif result == "WARNING":
+                if username not in self.low_margin_users:
+                    self.low_margin_users[username] = datetime.datetime.utcnow()
+                    self.email_user(util.get_user(self.session, username), cash_position, low_margin, high_margin, severe=False)
+            else:
+                if username in self.low_margin_users:
+                    del self.low_margin_users[username] # resolved
+                if username in self.bad_margin_users:
+                    del self.bad_margin_users[username] # resolved
+
+            log.msg("%s: %s / %d %d %d" % (result, username, low_margin, high_margin, cash_position))
 
 
 if __name__ == "__main__":
     log.startLogging(sys.stdout)
 
+    # Start the workers before this process has any connections to share
+    sweep = None
+    if config.getboolean("riskmanager", "sharded_sweep"):
+        num_procs = config.getint("accountant", "num_procs")
+        sweep = ShardedSweep(num_procs)
+        reactor.suggestThreadPoolSize(max(10, num_procs))
+
     session = database.make_session()
 
     safe_price_subscriber = connect_subscriber(config.get("safe_price_forwarder", "zmq_backend_address"))
@@ -150,6 +340,6 @@ if __name__ == "__main__":
                                  config.get("accountant", "riskmanager_export"),
                                  config.getint("accountant", "riskmanager_export_base_port"))
 
-    riskmanager = RiskManager(session, sendmail, safe_price_subscriber, accountant)
+    riskmanager = RiskManager(session, sendmail, safe_price_subscriber, accountant, sweep=sweep)
 
     reactor.run()
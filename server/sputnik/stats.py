@@ -0,0 +1,148 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+"""
+Latency histograms for the methods wrapped by util.timed.
+
+Each process has one registry. Timings are kept in microseconds, in
+buckets whose width doubles with every power of two, so a histogram stays
+a few dozen counters however many calls it has seen and any percentile is
+accurate to within one part in sub_buckets. Counts, such as batch sizes,
+can be kept the same way.
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class Histogram(object):
+    def __init__(self, sub_buckets=32, scale=1000.0, unit="ms"):
+        # Values below sub_buckets are counted exactly
+        self.sub_buckets = sub_buckets
+        # stats are divided by scale, microseconds to ms by default
+        self.scale = scale
+        self.unit = unit
+        self.sub_bits = sub_buckets.bit_length() - 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        """
+        :returns: int -- the lowest value in value's bucket
+        """
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.sub_bits - 1
+        return (value >> shift) << shift
+
+    def top(self, bucket):
+        """
+        :returns: int -- the highest value in the bucket
+        """
+        if bucket < self.sub_buckets:
+            return bucket
+        return bucket + (1 << (bucket.bit_length() - self.sub_bits - 1)) - 1
+
+    def record(self, value):
+        value = int(value)
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        :param fraction: e.g. 0.99 for the p99
+        :type fraction: float
+        :returns: int -- the top of the bucket holding that fraction of values, None when empty
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.top(bucket), self.max)
+        return self.max
+
+    @property
+    def stats(self):
+        """
+        :returns: dict -- the call count and the mean and percentile values, in ms for times
+        """
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count,
+                "mean": self.total / self.scale / self.count,
+                "min": self.min / self.scale,
+                "p50": self.percentile(0.5) / self.scale,
+                "p90": self.percentile(0.9) / self.scale,
+                "p99": self.percentile(0.99) / self.scale,
+                "p999": self.percentile(0.999) / self.scale,
+                "max": self.max / self.scale}
+
+
+class Registry(object):
+    def __init__(self, name=None):
+        # Goes before each line logged, to tell registries in one process apart
+        self.name = name
+        self.histograms = {}
+
+    def histogram(self, name, **kwargs):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(**kwargs)
+        return histogram
+
+    def record(self, name, microseconds):
+        self.histogram(name).record(microseconds)
+
+    def record_count(self, name, count):
+        """
+        Record a count, such as a batch size, which is shown as it is rather than in ms.
+        """
+        self.histogram(name, scale=1.0, unit="").record(count)
+
+    @property
+    def stats(self):
+        return dict((name, histogram.stats) for name, histogram in self.histograms.iteritems())
+
+    def reset(self):
+        self.histograms.clear()
+
+    def log_stats(self, reset=True):
+        """
+        Log a line per method for the calls since the last reset.
+        """
+        for name, stats in sorted(self.stats.iteritems()):
+            unit = self.histograms[name].unit
+            if self.name is not None:
+                name = "%s %s" % (self.name, name)
+            log.msg("%s: %d calls, mean %.1f%s, p50 %.1f%s, p99 %.1f%s, p999 %.1f%s, max %.1f%s." %
+                    (name, stats["count"], stats["mean"], unit, stats["p50"], unit, stats["p99"], unit,
+                     stats["p999"], unit, stats["max"], unit))
+        if reset:
+            self.reset()
+
+    def start_logging(self, interval=600):
+        def regular_log():
+            self.log_stats()
+            reactor.callLater(interval, regular_log)
+
+        reactor.callLater(interval, regular_log)
+
+
+registry = Registry()
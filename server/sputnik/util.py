@@ -21,9 +21,13 @@ from sqlalchemy import func
 from twisted.python import log
 import twisted.python.util
 import models
-from zmq_util import ComponentExport
+import stats
+from zmq_util import ComponentExport, dealer_proxy_async
+import config
 from sqlalchemy.orm.session import Session
 import hashlib
+import weakref
+from collections import OrderedDict
 from decimal import Decimal
 
 #
@@ -63,11 +67,19 @@ def get_locale_template(locale, jinja_env, template):
     return t
 
 def timed(f):
+    """
+    Record how long each call takes in the histogram for f's name, in the
+    stats_registry of the object f is a method of if it has one, otherwise
+    in stats.registry. A Deferred result is timed until it is returned, not
+    until it fires.
+    """
     def wrapped(*args, **kwargs):
         start = time.time()
         result = f(*args, **kwargs)
-        stop = time.time()
-        log.msg("%s completed in %dms." % (f.__name__, (stop - start) * 1000))
+        registry = getattr(args[0], "stats_registry", None) if args else None
+        if registry is None:
+            registry = stats.registry
+        registry.record(f.__name__, (time.time() - start) * 1000000)
         return result
     return wrapped
 
@@ -242,6 +254,95 @@ def get_withdraw_fees(user, contract, withdraw_amount, trial_period=False):
     return {contract.ticker: final_fee}
 
 
+class IdentityCache:
+    """
+    Users, contracts and fee groups already looked up in a session, by
+    username, ticker or id, so a lookup does not query the database every
+    time. Each kind holds at most size entries, least recently used first
+    out.
+
+    The cached objects stay in the session, which still refreshes them
+    after a commit or rollback. A change to a contract, fee group or a
+    user's fee group has to be followed by invalidate, as reload_contract,
+    reload_fee_group and change_fee_group do.
+    """
+    kinds = ["user", "contract", "fee_group"]
+
+    def __init__(self, session, size=10000):
+        self.session = session
+        self.size = size
+        self.entries = dict((kind, OrderedDict()) for kind in self.kinds)
+        self.hits = dict((kind, 0) for kind in self.kinds)
+        self.misses = dict((kind, 0) for kind in self.kinds)
+
+    def get(self, kind, key, load):
+        """
+        :param load: called to look the object up on a miss, a None result is not cached
+        :type load: function
+        """
+        entries = self.entries[kind]
+        value = entries.pop(key, None)
+        if value is not None and value in self.session:
+            self.hits[kind] += 1
+        else:
+            self.misses[kind] += 1
+            value = load()
+            if value is None:
+                return None
+            if len(entries) >= self.size:
+                entries.popitem(last=False)
+        entries[key] = value
+        return value
+
+    def invalidate(self, kind, key=None):
+        """
+        Forget one object, or every object of the kind when key is None.
+        """
+        if key is None:
+            self.entries[kind].clear()
+        else:
+            self.entries[kind].pop(key, None)
+
+    @property
+    def stats(self):
+        return dict((kind, {"size": len(self.entries[kind]),
+                            "hits": self.hits[kind],
+                            "misses": self.misses[kind]}) for kind in self.kinds)
+
+
+identity_caches = weakref.WeakKeyDictionary()
+
+def get_identity_cache(session):
+    """
+    :returns: IdentityCache -- the one cache for this session
+    """
+    cache = identity_caches.get(session)
+    if cache is None:
+        cache = identity_caches[session] = IdentityCache(session)
+    return cache
+
+def get_user(session, username):
+    """
+    Return the User object corresponding to the username.
+    :param session: the sqlalchemy session to use
+    :param username: the username to look up
+    :type username: str, models.User
+    :returns: models.User -- the User matching the username
+    :raises: NoResultFound
+    """
+    if isinstance(username, models.User):
+        return username
+
+    return get_identity_cache(session).get("user", username, lambda: session.query(models.User).filter_by(
+        username=username).one())
+
+def get_fee_group(session, id):
+    """
+    :raises: NoResultFound
+    """
+    return get_identity_cache(session).get("fee_group", id, lambda: session.query(models.FeeGroup).filter_by(
+        id=id).one())
+
 def get_contract(session, ticker):
     """
     Return the Contract object corresponding to the ticker.
@@ -252,33 +353,91 @@ def get_contract(session, ticker):
     :raises: AccountantException
     """
 
-    # TODO: memoize this!
-
     if isinstance(ticker, models.Contract):
         return ticker
 
     try:
-        ticker = int(ticker)
-        return session.query(models.Contract).filter_by(
-            id=ticker).one()
-    except NoResultFound:
-        raise Exception("Could not resolve contract '%s'." % ticker)
+        key = int(ticker)
     except ValueError:
-        # drop through
-        pass
+        key = ticker
+
+    def load():
+        if isinstance(key, int):
+            try:
+                return session.query(models.Contract).filter_by(
+                    id=key).one()
+            except NoResultFound:
+                raise Exception("Could not resolve contract '%s'." % key)
 
-    try:
         return session.query(models.Contract).filter_by(
-            ticker=ticker).order_by(models.Contract.id.desc()).first()
-    except NoResultFound:
-        raise Exception("Could not resolve contract '%s'." % ticker)
+            ticker=key).order_by(models.Contract.id.desc()).first()
+
+    return get_identity_cache(session).get("contract", key, load)
+
+def get_engine_hosts():
+    """
+    Read which contracts share an engine host process. [engine] engines
+    lists the engine processes, comma separated; tickers joined with "+"
+    run in one host, which listens on the ports of the first of them that
+    is active, so that an expired contract can stay in the list.
+
+    :returns: dict -- ticker to the tickers on its host, for hosted contracts
+    """
+    hosts = {}
+    if config.has_option("engine", "engines"):
+        for entry in config.get("engine", "engines").split(","):
+            tickers = [ticker.strip() for ticker in entry.split("+") if ticker.strip()]
+            if len(tickers) > 1:
+                for ticker in tickers:
+                    hosts[ticker] = tickers
+    return hosts
+
+def connect_engines(base_port, contract_ids, timeout=1):
+    """
+    Make a proxy for the engine of each contract. Contracts on the same
+    engine host share one connection and their calls are routed by ticker.
+
+    :param base_port: the engine port of the contract with id 0
+    :type base_port: int
+    :param contract_ids: ticker to contract id of the active contracts
+    :type contract_ids: dict
+    :returns: dict -- ticker to proxy
+    """
+    hosts = get_engine_hosts()
+    connections = {}
+    engines = {}
+    for ticker, id in contract_ids.iteritems():
+        if ticker not in hosts:
+            engines[ticker] = dealer_proxy_async("tcp://127.0.0.1:%d" % (base_port + int(id)),
+                                                 timeout=timeout)
+            continue
+
+        # ticker itself is active, so there is at least one
+        port_ticker = [hosted for hosted in hosts[ticker] if hosted in contract_ids][0]
+        port = base_port + int(contract_ids[port_ticker])
+        if port not in connections:
+            connections[port] = dealer_proxy_async("tcp://127.0.0.1:%d" % port, timeout=timeout)
+        engines[ticker] = connections[port].routed(ticker)
+    return engines
 
 def position_calculated(position, session, checkpoint=None, start=None, end=None):
+    """The position as the ledger has it, and the time of the last journal to change it
+
+    Up to now this is a lookup in the balances the ledger keeps. Up to an
+    earlier end, or when there is no balance yet (a database from before
+    the balances were kept), it is the checkpoint plus the postings since start.
+    """
     if start is None:
         start = position.position_cp_timestamp or timestamp_to_dt(0)
     if checkpoint is None:
         checkpoint = position.position_checkpoint or 0
 
+    if end is None:
+        balance = session.query(models.Balance).filter_by(username=position.username,
+                                                          contract_id=position.contract_id).first()
+        if balance is not None:
+            return int(balance.balance), balance.timestamp
+
     rows = session.query(func.sum(models.Posting.quantity).label('quantity_sum'),
                          func.max(models.Journal.timestamp).label('last_timestamp')).filter_by(
         username=position.username).filter_by(
@@ -16,6 +16,7 @@ import config
 from alerts import AlertsProxy
 import database
 import models
+import util
 
 
 class WatchdogExport(object):
@@ -76,10 +77,18 @@ if __name__ == "__main__":
         watchdogs[name].run()
 
     engine_base_port = config.getint("watchdog", "engine_base_port")
-    for contract in session.query(models.Contract).filter_by(active=True).all():
+    engine_hosts = util.get_engine_hosts()
+    contracts = session.query(models.Contract).filter_by(active=True).all()
+    active_tickers = set(contract.ticker for contract in contracts)
+    for contract in contracts:
         if contract.contract_type != "cash":
-            watchdogs[contract.ticker] = Watchdog(contract.ticker, config.get("watchdog", "engine") % (engine_base_port +
-                                                                                          int(contract.id)), proxy)
-            watchdogs[contract.ticker].run()
+            # An engine host answers on the port of its first active contract
+            tickers = engine_hosts.get(contract.ticker, [contract.ticker])
+            if contract.ticker != [ticker for ticker in tickers if ticker in active_tickers][0]:
+                continue
+            name = "+".join(tickers)
+            watchdogs[name] = Watchdog(name, config.get("watchdog", "engine") % (engine_base_port +
+                                                                                int(contract.id)), proxy)
+            watchdogs[name].run()
 
     reactor.run()
@@ -254,6 +254,7 @@ if __name__ == "__main__":
                "sputnik.webserver.plugins.backend.accountant.AccountantProxy",
                "sputnik.webserver.plugins.backend.cashier.CashierProxy",
                "sputnik.webserver.plugins.backend.alerts.AlertsProxy",
+               "sputnik.webserver.plugins.backend.engine.EngineProxy",
                "sputnik.webserver.plugins.rpc.registrar.RegistrarService",
                "sputnik.webserver.plugins.rpc.token.TokenService",
                "sputnik.webserver.plugins.rpc.info.InfoService",
@@ -0,0 +1,34 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from sputnik import config
+from sputnik import observatory
+
+debug, log, warn, error, critical = observatory.get_loggers("engine_proxy")
+
+from sputnik.webserver.plugin import BackendPlugin
+from sputnik.util import connect_engines
+from twisted.internet.defer import inlineCallbacks
+
+class EngineProxy(BackendPlugin):
+    def __init__(self):
+        BackendPlugin.__init__(self)
+        self.engines = {}
+
+    @inlineCallbacks
+    def init(self):
+        yield BackendPlugin.init(self)
+
+        self.db = self.require("sputnik.webserver.plugins.db.postgres.PostgresDatabase")
+        contract_ids = yield self.db.get_contract_ids()
+        self.engines = connect_engines(config.getint("engine", "accountant_base_port"),
+                                       contract_ids)
+
+    def get_book_snapshot(self, ticker):
+        return self.engines[ticker].get_book_snapshot()
+
@@ -103,6 +103,11 @@ class PostgresDatabase(DatabasePlugin):
         contracts = [r[0] for r in result]
         returnValue(contracts)
 
+    @inlineCallbacks
+    def get_contract_ids(self):
+        result = yield self.dbpool.runQuery("SELECT ticker, id FROM contracts WHERE active IS TRUE")
+        returnValue(dict(result))
+
     @inlineCallbacks
     def load_contract(self, ticker):
         res = yield self.dbpool.runQuery("SELECT ticker, description, denominator, contract_type, full_description,"
@@ -173,11 +178,15 @@ class PostgresDatabase(DatabasePlugin):
 
     @inlineCallbacks
     def get_transaction_history(self, from_timestamp, to_timestamp, username):
+        # The balances at the start are the current ones less what was posted since
         result = yield self.dbpool.runQuery(
-            "SELECT contracts.ticker, SUM(posting.quantity) FROM posting, journal, contracts "
-            "WHERE posting.journal_id=journal.id AND posting.username=%s AND journal.timestamp<%s "
-            "AND posting.contract_id=contracts.id GROUP BY contracts.ticker",
-            (username, util.timestamp_to_dt(from_timestamp)))
+            "SELECT contracts.ticker, balances.balance - COALESCE(since.quantity, 0) "
+            "FROM balances JOIN contracts ON balances.contract_id=contracts.id "
+            "LEFT JOIN (SELECT posting.contract_id, SUM(posting.quantity) AS quantity FROM posting, journal "
+            "WHERE posting.journal_id=journal.id AND posting.username=%s AND journal.timestamp>=%s "
+            "GROUP BY posting.contract_id) AS since ON since.contract_id=balances.contract_id "
+            "WHERE balances.username=%s",
+            (username, util.timestamp_to_dt(from_timestamp), username))
 
         balances = collections.defaultdict(int)
         for row in result:
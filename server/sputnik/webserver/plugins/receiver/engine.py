@@ -17,18 +17,102 @@ from sputnik.zmq_util import export, pull_share_async
 class EngineReceiver(ReceiverPlugin):
     def __init__(self):
         ReceiverPlugin.__init__(self)
+        # Books rebuilt from the engines' deltas, by ticker
+        self.books = {}
+        self.sequences = {}
+        # Deltas held back while waiting on a snapshot, by ticker
+        self.pending = {}
 
     @export
     def book(self, ticker, book):
         log("Got 'book' for %s / %s" % (ticker, book))
-        self.emit("book", ticker, book)
+        if "sequence" in book:
+            # A full push always wins, the engine may have restarted
+            self.load_book(ticker, book)
+        else:
+            self.emit("book", ticker, book)
+
+    @export
+    def book_delta(self, ticker, delta):
+        debug("Got 'book_delta' for %s / %s" % (ticker, delta))
+        if ticker in self.pending:
+            self.pending[ticker].append(delta)
+            return
+
+        if ticker not in self.sequences or not self.apply_delta(ticker, delta):
+            self.resync(ticker, [delta])
+            return
+
+        self.emit("book", ticker, self.wire_book(ticker))
 
     @export
     def safe_prices(self, ticker, price):
         log("Got safe price for %s: %s" % (ticker, price))
         self.emit("safe_prices", ticker, price)
 
+    def load_book(self, ticker, book):
+        self.books[ticker] = {side: {row["price"]: row["quantity"] for row in book[side]}
+                              for side in ["bids", "asks"]}
+        self.sequences[ticker] = book["sequence"]
+
+        deltas = sorted(self.pending.pop(ticker, []), key=lambda delta: delta["sequence"])
+        for i, delta in enumerate(deltas):
+            if not self.apply_delta(ticker, delta):
+                self.resync(ticker, deltas[i:])
+                return
+
+        self.emit("book", ticker, self.wire_book(ticker))
+
+    def apply_delta(self, ticker, delta):
+        """Apply a delta to the book, returning False if an update was missed."""
+        sequence = self.sequences[ticker]
+        if delta["sequence"] <= sequence:
+            # Already covered by the snapshot
+            return True
+        if delta["sequence"] != sequence + 1:
+            return False
+
+        for side in ["bids", "asks"]:
+            levels = self.books[ticker][side]
+            for row in delta[side]:
+                if row["quantity"]:
+                    levels[row["price"]] = row["quantity"]
+                else:
+                    levels.pop(row["price"], None)
+
+        self.sequences[ticker] = delta["sequence"]
+        return True
+
+    def resync(self, ticker, deltas):
+        warn("Book for %s out of sequence, requesting a snapshot." % ticker)
+        self.pending[ticker] = deltas
+
+        def loaded(book):
+            # Drop it if a full push got here first
+            if ticker in self.pending:
+                self.load_book(ticker, book)
+
+        def failed(failure):
+            error("Unable to get a book snapshot for %s." % ticker)
+            error(failure)
+            # The next delta will try again
+            self.pending.pop(ticker, None)
+            self.sequences.pop(ticker, None)
+
+        d = self.engine.get_book_snapshot(ticker)
+        d.addCallbacks(loaded, failed)
+
+    def wire_book(self, ticker):
+        bids = self.books[ticker]["bids"]
+        asks = self.books[ticker]["asks"]
+        return {"contract": ticker,
+                "bids": [{"price": price, "quantity": bids[price]}
+                         for price in sorted(bids, reverse=True)],
+                "asks": [{"price": price, "quantity": asks[price]}
+                         for price in sorted(asks)]}
+
     def init(self):
+        self.engine = self.require("sputnik.webserver.plugins.backend.engine.EngineProxy")
         self.share = pull_share_async(self,
                 config.get("webserver", "engine_export"))
 
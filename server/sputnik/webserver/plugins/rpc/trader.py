@@ -49,6 +49,36 @@ class TraderService(ServicePlugin):
         result = yield self.accountant.proxy.place_order(username, order)
         returnValue(result)
 
+    @wamp.register(u"rpc.trader.place_orders")
+    @error_handler
+    @authenticated
+    @schema(u"public/trader.json#place_orders")
+    def place_orders(self, orders, username=None):
+        """
+        Places several orders in one call to the accountant
+        :returns: Deferred -- a result per order, in order
+        :param orders: the orders to place
+        """
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        results = [None] * len(orders)
+        valid = []
+        for i, order in enumerate(orders):
+            # Check for zero price or quantity
+            if order["price"] == 0 or order["quantity"] == 0:
+                results[i] = {"success": False, "error": ("exceptions/webserver/invalid_price_quantity",)}
+                continue
+
+            order["timestamp"] = timestamp
+            order['username'] = username
+            valid.append(i)
+
+        if valid:
+            placed = yield self.accountant.proxy.place_orders(username, [orders[i] for i in valid])
+            for i, result in zip(valid, placed):
+                results[i] = result
+
+        returnValue(results)
+
     @wamp.register(u"rpc.trader.request_support_nonce")
     @error_handler
     @authenticated
@@ -316,6 +346,40 @@ class TraderService(ServicePlugin):
         result = yield self.accountant.proxy.cancel_order(username, id)
         returnValue(result)
 
+    @wamp.register(u"rpc.trader.amend_order")
+    @error_handler
+    @authenticated
+    @schema(u"public/trader.json#amend_order")
+    def amend_order(self, id, price, quantity, username=None):
+        """
+        Changes the price and quantity of an order, keeping its place in
+        the queue if it only gets smaller
+        :returns: Deferred
+        :param id: order_id of the order
+        :param price: the new price
+        :param quantity: the new total quantity
+        """
+        # Check for zero price or quantity
+        if price == 0 or quantity == 0:
+            raise WebserverException("exceptions/webserver/invalid_price_quantity")
+
+        result = yield self.accountant.proxy.amend_order(username, id, price, quantity)
+        returnValue(result)
+
+    @wamp.register(u"rpc.trader.cancel_orders")
+    @error_handler
+    @authenticated
+    @schema(u"public/trader.json#cancel_orders")
+    def cancel_orders(self, ids, username=None):
+        """
+        Cancels several orders in one call to the accountant
+        :returns: Deferred -- a result per order, in order
+        :param ids: ids of the orders
+        """
+
+        results = yield self.accountant.proxy.cancel_orders(username, ids)
+        returnValue(results)
+
     @inlineCallbacks
     def register(self, endpoint, procedure = None, options = None):
         results = yield ServicePlugin.register(self, endpoint, procedure, options=RegisterOptions(details_arg="details", discloseCaller=True))
@@ -8,6 +8,7 @@
 
 import inspect
 import json
+import copy
 import zmq
 import uuid
 import time
@@ -236,6 +237,50 @@ class AsyncRouterExport(AsyncExport):
         d.addCallbacks(result, exception)
         d.addCallback(complete)
 
+class AsyncRoutedRouterExport(AsyncRouterExport):
+    def __init__(self, routes, connection):
+        """
+        Shares one object per route on a single socket. Each message names
+        the object it is for in its "route" field, see Proxy.routed.
+
+        :param routes: dict -- route to the object to share on it
+        :param connection:
+        """
+        self.routes = dict((route, AsyncExport(wrapped)) for route, wrapped in routes.iteritems())
+        self.connection = connection
+        self.connection.gotMessage = self.gotMessage
+        self.counter = 0
+
+    def decode(self, message):
+        """
+
+        :param message:
+        :returns: tuple -- "route:method", args and kwargs
+        :raise RemoteCallException:
+        """
+        try:
+            route = json.loads(message).get("route", None)
+        except:
+            raise RemoteCallException("Invalid JSON received.")
+
+        export = self.routes.get(route, None)
+        if export is None:
+            raise RemoteCallException("Route not found: %s" % route)
+
+        method_name, args, kwargs = export.decode(message)
+        return "%s:%s" % (route, method_name), args, kwargs
+
+    def dispatch(self, method_name, args, kwargs):
+        """
+
+        :param method_name: "route:method"
+        :param args:
+        :param kwargs:
+        :returns: maybeDeferred
+        """
+        route, method_name = method_name.rsplit(":", 1)
+        return self.routes[route].dispatch(method_name, args, kwargs)
+
 class SyncPullExport(SyncExport):
     def __init__(self, wrapped, connection):
         """
@@ -342,6 +387,16 @@ def router_share_async(obj, address):
     socket = ZmqREPConnection(ZmqFactory(), ZmqEndpoint("bind", address))
     return AsyncRouterExport(obj, socket)
 
+def router_share_routed_async(routes, address):
+    """
+
+    :param routes: dict -- route to the object to share on it
+    :param address:
+    :returns: AsyncRoutedRouterExport
+    """
+    socket = ZmqREPConnection(ZmqFactory(), ZmqEndpoint("bind", address))
+    return AsyncRoutedRouterExport(routes, socket)
+
 def pull_share_async(obj, address):
     """
 
@@ -379,6 +434,9 @@ def pull_share_sync(obj, address):
         spe.process(socket.recv_multipart())
 
 class Proxy:
+    # Set on proxies made by routed()
+    _route = None
+
     def __init__(self, connection):
         """
 
@@ -386,6 +444,18 @@ class Proxy:
         """
         self._connection = connection
 
+    def routed(self, route):
+        """
+        A proxy on the same connection whose calls go to the object shared
+        on route, see router_share_routed_async.
+
+        :param route:
+        :returns: Proxy
+        """
+        proxy = copy.copy(self)
+        proxy._route = route
+        return proxy
+
     def decode(self, message):
         """
 
@@ -450,7 +520,10 @@ class Proxy:
         debug("Encoding message...")
         debug("method=%s, args=%s, kwargs=%s" % (method_name, args, kwargs))
 
-        return json.dumps({"method":method_name, "args":args, "kwargs":kwargs})
+        message = {"method":method_name, "args":args, "kwargs":kwargs}
+        if self._route is not None:
+            message["route"] = self._route
+        return json.dumps(message)
 
     def __getattr__(self, key):
         """
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+"""
+Drives engine2.Engine with synthetic order flow and reports orders per
+second and p50/p99/p999 latency for each operation, once on a bare engine
+and once with the engine's standard listeners attached.
+
+Flows:
+    walk    orders around a mid price that random walks, some crossing,
+            with the odd cancel
+    mm      market makers cancelling and replacing their quotes, with the
+            occasional taker
+    sweep   a deep book refilled between aggressive orders that take out
+            several levels at once
+    storm   a deep book, then every order on it cancelled in random order
+
+The listeners are the journal, accountant, webserver (in delta mode) and
+safe price notifiers, sending to sinks that drop everything. The logging
+listener is left out: it prints the whole book on every change.
+
+To gate a change, save a baseline from the old tree and compare the new
+one against it. The run fails if any throughput falls, or any p99 rises,
+by more than the tolerance.
+
+Usage: python bench_engine.py [-n orders] [-f flow] [-s seed]
+                              [--save file] [--baseline file] [--tolerance 0.2]
+"""
+
+import sys
+import os
+import json
+import random
+import shutil
+import tempfile
+import timeit
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+options = sys.argv[1:]
+# engine2 parses the command line when it is imported
+sys.argv = sys.argv[:1]
+
+from test_sputnik import fix_config
+fix_config()
+
+from twisted.python import log
+from twisted.internet import reactor
+from sputnik.engine2 import Engine, Order, OrderSide, JournalListener, \
+    AccountantNotifier, WebserverNotifier, SafePriceNotifier
+
+clock = timeit.default_timer
+
+
+class Contract:
+    id = 1
+    ticker = "BENCH"
+
+
+class Sink:
+    """
+    Stands in for the accountant, webserver and forwarder, accepting any
+    call and dropping it.
+    """
+
+    def __getattr__(self, name):
+        return self.drop
+
+    def drop(self, *args, **kwargs):
+        pass
+
+
+class Flow:
+    """
+    Builds the steps of a flow: ("place", order arguments) or
+    ("cancel", id). Tracks which of its orders may still be resting so
+    cancels mostly hit live orders; a few will have traded away first.
+    """
+
+    def __init__(self, seed, mid=10000):
+        self.rng = random.Random(seed)
+        self.mid = mid
+        self.next_id = 0
+        self.steps = []
+        self.live = []
+
+    def place(self, price, side, quantity, username="user0"):
+        self.next_id += 1
+        self.steps.append(("place", dict(id=self.next_id, contract=Contract.id,
+                                         quantity=quantity, price=price, side=side,
+                                         username=username, timestamp=self.next_id)))
+        self.live.append(self.next_id)
+        return self.next_id
+
+    def cancel(self, id=None):
+        if id is None:
+            if not self.live:
+                return
+            index = self.rng.randrange(len(self.live))
+            self.live[index], self.live[-1] = self.live[-1], self.live[index]
+            id = self.live.pop()
+        else:
+            self.live.remove(id)
+        self.steps.append(("cancel", id))
+
+    def fill(self, depth, levels=50):
+        for i in range(depth):
+            side = self.rng.choice([OrderSide.BUY, OrderSide.SELL])
+            self.place(self.mid + side * self.rng.randrange(1, levels), side,
+                       self.rng.randrange(1, 10), "maker%d" % self.rng.randrange(20))
+
+
+def random_walk(count, seed):
+    flow = Flow(seed)
+    while len(flow.steps) < count:
+        flow.mid += flow.rng.choice([-1, 1])
+        if flow.rng.random() < 0.1:
+            flow.cancel()
+            continue
+        side = flow.rng.choice([OrderSide.BUY, OrderSide.SELL])
+        offset = int(flow.rng.gauss(5, 5))
+        flow.place(flow.mid + side * offset, side, flow.rng.randrange(1, 10),
+                   "user%d" % flow.rng.randrange(100))
+    return flow.steps
+
+
+def market_maker(count, seed, makers=10):
+    flow = Flow(seed)
+    quotes = {}
+    for maker in range(makers):
+        for side in [OrderSide.BUY, OrderSide.SELL]:
+            quotes[maker, side] = flow.place(flow.mid + side * (maker + 1), side, 10,
+                                             "maker%d" % maker)
+
+    while len(flow.steps) < count:
+        if flow.rng.random() < 0.05:
+            side = flow.rng.choice([OrderSide.BUY, OrderSide.SELL])
+            flow.place(flow.mid - side * makers, side, flow.rng.randrange(1, 20), "taker")
+            continue
+        maker = flow.rng.randrange(makers)
+        side = flow.rng.choice([OrderSide.BUY, OrderSide.SELL])
+        if quotes[maker, side] in flow.live:
+            flow.cancel(quotes[maker, side])
+        flow.mid += flow.rng.choice([-1, 0, 0, 1])
+        quotes[maker, side] = flow.place(flow.mid + side * (maker + 1), side, 10,
+                                         "maker%d" % maker)
+    return flow.steps
+
+
+def sweep(count, seed, depth=200):
+    flow = Flow(seed)
+    while len(flow.steps) < count:
+        flow.fill(depth)
+        side = flow.rng.choice([OrderSide.BUY, OrderSide.SELL])
+        flow.place(flow.mid - side * 50, side, 5 * depth, "sweeper")
+        # Whatever is left of the book or the sweep is cancelled next round
+        while flow.live:
+            flow.cancel()
+    return flow.steps[:count]
+
+
+def cancel_storm(count, seed):
+    flow = Flow(seed)
+    flow.fill(count / 2)
+    while flow.live:
+        flow.cancel()
+    return flow.steps
+
+
+flows = [("walk", random_walk), ("mm", market_maker), ("sweep", sweep),
+         ("storm", cancel_storm)]
+
+
+def attach_listeners(engine, journal_dir):
+    contract = Contract()
+    sink = Sink()
+    engine.add_listener(JournalListener(engine, contract, journal_dir, reg_snapshot=False))
+    engine.add_listener(AccountantNotifier(engine, sink, contract))
+    engine.add_listener(WebserverNotifier(engine, sink, contract, reg_publish=False, deltas=True))
+    engine.add_listener(SafePriceNotifier(None, engine, sink, sink, sink, contract))
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run(steps, listeners):
+    engine = Engine()
+    journal_dir = None
+    if listeners:
+        journal_dir = tempfile.mkdtemp()
+        attach_listeners(engine, journal_dir)
+
+    # Orders are built up front so only the engine is timed
+    work = []
+    for action, argument in steps:
+        if action == "place":
+            work.append((engine.place_order, Order(**argument), "place"))
+        else:
+            work.append((engine.cancel_order, argument, "cancel"))
+
+    latencies = {"place": [], "cancel": []}
+    start = clock()
+    for operation, argument, action in work:
+        before = clock()
+        operation(argument)
+        if listeners:
+            # The end of the reactor turn, where batched fills go out
+            reactor.runUntilCurrent()
+        latencies[action].append(clock() - before)
+    elapsed = clock() - start
+
+    if journal_dir is not None:
+        shutil.rmtree(journal_dir)
+
+    results = {"orders/s": len(work) / elapsed}
+    for action, times in latencies.items():
+        if not times:
+            continue
+        times.sort()
+        results[action] = {"count": len(times),
+                           "p50": percentile(times, 0.5),
+                           "p99": percentile(times, 0.99),
+                           "p999": percentile(times, 0.999)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a line for every figure which regressed past the tolerance.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result["orders/s"] < old["orders/s"] * (1 - tolerance):
+            regressions.append("%s: %.0f orders/s, was %.0f" % (name, result["orders/s"], old["orders/s"]))
+        for action in ["place", "cancel"]:
+            if action in result and action in old and \
+                    result[action]["p99"] > old[action]["p99"] * (1 + tolerance):
+                regressions.append("%s %s: p99 %.1fus, was %.1fus" % (
+                    name, action, result[action]["p99"] * 1e6, old[action]["p99"] * 1e6))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--orders", dest="orders", type="int", default=20000,
+                      help="operations per flow")
+    parser.add_option("-f", "--flow", dest="flows", action="append", default=None,
+                      help="flow to run, may be repeated (walk, mm, sweep, storm)")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=0)
+    parser.add_option("--save", dest="save", default=None,
+                      help="write the results to this file")
+    parser.add_option("--baseline", dest="baseline", default=None,
+                      help="compare against results saved earlier")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.2)
+    (opts, args) = parser.parse_args(options)
+
+    # Keep the engine's logging off the clock
+    log.theLogPublisher.observers[:] = []
+
+    print "%d operations per flow" % opts.orders
+    print "%-16s %10s %8s %10s %10s %10s" % ("", "orders/s", "op", "p50 us", "p99 us", "p999 us")
+    results = {}
+    for name, flow in flows:
+        if opts.flows and name not in opts.flows:
+            continue
+        steps = flow(opts.orders, opts.seed)
+        for listeners in [False, True]:
+            label = name + (" +listeners" if listeners else "")
+            result = run(steps, listeners)
+            results[label] = result
+            first = True
+            for action in ["place", "cancel"]:
+                if action not in result:
+                    continue
+                print "%-16s %10s %8s %10.1f %10.1f %10.1f" % (
+                    label if first else "", "%.0f" % result["orders/s"] if first else "",
+                    "%s x%d" % (action, result[action]["count"]), result[action]["p50"] * 1e6,
+                    result[action]["p99"] * 1e6, result[action]["p999"] * 1e6)
+                first = False
+
+    if opts.save:
+        with open(opts.save, "w") as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), opts.tolerance)
+        if regressions:
+            print "Regressed more than %d%%:" % (opts.tolerance * 100)
+            for regression in regressions:
+                print "  " + regression
+            sys.exit(1)
+        print "No regressions beyond %d%%." % (opts.tolerance * 100)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+"""
+Compares the slotted engine2.Order against the __dict__ based class it
+replaced: bytes per order, time to build orders, time to sort them by
+priority, and orders per second through the engine.
+
+Usage: python bench_order.py [orders] [levels]
+"""
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+options = sys.argv[1:]
+# engine2 parses the command line when it is imported
+sys.argv = sys.argv[:1]
+
+from test_sputnik import fix_config
+fix_config()
+
+from sputnik import util
+from sputnik.engine2 import Engine, Order
+from datetime import datetime
+
+
+class LegacyOrder:
+    """
+    The Order the engine used before it was slotted, kept here as the
+    benchmark baseline.
+    """
+
+    def __init__(self, id=None, contract=None, quantity=None,
+                 quantity_left=None, price=None, side=None, username=None,
+                 timestamp=None):
+        self.id = id
+        self.contract = contract
+        self.quantity = quantity
+        self.quantity_left = quantity
+        self.price = price
+        self.side = side
+        self.username = username
+        if timestamp is not None:
+            self.timestamp = timestamp
+        else:
+            self.timestamp = util.dt_to_timestamp(datetime.utcnow())
+
+    @property
+    def priority(self):
+        # The book needs the key, the legacy class builds it every time
+        return (self.side * self.price, self.timestamp)
+
+    def matchable(self, other):
+        if self.side == other.side:
+            return False
+        return (self.price - other.price) * self.side <= 0
+
+    def __lt__(self, other):
+        if self.side is not other.side:
+            raise Exception("Orders are not comparable.")
+
+        return (self.side * self.price, self.timestamp) < (other.side * other.price, other.timestamp)
+
+
+def make_specs(count, levels, seed=0):
+    """
+    Order arguments around a mid of 10000: bids below, asks above, with one
+    in ten crossing so the engine does some matching.
+    """
+    rng = random.Random(seed)
+    specs = []
+    for i in range(count):
+        side = rng.choice([-1, 1])
+        offset = rng.randrange(1, levels)
+        if rng.random() < 0.1:
+            offset = -offset
+        specs.append(dict(id=i + 1, contract=1, quantity=rng.randrange(1, 10),
+                          price=10000 + side * offset, side=side,
+                          username="user%d" % rng.randrange(100), timestamp=i))
+    return specs
+
+
+def order_size(order):
+    size = sys.getsizeof(order)
+    if hasattr(order, "__dict__"):
+        size += sys.getsizeof(order.__dict__)
+    else:
+        # The slotted order keeps its priority key alive
+        size += sys.getsizeof(order.priority)
+    return size
+
+
+def run(order_class, specs):
+    results = {}
+
+    start = time.time()
+    orders = [order_class(**spec) for spec in specs]
+    results["build"] = time.time() - start
+
+    results["bytes"] = sum(order_size(order) for order in orders) / float(len(orders))
+
+    asks = [order for order in orders if order.side == 1]
+    start = time.time()
+    sorted(asks)
+    results["sort"] = time.time() - start
+
+    orders = [order_class(**spec) for spec in specs]
+    engine = Engine()
+    start = time.time()
+    for order in orders:
+        engine.place_order(order)
+    results["engine"] = time.time() - start
+
+    return results
+
+
+if __name__ == "__main__":
+    count = int(options[0]) if len(options) > 0 else 100000
+    levels = int(options[1]) if len(options) > 1 else 500
+
+    specs = make_specs(count, levels)
+    print "%d orders over %d levels a side" % (count, levels)
+    print "%-8s %10s %10s %10s %14s" % ("", "bytes", "build", "sort", "engine")
+    results = {}
+    for name, order_class in [("legacy", LegacyOrder), ("slotted", Order)]:
+        results[name] = run(order_class, specs)
+        print "%-8s %10.0f %9.3fs %9.3fs %9.0f ops/s" % (name, results[name]["bytes"], results[name]["build"],
+                                                       results[name]["sort"], count / results[name]["engine"])
+
+    print "memory: %.1fx smaller" % (results["legacy"]["bytes"] / results["slotted"]["bytes"])
+    print "engine: %.2fx faster" % (results["legacy"]["engine"] / results["slotted"]["engine"])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+"""
+Compares the price-level order book in engine2 against the heap of Orders it
+replaced, under a cancel-heavy market maker workload: a deep resting book
+where most operations cancel a quote and replace it at a nearby price, with
+the occasional fill off the top of the book.
+
+Usage: python bench_orderbook.py [resting_orders] [operations] [levels]
+"""
+
+import sys
+import os
+import time
+import heapq
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+options = sys.argv[1:]
+# engine2 parses the command line when it is imported
+sys.argv = sys.argv[:1]
+
+from test_sputnik import fix_config
+fix_config()
+
+from sputnik.engine2 import Order, OrderBookSide, OrderSide
+
+
+class HeapBookSide:
+    """
+    The heap of Orders the engine used before price levels, kept here as the
+    benchmark baseline.
+    """
+
+    def __init__(self, side):
+        self.side = side
+        self.heap = []
+
+    def best(self):
+        if not self.heap:
+            return None
+        return self.heap[0]
+
+    def push(self, order):
+        heapq.heappush(self.heap, order)
+
+    def pop(self):
+        return heapq.heappop(self.heap)
+
+    def remove(self, order):
+        self.heap.remove(order)
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+
+def make_workload(resting, operations, levels, seed=0):
+    """
+    Returns the initial resting orders and a list of (action, argument)
+    steps. Orders are all asks so nothing crosses.
+    """
+    rng = random.Random(seed)
+    next_id = [0]
+    timestamp = [0]
+
+    def new_order():
+        next_id[0] += 1
+        timestamp[0] += 1
+        return Order(id=next_id[0], contract="BENCH", quantity=1,
+                     price=1000 + rng.randrange(levels), side=OrderSide.SELL,
+                     timestamp=timestamp[0])
+
+    initial = [new_order() for i in range(resting)]
+    live = list(initial)
+    steps = []
+    for i in range(operations):
+        if rng.random() < 0.05:
+            # A fill off the top of the book, replaced by a fresh quote
+            index = min(range(len(live)), key=lambda i: (live[i].price, live[i].timestamp))
+            steps.append(("pop", live[index].id))
+        else:
+            index = rng.randrange(len(live))
+            steps.append(("cancel", live[index].id))
+        live[index] = live[-1]
+        live.pop()
+        order = new_order()
+        steps.append(("push", order))
+        live.append(order)
+
+    return initial, steps
+
+
+def run(book_class, initial, steps):
+    book = book_class(OrderSide.SELL)
+    orders = {}
+    for order in initial:
+        book.push(order)
+        orders[order.id] = order
+
+    start = time.time()
+    for action, argument in steps:
+        if action == "cancel":
+            book.remove(orders.pop(argument))
+        elif action == "pop":
+            order = book.pop()
+            assert order.id == argument
+            del orders[order.id]
+        else:
+            book.push(argument)
+            orders[argument.id] = argument
+        book.best()
+    elapsed = time.time() - start
+
+    return elapsed, len(book)
+
+
+if __name__ == "__main__":
+    resting = int(options[0]) if len(options) > 0 else 2000
+    operations = int(options[1]) if len(options) > 1 else 5000
+    levels = int(options[2]) if len(options) > 2 else 200
+
+    print "%d resting orders over %d levels, %d cancel/replace operations" % (resting, levels, operations)
+    results = {}
+    for name, book_class in [("heap", HeapBookSide), ("levels", OrderBookSide)]:
+        initial, steps = make_workload(resting, operations, levels)
+        elapsed, remaining = run(book_class, initial, steps)
+        results[name] = elapsed
+        print "%-8s %8.3fs %10.0f ops/s (%d resting)" % (name, elapsed, len(steps) / elapsed, remaining)
+
+    print "speedup: %.1fx" % (results["heap"] / results["levels"])
@@ -31,16 +31,42 @@ from sputnik.exception import AccountantException
 class FakeEngine(FakeComponent):
     name = "engine"
 
+    def __init__(self):
+        FakeComponent.__init__(self)
+        # id -> username of the orders placed and not cancelled
+        self.resting = {}
+
     def place_order(self, order):
         self._log_call('place_order', order)
+        self.resting[order.id] = order.username
         # Always return a good fake result
         return defer.succeed(order.id)
 
     def cancel_order(self, id):
         self._log_call('cancel_order', id)
+        self.resting.pop(id, None)
         # Always return success, with None
         return defer.succeed(None)
 
+    def amend_order(self, id, price, quantity):
+        self._log_call('amend_order', id, price, quantity)
+        return defer.succeed(True)
+
+    def cancel_all(self, username=None):
+        self._log_call('cancel_all', username)
+        ids = sorted(id for id, owner in self.resting.iteritems() if username is None or owner == username)
+        for id in ids:
+            del self.resting[id]
+        return defer.succeed(ids)
+
+    def place_orders(self, orders):
+        self._log_call('place_orders', orders)
+        return defer.succeed([True for order in orders])
+
+    def cancel_orders(self, ids):
+        self._log_call('cancel_orders', ids)
+        return defer.succeed([True for id in ids])
+
 
 class FakeLedger(FakeComponent):
     name = "ledger"
@@ -67,8 +93,7 @@ class FakeWebserverNotifier():
     def __init__(self, ticker):
         self.ticker = ticker
 
-    @property
-    def wire_book(self):
+    def wire_book(self, depth=None):
         return defer.succeed({"contract": self.ticker,
                  "bids": [{"quantity": 1,
                            "price": 1}],
@@ -109,7 +134,8 @@ class TestAccountantBase(TestSputnik):
                                                     debug=True,
                                                     trial_period=False,
                                                     sendmail=FakeSendmail('test-email@m2.io'),
-                                                    template_dir="../server/sputnik/admin_templates",                                                    
+                                                    template_dir="../server/sputnik/admin_templates",
+                                                    verify_margin=True,
                                                     )
             self.accountant.accountant_proxy = FakeAccountantProxy(self.accountant)
             self.cashier_export = accountant.CashierExport(self.accountant)
@@ -417,6 +443,145 @@ class TestCashierExport(TestAccountant):
         self.assertEqual(position, 10)
 
 
+class TestPositionCache(TestAccountant):
+    def setUp(self):
+        TestAccountant.setUp(self)
+        from sputnik import accountant
+
+        self.create_account('test')
+        self.user = self.get_user('test')
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.accountant.positions = accountant.PositionCache(self.session, flush_interval=1)
+
+    def test_write_behind(self):
+        self.create_position('BTC', 10)
+
+        position = self.accountant.get_position('test', 'BTC')
+        position.position += 5
+        self.accountant.positions.touch(position)
+        mxn = self.accountant.get_position('test', 'MXN')
+        mxn.position = 7
+        self.accountant.positions.touch(mxn)
+
+        self.assertEqual(self.accountant.get_position_value('test', 'BTC'), 15)
+        self.session.expire_all()
+        self.assertEqual(self.get_position('BTC').position, 10)
+
+        self.clock.advance(1)
+        self.session.expire_all()
+        self.assertEqual(self.get_position('BTC').position, 15)
+        self.assertEqual(self.get_position('MXN').position, 7)
+        self.assertEqual(self.accountant.positions.dirty, set())
+
+    def test_pending_postings_written_through(self):
+        from sputnik import ledger
+
+        self.create_position('BTC', 10)
+        self.create_position('MXN', 0)
+        mxn = self.accountant.get_position('test', 'MXN')
+        mxn.position = 7
+        self.accountant.positions.touch(mxn)
+        posted = defer.Deferred()
+        self.accountant.ledger = FakeComponent("ledger")
+        self.accountant.ledger.post = lambda *postings: posted
+        posting = ledger.create_posting("Transfer", 'test', 'BTC', 5, 'credit')
+        d = self.accountant.post_or_fail(posting)
+
+        # On disk before the ledger has the posting, and nothing else is
+        self.session.expire_all()
+        self.assertEqual(self.get_position('BTC').pending_postings, 1)
+        self.assertEqual(self.get_position('MXN').position, 0)
+
+        posted.callback(True)
+        self.successResultOf(d)
+        self.assertEqual(self.accountant.get_position('test', 'BTC').pending_postings, 0)
+        self.session.expire_all()
+        self.assertEqual(self.get_position('BTC').pending_postings, 1)
+        self.clock.advance(1)
+        self.session.expire_all()
+        self.assertEqual(self.get_position('BTC').pending_postings, 0)
+        self.assertEqual(self.get_position('BTC').position, 15)
+        self.assertEqual(self.get_position('MXN').position, 7)
+
+    def test_pending_postings_new_position(self):
+        from sputnik import ledger
+
+        self.accountant.ledger = FakeComponent("ledger")
+        self.accountant.ledger.post = lambda *postings: defer.Deferred()
+        self.accountant.post_or_fail(ledger.create_posting("Transfer", 'test', 'MXN', 5, 'credit'))
+        self.session.expire_all()
+        self.assertEqual(self.get_position('MXN').pending_postings, 1)
+        self.assertEqual(self.accountant.positions.dirty, set())
+
+    def test_pending_postings_write_failure(self):
+        from sputnik import ledger
+
+        self.accountant.positions.write_pending = lambda positions: False
+        self.accountant.ledger = FakeComponent("ledger")
+        self.accountant.post_or_fail(ledger.create_posting("Transfer", 'test', 'BTC', 5, 'credit'))
+        self.assertTrue(self.alerts_proxy.check_for_calls([("send_alert", ("Exception in ledger. See logs.",), {})]))
+
+    def test_overloaded_retry(self):
+        from sputnik import ledger
+
+        self.create_position('BTC', 10)
+        self.accountant.ledger = ledger.AccountantExport(ledger.Ledger(self.session.bind.engine, 5000,
+                                                                       max_pending_groups=1))
+        blocker = [dict(ledger.create_posting("Transfer", username, 'MXN', 1, direction), uid="blocker", count=2)
+                   for username, direction in [('test', 'credit'), ('onlinecash', 'debit')]]
+        mine, theirs = [dict(ledger.create_posting("Transfer", username, 'BTC', 5, direction), uid="foo", count=2)
+                        for username, direction in [('test', 'credit'), ('onlinecash', 'debit')]]
+        self.accountant.ledger.post(blocker[0])
+
+        # Our side is refused while the table is full
+        d = self.accountant.post_or_fail(mine)
+        self.assertNoResult(d)
+        self.assertEqual(self.accountant.get_position('test', 'BTC').pending_postings, 1)
+
+        # The other side is admitted once there is room, and ours joins it
+        self.accountant.ledger.post(blocker[1])
+        theirs_posted = self.accountant.ledger.post(theirs)
+        self.clock.advance(1)
+        self.successResultOf(d)
+        self.assertTrue(self.successResultOf(theirs_posted))
+        position = self.accountant.get_position('test', 'BTC')
+        self.assertEqual(position.position, 15)
+        self.assertEqual(position.pending_postings, 0)
+        self.assertFalse(self.alerts_proxy.check_for_calls([("send_alert",
+            ("Ledger is overloaded and refusing postings. See logs.",), {})]))
+        self.flushLoggedErrors()
+
+    def test_overloaded_gives_up(self):
+        from sputnik import ledger
+
+        self.accountant.ledger_retries = 2
+        self.accountant.ledger = ledger.AccountantExport(ledger.Ledger(self.session.bind.engine, 5000,
+                                                                       max_pending_groups=1))
+        self.accountant.ledger.post(dict(ledger.create_posting("Transfer", 'test', 'MXN', 1, 'credit'),
+                                         uid="blocker", count=2))
+        d = self.accountant.post_or_fail(dict(ledger.create_posting("Transfer", 'test', 'BTC', 5, 'credit'),
+                                              uid="foo", count=2))
+        self.clock.advance(1)
+        self.assertNoResult(d)
+        self.clock.advance(2)
+        self.assertEqual(self.failureResultOf(d, ledger.LedgerException).value.args, ledger.OVERLOADED.args)
+        self.assertTrue(self.alerts_proxy.check_for_calls([("send_alert",
+            ("Ledger is overloaded and refusing postings. See logs.",), {})]))
+        self.assertEqual(self.accountant.get_position('test', 'BTC').pending_postings, 0)
+        self.flushLoggedErrors()
+
+    def test_load_from_ledger(self):
+        # The table says 50 but nothing was ever posted
+        self.create_position('BTC', 50)
+
+        self.accountant.positions.load('test', from_ledger=True)
+        self.assertEqual(self.accountant.get_position_value('test', 'BTC'), 0)
+        self.clock.advance(1)
+        self.session.expire_all()
+        self.assertEqual(self.get_position('BTC').position, 0)
+
+
 class TestAdministratorExport(TestAccountant):
     def test_change_fee_group(self):
         self.create_account('test', '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
@@ -426,6 +591,32 @@ class TestAdministratorExport(TestAccountant):
         test = self.get_user('test')
         self.assertEqual(test.fees.id, id)
 
+    def test_cache_stats(self):
+        self.create_account('test', '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        from sputnik import models
+        id = self.session.query(models.FeeGroup.id).filter_by(name='MarketMaker').one().id
+
+        user = self.accountant.get_user('test')
+        self.assertIs(self.accountant.get_user('test'), user)
+        self.assertEqual(self.administrator_export.get_cache_stats(None)['user'],
+                         {'size': 1, 'hits': 1, 'misses': 1})
+
+        # Changing the fee group drops the user
+        self.administrator_export.change_fee_group('test', id)
+        self.assertEqual(self.accountant.get_user('test').fees.id, id)
+        self.assertEqual(self.administrator_export.get_cache_stats(None)['user']['misses'], 2)
+
+        self.accountant.get_contract('BTC')
+        self.administrator_export.reload_contract(None, 'BTC')
+        self.accountant.get_contract('BTC')
+        self.assertEqual(self.administrator_export.get_cache_stats(None)['contract']['misses'], 2)
+
+    def test_get_stats(self):
+        self.create_account('test', '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        before = self.administrator_export.get_stats(None).get("cancel_orders", {}).get("count", 0)
+        self.accountant.cancel_orders('test', [1000])
+        self.assertEqual(self.administrator_export.get_stats(None)["cancel_orders"]["count"], before + 1)
+
     def test_reload_fee_group(self):
         from sputnik import models
         id = self.session.query(models.FeeGroup.id).filter_by(name='MarketMaker').one().id
@@ -504,6 +695,11 @@ class TestAdministratorExport(TestAccountant):
                 self.assertEquals(long_orders, [])
                 self.assertEquals(short_orders, [])
 
+                # One engine call for each user's orders
+                self.assertEqual(sorted(entry for entry in self.engines['NETS2015'].component.log
+                                        if entry[0] == 'cancel_all'),
+                                 [('cancel_all', ('long_account',), {}), ('cancel_all', ('short_account',), {})])
+
             d.addCallback(on_clear)
             return d
 
@@ -827,8 +1023,8 @@ class TestEngineExport(TestAccountant):
         dl.addCallback(onSuccess)
         return dl
 
-    def test_post_transaction(self):
-        from sputnik import util, models
+    def create_trade(self):
+        from sputnik import util
         import datetime
 
         self.create_account("aggressive_user", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
@@ -887,34 +1083,63 @@ class TestEngineExport(TestAccountant):
                    'uid': uid,
                    'timestamp': timestamp}
 
-        d1 = self.engine_export.post_transaction('aggressive_user', aggressive)
-        d2 = self.engine_export.post_transaction('passive_user', passive)
+        return aggressive, passive
 
-        def onSuccess(result):
-            # Inspect the positions
-            BTC = self.session.query(models.Contract).filter_by(ticker='BTC').one()
-            MXN = self.session.query(models.Contract).filter_by(ticker='MXN').one()
-            aggressive_user_btc_position = self.session.query(models.Position).filter_by(username='aggressive_user',
-                                                                                         contract=BTC).one()
-            passive_user_btc_position = self.session.query(models.Position).filter_by(username='passive_user',
-                                                                                      contract=BTC).one()
-            aggressive_user_mxn_position = self.session.query(models.Position).filter_by(username='aggressive_user',
-                                                                                         contract=MXN).one()
-            passive_user_mxn_position = self.session.query(models.Position).filter_by(username='passive_user',
-                                                                                      contract=MXN).one()
+    def check_trade_positions(self):
+        from sputnik import models
 
-            # This is based on all BTC fees being zero
-            self.assertEqual(aggressive_user_btc_position.position, 2000000)
-            self.assertEqual(passive_user_btc_position.position, 400000000 + 3000000)
+        # Inspect the positions
+        BTC = self.session.query(models.Contract).filter_by(ticker='BTC').one()
+        MXN = self.session.query(models.Contract).filter_by(ticker='MXN').one()
+        aggressive_user_btc_position = self.session.query(models.Position).filter_by(username='aggressive_user',
+                                                                                     contract=BTC).one()
+        passive_user_btc_position = self.session.query(models.Position).filter_by(username='passive_user',
+                                                                                  contract=BTC).one()
+        aggressive_user_mxn_position = self.session.query(models.Position).filter_by(username='aggressive_user',
+                                                                                     contract=MXN).one()
+        passive_user_mxn_position = self.session.query(models.Position).filter_by(username='passive_user',
+                                                                                  contract=MXN).one()
+
+        # This is based on all BTC fees being zero
+        self.assertEqual(aggressive_user_btc_position.position, 2000000)
+        self.assertEqual(passive_user_btc_position.position, 400000000 + 3000000)
+
+        # This is based on 100bps MXN fee charged to both sides (see test_sputnik.py)
+        self.assertEqual(aggressive_user_mxn_position.position, round(1800000 * 0.99) + 500000)
+        self.assertEqual(passive_user_mxn_position.position, round(3000000 - 1800000 * 1.01))
 
-            # This is based on 100bps MXN fee charged to both sides (see test_sputnik.py)
-            self.assertEqual(aggressive_user_mxn_position.position, round(1800000 * 0.99) + 500000)
-            self.assertEqual(passive_user_mxn_position.position, round(3000000 - 1800000 * 1.01))
+    def test_post_transaction(self):
+        aggressive, passive = self.create_trade()
+        d1 = self.engine_export.post_transaction('aggressive_user', aggressive)
+        d2 = self.engine_export.post_transaction('passive_user', passive)
 
         dl = defer.DeferredList([d1, d2])
-        dl.addCallback(onSuccess)
+        dl.addCallback(lambda result: self.check_trade_positions())
         return dl
 
+    def test_post_transactions(self):
+        from sputnik import models
+
+        aggressive, passive = self.create_trade()
+        posts = []
+        post = self.accountant.ledger.post
+
+        def counted_post(*postings):
+            posts.append(postings)
+            return post(*postings)
+
+        self.accountant.ledger.post = counted_post
+        d = self.engine_export.post_transactions(None, [aggressive, passive])
+
+        def check(result):
+            self.check_trade_positions()
+            # Both sides share the fill's uid: one call for their postings,
+            #   one for the fee postings sent to the vendors' accountant
+            self.assertEqual(len(posts), 2)
+            self.assertEqual(self.session.query(models.Trade).filter_by(posted=True).count(), 1)
+
+        return d.addCallback(check)
+
     """
     # Not implemented yet
     def test_safe_prices(self):
@@ -1282,6 +1507,234 @@ class TestWebserverExport(TestAccountant):
             d.addCallbacks(cancelSuccess, cancelFail)
             return d
 
+    def test_amend_order(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        id = self.webserver_export.place_order('test', {'username': 'test',
+                                                        'contract': 'BTC/MXN',
+                                                        'price': 1000000,
+                                                        'quantity': 3000000,
+                                                        'side': 'SELL',
+                                                        'timestamp': util.dt_to_timestamp(datetime.datetime.utcnow())})
+
+        # More than we have
+        with self.assertRaisesRegexp(AccountantException, 'insufficient_margin'):
+            self.webserver_export.amend_order('test', id, 1100000, 6000000)
+
+        def onAmended(result):
+            self.assertTrue(result)
+
+            from sputnik import models
+
+            order = self.session.query(models.Order).filter_by(id=id).one()
+            self.assertEqual(order.price, 1100000)
+            self.assertEqual(order.quantity, 2000000)
+            self.assertEqual(order.quantity_left, 2000000)
+            self.assertTrue(self.engines['BTC/MXN'].component.check_for_calls([('amend_order',
+                                                                                (id, 1100000, 2000000),
+                                                                                {})]))
+
+        d = self.webserver_export.amend_order('test', id, 1100000, 2000000)
+        d.addCallback(onAmended)
+        return d
+
+    def test_margin_state(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.cashier_export.deposit_cash("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        def place(side, quantity, price):
+            return self.webserver_export.place_order('test', {'username': 'test',
+                                                              'contract': 'BTC/MXN',
+                                                              'price': price,
+                                                              'quantity': quantity,
+                                                              'side': side,
+                                                              'timestamp': util.dt_to_timestamp(
+                                                                  datetime.datetime.utcnow())})
+
+        sell = place('SELL', 2000000, 1000000)
+        place('BUY', 1000000, 900000)
+        user = self.accountant.get_user('test')
+        state = self.accountant.margin_states['test']
+        self.assertEqual(len(state.orders), 2)
+
+        def check(result):
+            # Every check above went through verification too
+            self.assertFalse(self.alerts_proxy.log)
+            low, high, cash_spent = self.accountant.calculate_margin_incremental(user)
+            self.assertEqual((low, high), self.accountant.calculate_margin(user)[:2])
+            self.assertEqual(cash_spent['BTC'], 3000000)
+
+        d = self.webserver_export.amend_order('test', sell, 1000000, 3000000)
+        d.addCallback(check)
+        return d
+
+    def test_place_orders(self):
+        # The accountant talks to the engine over zmq, where the batch comes back as one Deferred
+        self.engines['BTC/MXN'] = FakeEngine()
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        orders = [{'username': 'test',
+                   'contract': 'BTC/MXN',
+                   'price': price,
+                   'quantity': 2000000,
+                   'side': 'SELL',
+                   'timestamp': timestamp} for price in [1000000, 1100000, 1200000]]
+
+        # The third order goes over the 5000000 we have
+        results = self.successResultOf(self.webserver_export.place_orders('test', orders))
+        self.assertEqual([result['success'] for result in results], [True, True, False])
+        self.assertEqual(results[2]['error'], accountant.INSUFFICIENT_MARGIN.args)
+
+        from sputnik import models
+
+        ids = [result['result'] for result in results[:2]]
+        placed = self.session.query(models.Order).filter(models.Order.id.in_(ids)).all()
+        self.assertEqual(sorted(order.price for order in placed), [1000000, 1100000])
+        self.assertTrue(all(order.accepted and order.dispatched for order in placed))
+
+        # One engine call for the whole batch
+        self.assertEqual([entry[0] for entry in self.engines['BTC/MXN'].component.log], ['place_orders'])
+
+    def test_place_orders_rejected(self):
+        class RefusingEngine(FakeEngine):
+            def place_orders(self, orders):
+                self._log_call('place_orders', orders)
+                return defer.succeed([False, True])
+
+        self.engines['BTC/MXN'] = RefusingEngine()
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util, models
+        import datetime
+
+        orders = [{'username': 'test', 'contract': 'BTC/MXN', 'price': price, 'quantity': 1000000,
+                   'side': 'SELL', 'timestamp': util.dt_to_timestamp(datetime.datetime.utcnow())}
+                  for price in [1000000, 1100000]]
+        results = self.successResultOf(self.webserver_export.place_orders('test', orders))
+        self.assertEqual(results[0], {"success": False, "error": accountant.ORDER_REJECTED.args})
+        self.assertTrue(results[1]["success"])
+
+        # The engine has the refused order cancelled, which frees its margin
+        refused = self.session.query(models.Order).filter_by(price=1000000).one()
+        self.engine_export.cancel_order('test', refused.id)
+        self.assertTrue(self.session.query(models.Order).get(refused.id).is_cancelled)
+        self.assertEqual(self.accountant.get_margin_state(self.accountant.get_user("test")).orders.keys(),
+                         [results[1]["result"]])
+
+    def test_cancel_orders(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        id = self.webserver_export.place_order('test', {'username': 'test',
+                                                        'contract': 'BTC/MXN',
+                                                        'price': 1000000,
+                                                        'quantity': 3000000,
+                                                        'side': 'SELL',
+                                                        'timestamp': util.dt_to_timestamp(datetime.datetime.utcnow())})
+
+        def cancelSuccess(results):
+            self.assertEqual(results, [{'success': True, 'result': True},
+                                       {'success': False, 'error': accountant.NO_ORDER_FOUND.args}])
+
+            from sputnik import models
+
+            order = self.session.query(models.Order).filter_by(id=id).one()
+            self.assertTrue(order.is_cancelled)
+            self.assertTrue(self.engines['BTC/MXN'].component.check_for_calls([('cancel_orders', ([id],), {})]))
+
+        # The accountant talks to the engine over zmq, where the batch comes back as one Deferred
+        self.engines['BTC/MXN'] = FakeEngine()
+        d = self.webserver_export.cancel_orders('test', [id, id + 100])
+        d.addCallback(cancelSuccess)
+        return d
+
+    def test_cancel_many_orders(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util, models
+        import datetime
+
+        order = {'username': 'test', 'contract': 'BTC/MXN', 'price': 1000000, 'quantity': 1000000,
+                 'side': 'SELL', 'timestamp': util.dt_to_timestamp(datetime.datetime.utcnow())}
+        queried_id = self.webserver_export.place_order('test', order)
+        unqueried_id = self.webserver_export.place_order('test', order)
+        # The engine does not have this one
+        gone_id = self.webserver_export.place_order('test', order)
+        del self.engines['BTC/MXN'].component.resting[gone_id]
+
+        queried = self.session.query(models.Order).filter(models.Order.id.in_([queried_id, gone_id])).all()
+        d = self.accountant.cancel_many_orders(queried)
+
+        def cancelled(results):
+            self.assertEqual(results, [(True, [queried_id, unqueried_id])])
+            orders = dict((order.id, order) for order in self.session.query(models.Order))
+            self.assertTrue(orders[queried_id].is_cancelled)
+            self.assertTrue(orders[unqueried_id].is_cancelled)
+            self.assertFalse(orders[gone_id].is_cancelled)
+            self.assertEqual(self.accountant.get_margin_state(self.accountant.get_user("test")).orders.keys(), [gone_id])
+
+        return d.addCallback(cancelled)
+
+    def test_cancel_many_orders_other_users(self):
+        from sputnik import util, models
+        import datetime
+
+        for username, address in [("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv'),
+                                  ("other", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')]:
+            self.create_account(username, address)
+            self.set_permissions_group(username, 'Deposit')
+            self.cashier_export.deposit_cash(username, address, 5000000)
+            self.set_permissions_group(username, 'Trade')
+        order = {'contract': 'BTC/MXN', 'price': 1000000, 'quantity': 1000000,
+                 'side': 'SELL', 'timestamp': util.dt_to_timestamp(datetime.datetime.utcnow())}
+        my_id = self.webserver_export.place_order('test', dict(order, username='test'))
+        # Another accountant's user, with an order on the same book
+        other_id = self.webserver_export.place_order('other', dict(order, username='other'))
+
+        mine = self.session.query(models.Order).filter_by(username='test').all()
+        d = self.accountant.cancel_many_orders(mine)
+
+        def cancelled(results):
+            self.assertEqual(results, [(True, [my_id])])
+            self.assertEqual(self.engines['BTC/MXN'].component.resting, {other_id: 'other'})
+            self.assertFalse(self.session.query(models.Order).get(other_id).is_cancelled)
+
+        return d.addCallback(cancelled)
+
     def test_request_withdrawal_success(self):
         self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
         self.set_permissions_group('test', 'Deposit')
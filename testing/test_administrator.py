@@ -616,6 +616,17 @@ class TestTicketServerExport(TestAdministrator):
         self.assertEqual(ticket.foreign_key, 'KEY')
 
 
+class TestCronExport(TestAdministrator):
+    def test_get_stats(self):
+        from sputnik import administrator
+
+        cron_export = administrator.CronExport(self.administrator)
+        self.create_account('test')
+        before = cron_export.get_stats().get("get_orders", {}).get("count", 0)
+        self.administrator.get_orders(self.get_user('test'))
+        self.assertEqual(cron_export.get_stats()["get_orders"]["count"], before + 1)
+
+
 # Not quite a Dummy
 class StupidRequest(DummyRequest):
     clientproto = 'HTTP/1.1'
@@ -39,6 +39,9 @@ class TestEngine(TestSputnik):
         return Order(id=self.order_counter, contract="FOO", quantity=quantity,
                      price=price, side=side)
 
+    def book(self):
+        return {side: list(orders) for side, orders in self.engine.orderbook.iteritems()}
+
 
 class TestEngineInternals(TestEngine):
     def test_bid(self):
@@ -46,7 +49,7 @@ class TestEngineInternals(TestEngine):
         # make a copy of the order to compare against
         order2 = self.create_order(1, 100, -1)
         self.engine.place_order(order)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [order2], 1: []}))
+        self.assertTrue(FakeComponent.check(self.book(), {-1: [order2], 1: []}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order2,),
                                                                        {})]))
@@ -56,7 +59,7 @@ class TestEngineInternals(TestEngine):
         # make a copy of the order to compare against
         order2 = self.create_order(1, 100, 1)
         self.engine.place_order(order)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [], 1: [order2]}))
+        self.assertTrue(FakeComponent.check(self.book(), {-1: [], 1: [order2]}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order2,),
                                                                        {})]))
@@ -73,7 +76,7 @@ class TestEngineInternals(TestEngine):
 
         self.engine.place_order(order_bid)
         self.engine.place_order(order_ask)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [], 1: []}))
+        self.assertTrue(FakeComponent.check(self.book(), {-1: [], 1: []}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order_bid2,),
                                                                        {}),
@@ -95,7 +98,7 @@ class TestEngineInternals(TestEngine):
 
         self.engine.place_order(order_bid)
         self.engine.place_order(order_ask)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [], 1: []}))
+        self.assertTrue(FakeComponent.check(self.book(), {-1: [], 1: []}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order_bid2,),
                                                                        {}),
@@ -113,7 +116,7 @@ class TestEngineInternals(TestEngine):
 
         self.engine.place_order(order_bid)
         self.engine.place_order(order_ask)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [order_bid], 1: [order_ask]}))
+        self.assertTrue(FakeComponent.check(self.book(), {-1: [order_bid], 1: [order_ask]}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order_bid,),
                                                                        {}),
@@ -210,6 +213,168 @@ class TestEngineInternals(TestEngine):
               (order_bid,),
               {})]))
 
+    def test_time_priority(self):
+        first = self.create_order(1, 100, 1)
+        second = self.create_order(1, 100, 1)
+        first.timestamp = 1
+        second.timestamp = 2
+
+        # Arrival order should not matter, the earlier timestamp goes first
+        self.engine.place_order(second)
+        self.engine.place_order(first)
+        self.assertEqual(list(self.engine.orderbook[1]), [first, second])
+
+        order_bid = self.create_order(1, 100, -1)
+        self.engine.place_order(order_bid)
+        self.assertEqual([o.id for o in self.engine.orderbook[1]], [second.id])
+
+    def test_amend_size_down_keeps_priority(self):
+        orders = [self.create_order(5, 100, 1) for i in range(3)]
+        for i, order in enumerate(orders):
+            order.timestamp = i
+            self.engine.place_order(order)
+        self.engine.place_order(self.create_order(1, 100, -1))
+
+        self.fake_listener.component.log = []
+        self.assertTrue(self.engine.amend_order(orders[0].id, 100, 3))
+        self.assertEqual([(o.id, o.quantity, o.quantity_left) for o in self.engine.orderbook[1]],
+                         [(1, 3, 2), (2, 5, 5), (3, 5, 5)])
+        self.assertEqual([entry[0] for entry in self.fake_listener.component.log], ['on_amend_success'])
+        self.assertEqual(self.fake_listener.component.log[0][1][1], 4)
+
+    def test_amend_price_loses_priority(self):
+        orders = [self.create_order(5, 100, 1) for i in range(2)]
+        for i, order in enumerate(orders):
+            order.timestamp = i
+            self.engine.place_order(order)
+        self.engine.place_order(self.create_order(2, 99, -1))
+
+        # Moving away and back puts it behind the other order
+        self.assertTrue(self.engine.amend_order(1, 101, 5))
+        self.assertTrue(self.engine.amend_order(1, 100, 5))
+        self.assertEqual([(o.id, o.quantity_left) for o in self.engine.orderbook[1]], [(2, 5), (1, 5)])
+        self.assertEqual(self.engine.ordermap[1].quantity, 5)
+
+    def test_amend_size_up_loses_priority(self):
+        orders = [self.create_order(5, 100, 1) for i in range(2)]
+        for i, order in enumerate(orders):
+            order.timestamp = i
+            self.engine.place_order(order)
+
+        self.assertTrue(self.engine.amend_order(1, 100, 6))
+        self.assertEqual([(o.id, o.quantity_left) for o in self.engine.orderbook[1]], [(2, 5), (1, 6)])
+
+    def test_amend_crosses(self):
+        ask = self.create_order(5, 100, 1)
+        bid = self.create_order(2, 99, -1)
+        self.engine.place_order(ask)
+        self.engine.place_order(bid)
+
+        self.fake_listener.component.log = []
+        self.assertTrue(self.engine.amend_order(bid.id, 100, 2))
+        self.assertEqual(self.book()[-1], [])
+        self.assertEqual([(o.id, o.quantity_left) for o in self.engine.orderbook[1]], [(1, 3)])
+        self.assertEqual([entry[0] for entry in self.fake_listener.component.log],
+                         ['on_cancel_success', 'on_trade_success'])
+
+    def test_amend_fail(self):
+        order = self.create_order(5, 100, 1)
+        self.engine.place_order(order)
+        self.engine.place_order(self.create_order(3, 100, -1))
+
+        self.fake_listener.component.log = []
+        self.assertFalse(self.engine.amend_order(order.id, 100, 3))
+        self.assertFalse(self.engine.amend_order(42, 100, 3))
+        self.assertEqual([(entry[0], entry[1][0]) for entry in self.fake_listener.component.log],
+                         [('on_amend_fail', order.id), ('on_amend_fail', 42)])
+        self.assertEqual([(o.id, o.quantity_left) for o in self.engine.orderbook[1]], [(1, 2)])
+
+    def test_cancel_middle_of_level(self):
+        orders = [self.create_order(1, 100, -1) for i in range(3)]
+        for i, order in enumerate(orders):
+            order.timestamp = i
+            self.engine.place_order(order)
+        better = self.create_order(1, 101, -1)
+        self.engine.place_order(better)
+
+        self.assertTrue(self.engine.cancel_order(orders[1].id))
+        self.assertEqual([o.id for o in self.engine.orderbook[-1]],
+                         [better.id, orders[0].id, orders[2].id])
+        self.assertNotIn(orders[1].id, self.engine.ordermap)
+
+        # Emptying the best level falls through to the next one
+        self.assertTrue(self.engine.cancel_order(better.id))
+        self.assertEqual(self.engine.orderbook[-1].best().id, orders[0].id)
+
+    def test_cancel_order_not_on_book(self):
+        self.assertFalse(self.engine.cancel_order(42))
+        self.assertTrue(self.fake_listener.component.check_for_calls(
+            [('on_cancel_fail', (42, "the order is no longer on the book"), {})]))
+
+    def test_sweep_levels(self):
+        for price in [103, 101, 102]:
+            self.engine.place_order(self.create_order(1, price, 1))
+        order_bid = self.create_order(3, 102, -1)
+        self.engine.place_order(order_bid)
+
+        trades = [args for method, args, kwargs in self.fake_listener.component.log
+                  if method == 'on_trade_success']
+        self.assertEqual([price for _, _, price, _ in trades], [101, 102])
+        self.assertEqual([o.price for o in self.engine.orderbook[1]], [103])
+        self.assertEqual([o.quantity_left for o in self.engine.orderbook[-1]], [1])
+
+
+    def test_cancel_all_user(self):
+        orders = [self.create_order(1, 100 + i, 1) for i in range(4)]
+        for order, username in zip(orders, ['a', 'b', 'a', 'a']):
+            order.username = username
+            self.engine.place_order(order)
+
+        # Fill one of a's orders, it should leave the index
+        taker = self.create_order(1, 100, -1)
+        taker.username = 'b'
+        self.engine.place_order(taker)
+        self.assertEqual(sorted(self.engine.user_orders['a']), [3, 4])
+
+        self.fake_listener.component.log = []
+        self.assertEqual(self.engine.cancel_all('a'), [3, 4])
+        self.assertEqual([order.id for order in self.book()[1]], [2])
+        self.assertNotIn('a', self.engine.user_orders)
+        self.assertNotIn('a', self.engine.usernames)
+        self.assertEqual(sorted(self.engine.ordermap), [2])
+
+        # A single notification for the lot
+        self.assertEqual(len(self.fake_listener.component.log), 1)
+        method, args, kwargs = self.fake_listener.component.log[0]
+        self.assertEqual(method, 'on_cancel_all')
+        self.assertEqual([order.id for order in args[0]], [3, 4])
+
+        self.assertEqual(self.engine.cancel_all('a'), [])
+        self.assertEqual(len(self.fake_listener.component.log), 1)
+
+    def test_usernames_shared(self):
+        orders = [self.create_order(1, 100 + i, 1) for i in range(2)]
+        for order in orders:
+            # Equal strings, but not the same one
+            order.username = "".join(["us", "er"])
+            self.engine.place_order(order)
+        self.assertIs(orders[0].username, orders[1].username)
+
+        for order in orders:
+            self.engine.cancel_order(order.id)
+        self.assertEqual(self.engine.usernames, {})
+
+    def test_cancel_all(self):
+        for i in range(3):
+            order = self.create_order(1, 100 + i + 10 * (i % 2), (-1) ** (i + 1))
+            order.username = str(i)
+            self.engine.place_order(order)
+
+        self.assertEqual(self.engine.cancel_all(), [1, 2, 3])
+        self.assertEqual(self.book(), {-1: [], 1: []})
+        self.assertEqual(self.engine.ordermap, {})
+        self.assertEqual(dict(self.engine.user_orders), {})
+
 
 class TestAdministratorExport(TestEngine):
     def test_get_order_book(self):
@@ -234,6 +399,104 @@ class TestAdministratorExport(TestEngine):
                           'quantity_left': 1,
                           'username': None}}}, order_book))
 
+    def test_get_stats(self):
+        from sputnik import engine2
+
+        # Each engine in a process keeps its own timings
+        other = engine2.Engine()
+        self.engine.place_order(self.create_order(1, 100, -1))
+        self.engine.place_order(self.create_order(1, 105, 1))
+        other.place_order(self.create_order(1, 100, -1))
+
+        self.assertEqual(self.administrator_export.get_stats()["place_order"]["count"], 2)
+        self.assertEqual(engine2.AdministratorExport(other).get_stats()["place_order"]["count"], 1)
+
+
+class TestAccountantExport(TestEngine):
+    def setUp(self):
+        TestEngine.setUp(self)
+        from sputnik import engine2
+
+        self.accountant_export = engine2.AccountantExport(self.engine, None, None)
+
+    def test_place_orders(self):
+        orders = [{'id': id, 'contract': 5, 'username': 'maker', 'quantity': 1, 'price': price, 'side': side,
+                   'timestamp': id}
+                  for id, price, side in [(1, 100, -1), (2, 105, 1), (3, 100, 1)]]
+        self.assertEqual(self.accountant_export.place_orders(orders), [True, True, True])
+        self.assertEqual([order.id for order in self.book()[-1]], [])
+        self.assertEqual([order.id for order in self.book()[1]], [2])
+        self.assertEqual([entry[0] for entry in self.fake_listener.component.log],
+                         ['on_queue_success', 'on_queue_success', 'on_trade_success'])
+
+    def test_cancel_orders(self):
+        orders = [self.create_order(1, price, 1) for price in [100, 101, 102]]
+        for order in orders:
+            self.engine.place_order(order)
+
+        self.assertEqual(self.accountant_export.cancel_orders([3, 42, 1]), [True, False, True])
+        self.assertEqual([order.id for order in self.book()[1]], [2])
+
+
+class TestAdmissionQueue(TestEngine):
+    def setUp(self):
+        TestEngine.setUp(self)
+        from sputnik import engine2
+
+        self.admission = engine2.AdmissionQueue(self.engine, max_pending=2, reg_log=False)
+        self.accountant_export = engine2.AccountantExport(self.engine, None, None, self.admission)
+
+    def order_spec(self, id, price, side):
+        return {'id': id, 'contract': 5, 'username': 'maker', 'quantity': 1, 'price': price, 'side': side,
+                'timestamp': id}
+
+    def test_cancels_first(self):
+        self.engine.place_order(self.create_order(1, 100, 1))
+
+        results = []
+        self.accountant_export.place_order(self.order_spec(2, 100, -1)).addCallback(results.append)
+        self.accountant_export.cancel_order(1).addCallback(results.append)
+        self.assertEqual(results, [])
+
+        self.admission.drain()
+        # The cancel took the ask away before the bid could trade with it
+        self.assertEqual(results, [True, True])
+        self.assertEqual([order.id for order in self.book()[-1]], [2])
+        self.assertEqual([order.id for order in self.book()[1]], [])
+
+    def test_cancel_waiting_order(self):
+        results = []
+        self.accountant_export.place_order(self.order_spec(1, 100, 1)).addCallback(results.append)
+        self.accountant_export.cancel_order(1).addCallback(results.append)
+        self.assertEqual(self.admission.stats["depth"], {'cancel': 0, 'order': 2})
+
+        self.admission.drain()
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.book()[1], [])
+
+    def test_overloaded(self):
+        from sputnik import engine2
+
+        for id in [1, 2, 3]:
+            self.accountant_export.place_order(self.order_spec(id, 100 + id, 1))
+        self.assertEqual(self.fake_listener.component.log[-1][0], 'on_queue_fail')
+        self.assertEqual(self.fake_listener.component.log[-1][1][0].id, 3)
+
+        for id in [4, 5]:
+            self.engine.place_order(engine2.Order(**self.order_spec(id, 90 + id, 1)))
+        self.accountant_export.cancel_order(4)
+        self.accountant_export.cancel_order(5)
+        failures = []
+        self.accountant_export.cancel_order(4).addErrback(failures.append)
+        self.assertEqual(failures[0].value, engine2.OVERLOADED)
+
+        self.admission.drain()
+        self.assertEqual([order.id for order in self.book()[1]], [1, 2])
+        self.assertEqual(self.admission.stats, {'depth': {'cancel': 0, 'order': 0},
+                                                'peak_depth': {'cancel': 2, 'order': 2},
+                                                'admitted': {'cancel': 2, 'order': 2},
+                                                'rejected': {'cancel': 1, 'order': 1}})
+
 
 class TestNotifier(TestEngine):
     def setUp(self):
@@ -262,29 +525,49 @@ class TestAccountantNotifier(TestNotifier):
 
     def test_on_trade_success(self):
         self.accountant_notifier.on_trade_success(self.order, self.passive_order, 10, 10)
-        self.assertTrue(self.accountant.component.check_for_calls([('post_transaction',
-                                                                    (u'aggressive',
-                                                                     {'aggressive': True,
-                                                                      'contract': self.contract.ticker,
-                                                                      'order': 1,
-                                                                      'other_order': 2,
-                                                                      'price': 10,
-                                                                      'quantity': 10,
-                                                                      'side': u'BUY',
-                                                                      'username': u'aggressive'},),
-                                                                    {}),
-                                                                   ('post_transaction',
-                                                                    (u'passive',
-                                                                     {'aggressive': False,
-                                                                      'contract': self.contract.ticker,
-                                                                      'order': 2,
-                                                                      'other_order': 1,
-                                                                      'price': 10,
-                                                                      'quantity': 10,
-                                                                      'side': u'SELL',
-                                                                      'username': u'passive'},),
+        self.assertEqual(self.accountant.component.log, [])
+        self.accountant_notifier.flush()
+        self.assertTrue(self.accountant.component.check_for_calls([('post_transactions',
+                                                                    ([{'aggressive': True,
+                                                                       'contract': self.contract.ticker,
+                                                                       'order': 1,
+                                                                       'other_order': 2,
+                                                                       'price': 10,
+                                                                       'quantity': 10,
+                                                                       'side': u'BUY',
+                                                                       'username': u'aggressive'},
+                                                                      {'aggressive': False,
+                                                                       'contract': self.contract.ticker,
+                                                                       'order': 2,
+                                                                       'other_order': 1,
+                                                                       'price': 10,
+                                                                       'quantity': 10,
+                                                                       'side': u'SELL',
+                                                                       'username': u'passive'}],),
                                                                     {})]))
 
+    def test_batch(self):
+        from sputnik import engine2
+
+        self.engine.add_listener(self.accountant_notifier)
+        self.passive_order.quantity_left = 5
+        self.engine.place_order(self.passive_order)
+        self.engine.place_order(engine2.Order(id=4, contract=self.contract.ticker, quantity=5,
+                                              price=11, side=1, username='passive'))
+        self.engine.place_order(self.order)
+        self.accountant_notifier.flush()
+        self.accountant_notifier.flush()
+
+        self.assertEqual(len(self.accountant.component.log), 1)
+        method, args, kwargs = self.accountant.component.log[0]
+        self.assertEqual(method, 'post_transactions')
+        self.assertEqual([(transaction['order'], transaction['quantity']) for transaction in args[0]],
+                         [(1, 5), (2, 5), (1, 5), (4, 5)])
+
+    def test_on_queue_fail(self):
+        self.accountant_notifier.on_queue_fail(self.order, "the engine is overloaded")
+        self.assertTrue(self.accountant.component.check_for_calls([('cancel_order_engine', (u'aggressive', 1), {})]))
+
 
 class TestWebserverNotifier(TestNotifier):
     def setUp(self):
@@ -381,6 +664,328 @@ class TestWebserverNotifier(TestNotifier):
         ))
 
 
+    def test_wire_book_sorted(self):
+        for price in [10, 12, 11]:
+            self.webserver_notifier.on_queue_success(self.create_order(1, price, -1))
+        for price in [15, 13, 14]:
+            self.webserver_notifier.on_queue_success(self.create_order(2, price, 1))
+
+        self.assertEqual(self.webserver_notifier.wire_book(),
+                         {'contract': 'FOO',
+                          'bids': [{'price': 12, 'quantity': 1},
+                                   {'price': 11, 'quantity': 1},
+                                   {'price': 10, 'quantity': 1}],
+                          'asks': [{'price': 13, 'quantity': 2},
+                                   {'price': 14, 'quantity': 2},
+                                   {'price': 15, 'quantity': 2}]})
+        self.assertEqual(self.webserver_notifier.wire_book(depth=1),
+                         {'contract': 'FOO',
+                          'bids': [{'price': 12, 'quantity': 1}],
+                          'asks': [{'price': 13, 'quantity': 2}]})
+
+    def test_wire_book_cache(self):
+        orders = [self.create_order(1, price, -1) for price in [10, 11, 12]]
+        for order in orders:
+            self.webserver_notifier.on_queue_success(order)
+
+        top = self.webserver_notifier.wire_book(depth=2)
+        self.assertIs(self.webserver_notifier.wire_book(depth=2), top)
+
+        # Below the top two levels
+        self.webserver_notifier.on_cancel_success(orders[0])
+        self.webserver_notifier.on_queue_success(self.create_order(1, 9, -1))
+        self.assertIs(self.webserver_notifier.wire_book(depth=2), top)
+        self.assertEqual([row['price'] for row in self.webserver_notifier.wire_book()['bids']], [12, 11, 9])
+
+        # Within them
+        self.webserver_notifier.on_queue_success(self.create_order(1, 11, -1))
+        self.assertIsNot(self.webserver_notifier.wire_book(depth=2), top)
+        self.assertEqual(self.webserver_notifier.wire_book(depth=2)['bids'],
+                         [{'price': 12, 'quantity': 1}, {'price': 11, 'quantity': 2}])
+
+
+    def test_on_cancel_all(self):
+        orders = [self.create_order(1, price, -1) for price in [10, 11, 11]]
+        for order in orders:
+            self.webserver_notifier.on_queue_success(order)
+        self.webserver.component.log = []
+
+        self.webserver_notifier.on_cancel_all(orders[1:])
+        self.assertTrue(self.webserver.component.check_for_calls([
+            ('book', ('FOO', {'contract': 'FOO', 'asks': [], 'bids': [{'price': 10, 'quantity': 1}]}), {})]))
+        self.assertEqual(len(self.webserver.component.log), 1)
+
+
+    def test_on_amend_success(self):
+        order = self.create_order(5, 100, -1)
+        self.webserver_notifier.on_queue_success(order)
+        order.quantity_left = 2
+        self.webserver_notifier.on_amend_success(order, 5)
+        self.assertTrue(self.webserver.component.check_for_calls([
+            ('book', ('FOO', {'contract': 'FOO', 'asks': [], 'bids': [{'price': 100, 'quantity': 5}]}), {}),
+            ('book', ('FOO', {'contract': 'FOO', 'asks': [], 'bids': [{'price': 100, 'quantity': 2}]}), {})]))
+
+
+class TestBookDeltas(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+
+        self.webserver = FakeComponent()
+        self.webserver_notifier = engine2.WebserverNotifier(self.engine, self.webserver, self.contract,
+                                                            reg_publish=False, deltas=True)
+        self.accountant_export = engine2.AccountantExport(self.engine, None, self.webserver_notifier)
+
+    def test_deltas(self):
+        self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_queue_success(self.small_order)
+        self.webserver_notifier.on_queue_success(self.passive_order)
+        self.webserver_notifier.on_trade_success(self.order, self.passive_order, 10, 10)
+        self.assertEqual([entry[0] for entry in self.webserver.component.log], ['book_delta'] * 4)
+        self.assertTrue(self.webserver.component.check_for_calls([
+            ('book_delta', ('FOO', {'contract': 'FOO', 'sequence': 1, 'asks': [],
+                                    'bids': [{'price': 13, 'quantity': 10}]}), {}),
+            ('book_delta', ('FOO', {'contract': 'FOO', 'sequence': 2, 'asks': [],
+                                    'bids': [{'price': 13, 'quantity': 15}]}), {}),
+            ('book_delta', ('FOO', {'contract': 'FOO', 'sequence': 3, 'bids': [],
+                                    'asks': [{'price': 10, 'quantity': 10}]}), {}),
+            ('book_delta', ('FOO', {'contract': 'FOO', 'sequence': 4, 'bids': [],
+                                    'asks': [{'price': 10, 'quantity': 0}]}), {})]))
+
+    def test_init_pushes_snapshot(self):
+        self.engine.place_order(self.order)
+        self.webserver_notifier.on_init()
+        self.assertTrue(self.webserver.component.check_for_calls([
+            ('book', ('FOO', {'contract': 'FOO', 'sequence': 1, 'asks': [],
+                              'bids': [{'price': 13, 'quantity': 10}]}), {})]))
+
+    def test_get_book_snapshot(self):
+        self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_cancel_success(self.order)
+        self.webserver_notifier.on_queue_success(self.passive_order)
+        self.assertEqual(self.accountant_export.get_book_snapshot(),
+                         {'contract': 'FOO', 'sequence': 3, 'bids': [],
+                          'asks': [{'price': 10, 'quantity': 10}]})
+
+
+    def test_conflation(self):
+        self.webserver_notifier.conflation_window = 0
+        asks = [self.create_order(1, price, 1) for price in [10, 11, 12]]
+        for order in asks:
+            self.webserver_notifier.on_queue_success(order)
+        for order in asks[:2]:
+            self.webserver_notifier.on_trade_success(self.order, order, order.price, 1)
+
+        self.assertEqual(self.webserver.component.log, [])
+        self.webserver_notifier.flush()
+        self.webserver_notifier.flush()
+
+        self.assertEqual(len(self.webserver.component.log), 1)
+        method, args, kwargs = self.webserver.component.log[0]
+        self.assertEqual(method, 'book_delta')
+        self.assertEqual(args[1]['sequence'], 1)
+        self.assertEqual(args[1]['bids'], [])
+        self.assertEqual(sorted(args[1]['asks']), [{'price': 10, 'quantity': 0},
+                                                   {'price': 11, 'quantity': 0},
+                                                   {'price': 12, 'quantity': 1}])
+        self.assertEqual(self.webserver_notifier.changes, 5)
+        self.assertEqual(self.webserver_notifier.conflated, 4)
+        self.assertEqual(self.webserver_notifier.conflation_hit_rate, 0.8)
+
+
 class TestSafePriceNotifier(TestNotifier):
-    pass
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import models
+        import tempfile
+
+        self.contract = self.session.query(models.Contract).filter_by(ticker="BTC/MXN").one()
+        self.other_contract = self.session.query(models.Contract).filter_by(ticker="BTC/PLN").one()
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.accountant = FakeComponent("accountant")
+        self.webserver = FakeComponent("webserver")
+        self.forwarder = FakeComponent("forwarder")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.checkpoint_dir)
+
+    def add_trades(self, contract, trades):
+        from sputnik import models
+        from datetime import datetime
+
+        self.session.execute(models.Trade.__table__.insert(),
+                             [{"contract_id": contract.id, "price": price, "quantity": quantity,
+                               "timestamp": datetime(2015, 1, 1, 0, 0, second)}
+                              for price, quantity, second in trades])
+        self.session.commit()
+
+    def notifier(self, checkpoint_dir=None):
+        from sputnik import engine2
+
+        return engine2.SafePriceNotifier(self.session, self.engine, self.accountant, self.webserver,
+                                         self.forwarder, self.contract, checkpoint_dir=checkpoint_dir,
+                                         reg_publish=False, reg_checkpoint=False)
+
+    def test_on_init(self):
+        self.add_trades(self.contract, [(100, 1, 0), (200, 3, 1)])
+        self.add_trades(self.other_contract, [(5000, 10, 2)])
+        notifier = self.notifier()
+        notifier.on_init()
+
+        self.assertTrue(100 < notifier.safe_price < 200)
+        self.assertTrue(self.webserver.check_for_calls([("safe_prices", ("BTC/MXN", notifier.safe_price), {})]))
+
+    def test_restore(self):
+        from sputnik import models
+
+        self.add_trades(self.contract, [(100, 1, 0), (200, 3, 1)])
+        notifier = self.notifier(self.checkpoint_dir)
+        notifier.on_init()
+        notifier.checkpoint()
+
+        # Only trades after the checkpoint are replayed
+        self.add_trades(self.contract, [(300, 2, 2)])
+        full = self.notifier()
+        full.on_init()
+        self.session.execute("DELETE FROM trades WHERE timestamp < :t",
+                             {"t": full.ema_timestamp})
+        self.assertEqual(self.session.query(models.Trade).count(), 1)
+        restored = self.notifier(self.checkpoint_dir)
+        restored.on_init()
+
+        self.assertEqual(restored.ema_timestamp, full.ema_timestamp)
+        self.assertAlmostEqual(restored.ema_volume, full.ema_volume)
+        self.assertEqual(restored.safe_price, full.safe_price)
+
+    def test_no_checkpoint_without_trades(self):
+        import os
+
+        notifier = self.notifier(self.checkpoint_dir)
+        notifier.on_init()
+        notifier.on_shutdown()
+        self.assertEqual(notifier.safe_price, 42)
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+        self.assertFalse(self.notifier(self.checkpoint_dir).restore())
+
+
+
+class TestJournalListener(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+        import tempfile
+
+        self.contract.id = 7
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal = engine2.JournalListener(self.engine, self.contract, self.journal_dir, reg_snapshot=False)
+        self.engine.add_listener(self.journal)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.journal_dir)
+
+    def recovered_engine(self):
+        from sputnik import engine2
+
+        engine = engine2.Engine()
+        journal = engine2.JournalListener(engine, self.contract, self.journal_dir, reg_snapshot=False)
+        journal.recover()
+        return engine, journal
+
+    def assertSameBook(self, engine):
+        for side in [-1, 1]:
+            self.assertEqual([(o.id, o.price, o.quantity_left, o.username, o.timestamp)
+                              for o in engine.orderbook[side]],
+                             [(o.id, o.price, o.quantity_left, o.username, o.timestamp)
+                              for o in self.engine.orderbook[side]])
+        self.assertEqual(sorted(engine.ordermap.keys()), sorted(self.engine.ordermap.keys()))
+
+    def place_some_orders(self):
+        for quantity, price, side in [(2, 100, -1), (3, 100, -1), (1, 99, -1), (5, 105, 1), (2, 106, 1)]:
+            self.engine.place_order(self.create_order(quantity, price, side))
+
+    def test_recover_from_journal(self):
+        self.place_some_orders()
+        self.engine.place_order(self.create_order(3, 100, 1))
+        self.engine.cancel_order(5)
+
+        engine, journal = self.recovered_engine()
+        self.assertSameBook(engine)
+        self.assertEqual(journal.sequence, self.journal.sequence)
+
+    def test_recover_amended(self):
+        self.place_some_orders()
+        self.engine.amend_order(1, 100, 1)
+        self.engine.amend_order(4, 104, 5)
+
+        engine, journal = self.recovered_engine()
+        self.assertSameBook(engine)
+        self.assertEqual(engine.ordermap[1].quantity, 1)
+
+    def test_recover_from_snapshot_and_journal(self):
+        self.place_some_orders()
+        self.journal.snapshot()
+        self.engine.place_order(self.create_order(1, 105, -1))
+        self.engine.cancel_order(3)
+
+        engine, journal = self.recovered_engine()
+        self.assertSameBook(engine)
+
+    def test_crash_before_journal_truncated(self):
+        self.place_some_orders()
+        journal_copy = open(self.journal.journal_path).read()
+        self.journal.snapshot()
+        self.engine.place_order(self.create_order(1, 100, 1))
+
+        # Put back the entries which are already in the snapshot
+        with open(self.journal.journal_path) as journal_file:
+            tail = journal_file.read()
+        with open(self.journal.journal_path, "w") as journal_file:
+            journal_file.write(journal_copy + tail)
+
+        engine, journal = self.recovered_engine()
+        self.assertSameBook(engine)
+
+    def test_torn_journal_line(self):
+        self.place_some_orders()
+        self.journal.journal.write('[6,"q",7,')
+        self.journal.journal.flush()
+
+        engine, journal = self.recovered_engine()
+        self.assertSameBook(engine)
+
+    def test_recover_nothing(self):
+        import shutil
+        shutil.rmtree(self.journal_dir)
+        os.mkdir(self.journal_dir)
+
+        engine, journal = self.recovered_engine()
+        self.assertEqual(len(engine.ordermap), 0)
+
+    def test_reconcile_book(self):
+        from sputnik import engine2, models
 
+        self.place_some_orders()
+        engine, journal = self.recovered_engine()
+
+        contract = self.get_contract("BTC/MXN")
+        self.contract.id = contract.id
+        user = self.get_user("customer")
+        db_orders = [models.Order(user, contract, 1, 100, "BUY") for i in range(6)]
+        for db_order in db_orders:
+            self.session.add(db_order)
+        self.session.commit()
+        # 3 and 4 were cancelled and 5 filled while the engine was down
+        db_orders[2].is_cancelled = True
+        db_orders[3].is_cancelled = True
+        db_orders[4].quantity_left = 0
+        self.session.commit()
+        # 6 is open in the db but was never seen by the engine
+        missing = db_orders[5]
+
+        accountant = FakeComponent("accountant")
+        engine2.reconcile_book(engine, self.session, self.contract, accountant)
+        self.assertEqual(sorted(engine.ordermap.keys()), [db_orders[0].id, db_orders[1].id])
+        self.assertTrue(accountant.check_for_calls([('cancel_order', ('customer', missing.id), {})]))
+        self.assertFalse(accountant.check_for_calls([('cancel_order', ('customer', db_orders[0].id), {})]))
@@ -89,6 +89,42 @@ class TestLedger(TestSputnik):
 
         return d.addCallback(dbtest)
 
+    def test_balances(self):
+        post1 = {"uid":"foo", "count":2, "type":"Trade", "username":"customer",
+                 "contract":"MXN", "quantity":5, "direction":"debit", "note": "debit",
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        post2 = {"uid":"foo", "count":2, "type":"Trade", "username":"onlinecash",
+                 "contract":"MXN", "quantity":5, "direction":"credit", "note": "credit",
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        self.successResultOf(self.export.post(post1, post2))
+        self.successResultOf(self.export.post(dict(post1, uid="bar"), dict(post2, uid="bar")))
+
+        journal = self.session.query(models.Journal).order_by(models.Journal.id.desc()).first()
+        balances = dict((balance.username, balance) for balance in self.session.query(models.Balance))
+        self.assertEqual(balances["customer"].balance, -10)
+        self.assertEqual(balances["onlinecash"].balance, -10)
+        self.assertEqual(balances["customer"].journal_id, journal.id)
+        self.assertEqual(balances["customer"].timestamp, journal.timestamp)
+
+        self.user = self.get_user("customer")
+        self.create_position("MXN", 0)
+        position = self.session.query(models.Position).filter_by(username="customer").one()
+        self.assertEqual(util.position_calculated(position, self.session),
+                         (-10, journal.timestamp))
+
+        # Without a balance the postings are summed
+        self.session.delete(balances["customer"])
+        self.session.commit()
+        self.assertEqual(util.position_calculated(position, self.session),
+                         (-10, journal.timestamp))
+
+        # A new balance starts from all of the postings, not just the new ones
+        self.successResultOf(self.export.post(dict(post1, uid="baz", quantity=1), dict(post2, uid="baz", quantity=1)))
+        self.session.expire_all()
+        balance = self.session.query(models.Balance).filter_by(username="customer").one()
+        self.assertEqual(balance.balance, -11)
+        self.assertEqual(util.position_calculated(position, self.session)[0], -11)
+
     def test_count_mismatch(self):
         post1 = {"uid":"foo", "count":2, "type":"Trade", "username":"customer",
                  "contract":"MXN", "quantity":5, "direction":"debit", "note": "debit",
@@ -148,3 +184,149 @@ class TestLedger(TestSputnik):
         return self.assertEqual(self.successResultOf(d1),
                 ledger.GROUP_TIMEOUT)
 
+    def test_unknown_user(self):
+        post1 = {"uid":"foo", "count":2, "type":"Trade", "username":"customer",
+                 "contract":"MXN", "quantity":5, "direction":"debit", "note": 'debit',
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        post2 = {"uid":"foo", "count":2, "type":"Trade", "username":"nobody",
+                 "contract":"MXN", "quantity":5, "direction":"credit", "note": 'credit',
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        d1 = self.export.post(post1)
+        d1.addErrback(lambda x: None)
+        d2 = self.assertFailure(self.export.post(post2),
+                LedgerException)
+        self.flushLoggedErrors()
+        self.assertEqual(self.successResultOf(d2), ledger.ARGUMENT_ERROR)
+
+        # Nothing was written, and what was looked up is kept
+        self.assertEqual(self.session.query(models.Journal).count(), 0)
+        self.assertEqual(self.ledger.user_types, {"customer": "Liability"})
+        self.assertEqual(self.ledger.contract_ids.keys(), ["MXN"])
+
+    def test_timeout_expires_group(self):
+        post1 = {"uid":"foo", "count":2, "type":"Trade", "username":"customer",
+                 "contract":"MXN", "quantity":5, "direction":"debit", "note": 'debit',
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        d1 = self.assertFailure(self.export.post(post1), LedgerException)
+        group = self.ledger.pending["foo"]
+        group.callLater = self.clock.callLater
+        group.setTimeout(1)
+        self.clock.advance(2)
+        self.flushLoggedErrors()
+
+        self.assertEqual(self.ledger.pending, {})
+        self.assertEqual(self.ledger.stats["pending_postings"], 0)
+        self.assertEqual(self.ledger.stats["timed_out"], 1)
+        return d1
+
+    def test_overloaded(self):
+        self.ledger.max_pending_groups = 2
+        self.ledger.max_pending_postings = 3
+        post = {"count":2, "type":"Trade", "username":"customer",
+                "contract":"MXN", "quantity":5, "direction":"debit", "note": 'debit',
+                "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        self.export.post(dict(post, uid="foo"))
+        self.export.post(dict(post, uid="bar"))
+
+        # A third group is refused, by count and then by postings
+        d = self.assertFailure(maybeDeferred(self.export.post, dict(post, uid="baz")),
+                               LedgerException)
+        self.assertEqual(self.successResultOf(d), ledger.OVERLOADED)
+        self.ledger.max_pending_groups = 3
+        d = self.assertFailure(maybeDeferred(self.export.post, dict(post, uid="baz"), dict(post, uid="baz")),
+                               LedgerException)
+        self.assertEqual(self.successResultOf(d), ledger.OVERLOADED)
+        self.flushLoggedErrors()
+
+        # Groups already pending can still complete
+        d = self.export.post(dict(post, uid="foo", direction="credit"))
+        self.assertTrue(self.successResultOf(d))
+        stats = self.export.get_stats()["pending"]
+        self.assertEqual(stats["pending_groups"], 1)
+        self.assertEqual(stats["pending_postings"], 1)
+        self.assertEqual(stats["completed"], 1)
+        self.assertEqual(stats["rejected"], 2)
+
+        self.ledger.log_stats()
+        self.assertEqual(self.ledger.stats["rejected"], 0)
+        self.assertEqual(self.ledger.stats["peak_pending_groups"], 1)
+
+
+class TestGroupCommit(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+        self.ledger = ledger.Ledger(self.session.bind.engine, group_commit_window=0.01,
+                                    group_commit_size=3)
+        self.export = ledger.AccountantExport(self.ledger)
+        self.clock = task.Clock()
+        self.ledger.callLater = self.clock.callLater
+        from sputnik import stats
+        stats.registry.reset()
+
+    def post(self, uid, username="customer"):
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        post1 = {"uid":uid, "count":2, "type":"Trade", "username":"customer",
+                 "contract":"MXN", "quantity":5, "direction":"debit", "note": 'debit',
+                 "timestamp": timestamp}
+        post2 = {"uid":uid, "count":2, "type":"Trade", "username":username,
+                 "contract":"MXN", "quantity":5, "direction":"credit", "note": 'credit',
+                 "timestamp": timestamp}
+        # The first posting's deferred fails along with the second's
+        self.export.post(post1).addErrback(lambda x: None)
+        return self.export.post(post2)
+
+    def test_window(self):
+        from sputnik import stats
+
+        d1 = self.post("foo")
+        d2 = self.post("bar")
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.assertEqual(self.session.query(models.Journal).count(), 0)
+
+        self.clock.advance(0.01)
+        self.assertTrue(self.successResultOf(d1))
+        self.assertTrue(self.successResultOf(d2))
+        self.assertEqual(self.session.query(models.Journal).count(), 2)
+        self.assertEqual(self.session.query(models.Posting).count(), 4)
+        self.assertEqual(stats.registry.stats["group_commit_size"]["max"], 2)
+        self.assertEqual(stats.registry.stats["group_commit_wait"]["count"], 2)
+
+        # Both journals moved the balance, the second one last
+        balance = self.session.query(models.Balance).filter_by(username="customer").one()
+        self.assertEqual(balance.balance, 0)
+        self.assertEqual(balance.journal_id, max(journal.id for journal in self.session.query(models.Journal)))
+
+    def test_size(self):
+        deferreds = [self.post(uid) for uid in ["foo", "bar", "baz"]]
+        for d in deferreds:
+            self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.session.query(models.Journal).count(), 3)
+        self.assertEqual(self.ledger.commit_call, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_bad_group(self):
+        d1 = self.post("foo")
+        d2 = self.assertFailure(self.post("bar", username="nobody"), LedgerException)
+        self.clock.advance(0.01)
+        self.flushLoggedErrors()
+
+        # The good group is committed without the bad one
+        self.assertTrue(self.successResultOf(d1))
+        self.assertEqual(self.successResultOf(d2), ledger.ARGUMENT_ERROR)
+        self.assertEqual(self.session.query(models.Journal).count(), 1)
+        self.assertEqual(self.session.query(models.Posting).count(), 2)
+
+    def test_audit(self):
+        post1 = {"uid":"foo", "count":2, "type":"Trade", "username":"customer",
+                 "contract":"MXN", "quantity":5, "direction":"debit", "note": 'debit',
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        post2 = {"uid":"foo", "count":2, "type":"Trade", "username":"customer",
+                 "contract":"MXN", "quantity":1, "direction":"credit", "note": 'credit',
+                 "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}
+        d = self.assertFailure(self.export.post(post1, post2), LedgerException)
+        self.flushLoggedErrors()
+
+        # Fails at once, without waiting for the window
+        self.assertEqual(self.successResultOf(d), ledger.QUANTITY_MISMATCH)
+        self.assertEqual(self.ledger.ready_groups, [])
@@ -293,3 +293,77 @@ class TestMargin(TestSputnik):
         low, high, _ = margin.calculate_margin(self.user, self.session, {}, id)
         assert high > self.get_position("BTC").position
 
+
+    def test_margin_state(self):
+        from sputnik import models
+        self.create_position('MXN', 10000)
+        self.create_position('USDBTC0W', -1, reference_price=1000)
+        self.create_order('BTC/MXN', 50000000, 5000, 'BUY')
+        self.create_order('USDBTC0W', 1, 1500, 'SELL')
+        self.create_order('NETS2015', 2, 500, 'BUY')
+
+        safe_prices = {'USDBTC0W': 1200}
+        state = margin.MarginState(self.user)
+        state.load(self.session)
+        positions = {position.contract.ticker: {'position': position.position,
+                                                'reference_price': position.reference_price,
+                                                'contract': position.contract}
+                     for position in self.session.query(models.Position).filter_by(user=self.user)}
+
+        def check(order_id=None, withdrawals=None):
+            order = self.session.query(models.Order).filter_by(id=order_id).one() if order_id else None
+            expected = margin.calculate_margin(self.user, self.session, safe_prices, order_id=order_id,
+                                               withdrawals=withdrawals)
+            low, high, cash_spent = state.calculate(positions, safe_prices, order=order, withdrawals=withdrawals)
+            self.assertEqual((low, high), expected[:2])
+            self.assertEqual(dict((k, v) for k, v in cash_spent.iteritems() if v),
+                             dict((k, v) for k, v in expected[2].iteritems() if v))
+
+        check()
+        check(withdrawals={'BTC': 1000})
+        check(self.create_order('USDBTC0W', 3, 1100, 'BUY', False))
+        self.assertEqual(len(state.orders), 3)
+
+        # Part filled, then cancelled
+        order = self.session.query(models.Order).filter_by(contract=self.get_contract('BTC/MXN')).one()
+        order.quantity_left -= 20000000
+        self.session.commit()
+        state.update_order(order)
+        check()
+
+        order.is_cancelled = True
+        self.session.commit()
+        state.update_order(order)
+        check()
+        self.assertEqual(len(state.orders), 2)
+
+    def test_calculate_margins(self):
+        self.create_position('MXN', 10000)
+        self.create_position('USDBTC0W', -1, reference_price=1000)
+        self.create_order('BTC/MXN', 50000000, 5000, 'BUY')
+        self.create_order('BTC/MXN', 20000000, 15000, 'SELL')
+        self.create_order('USDBTC0W', 1, 1500, 'SELL')
+        self.create_order('NETS2015', 2, 500, 'BUY')
+
+        self.create_account("short")
+        self.user = self.get_user("short")
+        self.create_position('NETS2015', -3)
+        self.create_position('MXN', -5)
+        self.create_order('NETS2015', 1, 700, 'SELL')
+        self.create_order('USDBTC0W', 2, 900, 'BUY')
+
+        # Big enough to overflow 64 bits
+        self.create_account("whale")
+        self.user = self.get_user("whale")
+        self.create_order('BTC/MXN', 10**12, 10**9, 'BUY')
+
+        self.create_account("idle")
+
+        users = [self.get_user(username) for username in ["test", "short", "whale", "idle"]]
+        for safe_prices in [{'USDBTC0W': 1200}, {}]:
+            margins = margin.calculate_margins(users, self.session, safe_prices)
+            for user in users:
+                low, high, cash_spent = margin.calculate_margin(user, self.session, safe_prices)
+                self.assertEqual(margins[user.username][:2], (low, high))
+                nonzero = lambda cash_spent: dict((k, v) for k, v in cash_spent.iteritems() if v)
+                self.assertDictEqual(nonzero(margins[user.username][2]), nonzero(cash_spent))
@@ -0,0 +1,166 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import sys
+import os
+import json
+from test_sputnik import fix_config, TestSputnik, FakeComponent, FakeSendmail
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../tools"))
+
+fix_config()
+
+
+class TestRiskManager(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+        # riskmanager reads its default config file when it is imported,
+        # so what it imports has to be loaded already
+        from sputnik import accountant
+        from sputnik import riskmanager
+        fix_config()
+
+        self.create_account("test")
+        self.create_account("other")
+        self.user = self.get_user("test")
+        self.create_position("USDBTC0W", -1, reference_price=1000)
+        self.user = self.get_user("other")
+        self.create_position("NETS2015", 3)
+
+        self.accountant = FakeComponent("accountant")
+        self.riskmanager = riskmanager.RiskManager(self.session, FakeSendmail("test-email@m2.io"),
+                                                   FakeComponent("safe_price_subscriber"), self.accountant,
+                                                   admin_templates="../server/sputnik/admin_templates")
+        self.checked = []
+        self.riskmanager.check_users = lambda usernames, safe_prices: \
+            self.checked.append(sorted(usernames) if usernames is not None else None)
+
+    def test_changed_only(self):
+        prices = {"USDBTC0W": 1000, "NETS2015": 500}
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        # Everyone
+        self.assertEqual(self.checked, [None])
+        self.assertEqual(self.riskmanager.exposure["USDBTC0W"], set(["test"]))
+
+        # Nothing moved
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        self.assertEqual(len(self.checked), 1)
+
+        prices["USDBTC0W"] = 1100
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        self.assertEqual(self.checked[1], ["test"])
+
+        # A new order puts other in the contract
+        self.create_order("USDBTC0W", 1, 1000, "SELL")
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        self.assertEqual(self.checked[2], ["other"])
+        self.assertEqual(self.riskmanager.exposure["USDBTC0W"], set(["test", "other"]))
+
+        prices["USDBTC0W"] = 1200
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        self.assertEqual(self.checked[3], ["other", "test"])
+
+    def test_late_posting(self):
+        from sputnik import ledger, util
+        import datetime
+
+        prices = {"USDBTC0W": 1000, "NETS2015": 500}
+        # Stamped before the sweep, committed after it
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow() - datetime.timedelta(minutes=5))
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+
+        postings = [dict(ledger.create_posting("Transfer", username, "BTC", 5, direction, timestamp=timestamp),
+                         uid="late", count=2)
+                    for username, direction in [("test", "debit"), ("other", "credit")]]
+        self.successResultOf(ledger.Ledger(self.session.bind.engine).post(postings))
+
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        self.assertEqual(self.checked[1], ["other", "test"])
+
+        # Seen once only
+        self.riskmanager.on_safe_prices(json.dumps(prices))
+        self.assertEqual(len(self.checked), 2)
+
+    def test_check_users(self):
+        from sputnik import riskmanager
+
+        checker = riskmanager.RiskManager(self.session, FakeSendmail("test-email@m2.io"),
+                                          FakeComponent("safe_price_subscriber"), self.accountant,
+                                          admin_templates="../server/sputnik/admin_templates")
+        checker.on_safe_prices(json.dumps({"USDBTC0W": 1000, "NETS2015": 500}))
+
+        # test has no cash to cover the short
+        self.assertTrue(self.accountant.check_for_calls([("liquidate_best", ("test",), {})]))
+        self.assertIn("test", checker.bad_margin_users)
+        self.assertNotIn("other", checker.bad_margin_users)
+        self.assertNotIn("other", checker.low_margin_users)
+
+    def test_shards(self):
+        from sputnik import riskmanager, accountant
+
+        usernames = set()
+        for shard in range(2):
+            checker = riskmanager.MarginChecker(self.session, shard, 2)
+            users = [user.username for user in checker.get_users()]
+            self.assertTrue(all(accountant.shard_for_user(username, 2) == shard for username in users))
+            usernames.update(users)
+            self.assertEqual([user.username for user in checker.get_users(set(["test", "other"]))],
+                             [username for username in ["test", "other"] if username in users])
+        self.assertTrue(set(["test", "other"]) <= usernames)
+
+    def test_check_shard(self):
+        from sputnik import riskmanager
+
+        # The workers make their own sessions; here they share the test database
+        self.patch(riskmanager.database, "make_session", lambda: self.session)
+        self.patch(riskmanager, "worker", None)
+
+        safe_prices = {"USDBTC0W": 1000, "NETS2015": 500}
+        results = []
+        for shard in range(2):
+            riskmanager.init_worker(shard, 2)
+            self.assertEqual(riskmanager.worker.shard, shard)
+            results.extend(riskmanager.check_shard(safe_prices))
+            results.extend(riskmanager.check_shard(safe_prices, set(["test", "other"])))
+
+        checker = riskmanager.MarginChecker(self.session)
+        expected = checker.check(checker.get_users(), safe_prices)
+        expected.extend(checker.check(checker.get_users(set(["test", "other"])), safe_prices))
+        self.assertEqual(sorted(results), sorted(expected))
+        self.assertIn("test", [result[0] for result in results])
+
+    def test_sharded_sweep(self):
+        from sputnik import riskmanager
+        from twisted.internet import defer
+
+        class FakeSweep:
+            def __init__(self):
+                self.pending = []
+
+            def check(self, safe_prices, usernames=None):
+                d = defer.Deferred()
+                self.pending.append(d)
+                return d
+
+        sweep = FakeSweep()
+        coordinator = riskmanager.RiskManager(self.session, FakeSendmail("test-email@m2.io"),
+                                              FakeComponent("safe_price_subscriber"), self.accountant,
+                                              admin_templates="../server/sputnik/admin_templates",
+                                              sweep=sweep)
+        coordinator.on_safe_prices(json.dumps({"USDBTC0W": 1000}))
+        # Nothing more is sent to the workers until they answer
+        coordinator.on_safe_prices(json.dumps({"USDBTC0W": 1100}))
+        self.assertEqual(len(sweep.pending), 1)
+
+        sweep.pending[0].callback([("test", "CALL", 0, 100, 200), ("other", "OK", 0, 0, 0)])
+        self.assertTrue(self.accountant.check_for_calls([("liquidate_best", ("test",), {})]))
+        self.assertIn("test", coordinator.bad_margin_users)
+        self.assertFalse(coordinator.sweeping)
@@ -0,0 +1,89 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from twisted.trial import unittest
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        from sputnik import stats
+
+        self.histogram = stats.Histogram(sub_buckets=32)
+
+    def test_buckets(self):
+        # Exact below sub_buckets, then 32 buckets per power of two
+        self.assertEqual(self.histogram.bucket(31), 31)
+        self.assertEqual(self.histogram.bucket(65), 64)
+        self.assertEqual(self.histogram.bucket(1000), 992)
+        self.assertEqual(self.histogram.top(992), 1007)
+        for value in [0, 5, 64, 1000, 123456, 10 ** 9]:
+            bucket = self.histogram.bucket(value)
+            self.assertTrue(bucket <= value <= self.histogram.top(bucket))
+            self.assertTrue(self.histogram.top(bucket) - bucket <= value / 32)
+
+    def test_percentile(self):
+        self.assertEqual(self.histogram.percentile(0.99), None)
+        for value in range(1, 1001):
+            self.histogram.record(value)
+
+        self.assertEqual(len(self.histogram.counts), 190)
+        for fraction in [0.5, 0.9, 0.99]:
+            exact = fraction * 1000
+            self.assertTrue(exact <= self.histogram.percentile(fraction) <= exact * 33 / 32)
+        self.assertEqual(self.histogram.percentile(1), 1000)
+
+    def test_stats(self):
+        for value in [1000, 2000, 3000]:
+            self.histogram.record(value)
+
+        stats = self.histogram.stats
+        self.assertEqual(stats["count"], 3)
+        self.assertEqual(stats["mean"], 2)
+        self.assertEqual(stats["min"], 1)
+        self.assertEqual(stats["max"], 3)
+
+
+class TestTimed(unittest.TestCase):
+    def setUp(self):
+        from sputnik import stats
+
+        stats.registry.reset()
+
+    def test_timed(self):
+        from sputnik import util, stats
+
+        @util.timed
+        def add(a, b):
+            return a + b
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(add(2, 3), 5)
+        self.assertEqual(stats.registry.stats["add"]["count"], 2)
+
+        stats.registry.log_stats()
+        self.assertEqual(stats.registry.stats, {})
+
+    def test_timed_registry(self):
+        from sputnik import util, stats
+
+        class Timed(object):
+            stats_registry = stats.Registry("timed")
+
+            @util.timed
+            def add(self, a, b):
+                return a + b
+
+        self.assertEqual(Timed().add(1, 2), 3)
+        self.assertEqual(Timed.stats_registry.stats["add"]["count"], 1)
+        self.assertEqual(stats.registry.stats, {})
+        Timed.stats_registry.log_stats()
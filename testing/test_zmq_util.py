@@ -74,6 +74,39 @@ class TestAsyncRouterDealer(unittest.TestCase):
         d.addCallbacks(onSuccess, onFail)
         return d
 
+class TestAsyncRoutedRouterDealer(unittest.TestCase):
+    def setUp(self):
+        from sputnik import zmq_util
+        import random
+        port = random.randint(50000, 60000)
+        self.dealer_proxy = zmq_util.dealer_proxy_async("tcp://127.0.0.1:%d" % port, timeout=None)
+        self.exports = {"A": TestExport(), "B": TestExport()}
+        self.router_share = zmq_util.router_share_routed_async(self.exports, "tcp://127.0.0.1:%d" % port)
+
+    def tearDown(self):
+        self.dealer_proxy._connection.factory.shutdown()
+        self.router_share.connection.factory.shutdown()
+
+    def test_route(self):
+        d = self.dealer_proxy.routed("B").test_function(True)
+        def onSuccess(result):
+            self.assertTrue(result)
+            self.assertIsNone(self.exports["A"].test_function_argument)
+            self.assertTrue(self.exports["B"].test_function_argument)
+
+        return d.addCallback(onSuccess)
+
+    def test_bad_route(self):
+        d = self.dealer_proxy.routed("C").test_function(True)
+
+        def onSuccess(result):
+            self.assertTrue(False)
+
+        def onFail(failure):
+            self.assertIsInstance(failure.value, Exception)
+
+        return d.addCallbacks(onSuccess, onFail)
+
 class TestSyncRouterDealer(unittest.TestCase):
     pass
 
@@ -20,6 +20,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
 from sputnik import config
 from sputnik import database, models, util
 from datetime import datetime
+from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 import time
 
@@ -49,6 +50,22 @@ for journal in journals:
         adjust = False
     count += 1
 
+# Go through balances
+sums = session.query(models.Posting.username, models.Posting.contract_id,
+                     func.sum(models.Posting.quantity)).group_by(models.Posting.username, models.Posting.contract_id)
+balances = dict(((balance.username, balance.contract_id), balance.balance)
+                for balance in session.query(models.Balance))
+print "%d balances to cover" % len(balances)
+for username, contract_id, quantity in sums:
+    balance = balances.pop((username, contract_id), None)
+    if balance != quantity:
+        print "Balance of %s in contract %d is %s, postings sum to %d" % (username, contract_id, balance, quantity)
+        # Positions are checked against the balances
+        adjust = False
+for (username, contract_id), balance in balances.iteritems():
+    print "Balance of %s in contract %d is %d, there are no postings" % (username, contract_id, balance)
+    adjust = False
+
 # Go through positions
 positions = session.query(models.Position)
 total = positions.count()
@@ -21,6 +21,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
 from sputnik import config
 from sputnik import database, models
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import func
 from dateutil import parser
 from datetime import timedelta, datetime
 import shlex
@@ -367,6 +368,19 @@ class DatabaseManager:
     def init(self):
         database.Base.metadata.create_all(self.session.bind)
 
+    def rebuild_balances(self):
+        """Recreate the balances the ledger keeps from all of the postings
+        """
+        self.session.query(models.Balance).delete()
+        rows = self.session.query(models.Posting.username, models.Posting.contract_id,
+                                  func.sum(models.Posting.quantity), func.max(models.Journal.id)).filter(
+            models.Journal.id == models.Posting.journal_id).group_by(
+            models.Posting.username, models.Posting.contract_id)
+        for username, contract_id, balance, journal_id in rows:
+            journal = self.session.query(models.Journal).get(journal_id)
+            self.session.add(models.Balance(username=username, contract_id=contract_id, balance=balance,
+                                            journal_id=journal_id, timestamp=journal.timestamp))
+
 class LowEarthOrbit:
     def __init__(self, session):
         self.session = session